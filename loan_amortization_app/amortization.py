@@ -0,0 +1,234 @@
+import math
+from decimal import ROUND_HALF_EVEN, ROUND_HALF_UP, Decimal, localcontext
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+
+class SummaryValues(NamedTuple):
+    month: int
+    monthly_payment: float
+    remaining_balance: float
+
+
+def monthly_interest_rate(annual_interest_rate) -> float:
+    return float((annual_interest_rate / 100) / 12)
+
+
+def monthly_payment(amount: float, rate: float, term: int) -> float:
+    if rate == 0:
+        return amount / term
+    numerator = (rate * ((float(1) + rate) ** float(term)))
+    denominator = (((float(1) + rate) ** float(term)) - float(1))
+    return amount * (numerator / denominator)
+
+
+def closed_form_balance(amount: float, rate: float, payment: float, month: int) -> float:
+    if rate == 0:
+        return amount - payment * month
+    growth = (float(1) + rate) ** month
+    return amount * growth - payment * (growth - float(1)) / rate
+
+
+def replay_balance(amount: float, rate: float, payment: float, month: int) -> float:
+    remaining = amount
+    for _ in range(month):
+        remaining -= payment - (remaining * rate)
+    return remaining
+
+
+def near_half_cent(value: float, error_bound: float) -> bool:
+    cents = abs(value) * 100
+    return abs(cents - math.floor(cents) - 0.5) < max(1e-6, error_bound * 100)
+
+
+def balance_error_bound(amount: float, rate: float, month: int) -> float:
+    # The closed form and the month-by-month loop drift apart by at most ~2e-12 of
+    # amount * (1 + rate) ** month, which only changes the rounded cents when the
+    # balance sits that close to a half cent.
+    return abs(amount) * (float(1) + rate) ** month * 1e-11
+
+
+def summary_values(amount: float, annual_interest_rate, term: int, month: int,
+                   replay: str = "auto") -> SummaryValues:
+    rate = monthly_interest_rate(annual_interest_rate)
+    payment = monthly_payment(amount, rate, term)
+    if replay == "always":
+        remaining = replay_balance(amount, rate, payment, month)
+    else:
+        remaining = closed_form_balance(amount, rate, payment, month)
+        if replay == "auto" and near_half_cent(remaining, balance_error_bound(amount, rate, month)):
+            remaining = replay_balance(amount, rate, payment, month)
+    return SummaryValues(month=month, monthly_payment=round(payment, 2),
+                         remaining_balance=round(remaining, 2) + 0.0)
+
+
+def as_decimal(value: float) -> Decimal:
+    return Decimal(str(value))
+
+
+class ScheduleColumns(NamedTuple):
+    month: Sequence[int]
+    monthly_payment: Sequence[float]
+    principal: Sequence[float]
+    interest: Sequence[float]
+    remaining_balance: Sequence[float]
+
+    def window(self, start: int, stop: int) -> "ScheduleColumns":
+        offset = start - self.month[0]
+        return ScheduleColumns(*(column[offset:offset + stop - start + 1] for column in self))
+
+    def rows(self, fields: Sequence[str] = ("month", "remaining_balance", "monthly_payment")) -> List[dict]:
+        columns = [as_list(getattr(self, field)) for field in fields]
+        return [dict(zip(fields, values)) for values in zip(*columns)]
+
+
+def as_list(column) -> list:
+    return column.tolist() if hasattr(column, "tolist") else list(column)
+
+
+def python_schedule(amount: float, annual_interest_rate, term: int, start: int = 1,
+                    stop: Optional[int] = None) -> ScheduleColumns:
+    stop = term if stop is None else stop
+    rate = monthly_interest_rate(annual_interest_rate)
+    payment = monthly_payment(amount, rate, term)
+    if start == 1:
+        columns, _ = _python_window(amount, amount, rate, payment, start, stop)
+        return columns
+
+    # Jump to the month before the window with the closed form; if any balance in the
+    # window could round differently from the full loop, replay from month one instead.
+    remaining = closed_form_balance(amount, rate, payment, start - 1)
+    columns, ambiguous = _python_window(remaining, amount, rate, payment, start, stop)
+    if ambiguous:
+        remaining = replay_balance(amount, rate, payment, start - 1)
+        columns, _ = _python_window(remaining, amount, rate, payment, start, stop)
+    return columns
+
+
+def _python_window(remaining: float, amount: float, rate: float, payment: float, start: int,
+                   stop: int) -> Tuple[ScheduleColumns, bool]:
+    rounded_payment = round(payment, 2)
+    balances, principals, interests = [], [], []
+    ambiguous = False
+    for month in range(start, stop + 1):
+        principal = payment - (remaining * rate)
+        remaining -= principal
+        balances.append(round(remaining, 2) + 0.0)
+        principals.append(round(principal, 2))
+        interests.append(round(payment - principal, 2))
+        ambiguous = ambiguous or (start > 1 and near_half_cent(remaining, balance_error_bound(amount, rate, month)))
+
+    columns = ScheduleColumns(month=list(range(start, stop + 1)), monthly_payment=[rounded_payment] * len(balances),
+                              principal=principals, interest=interests, remaining_balance=balances)
+    return columns, ambiguous
+
+
+# Exact mode works in integer cents. The monthly rate is annual_interest_rate / 1200,
+# i.e. rate_bp / RATE_DENOMINATOR with the annual rate expressed in basis points.
+RATE_DENOMINATOR = 120000
+
+
+class CentsSummary(NamedTuple):
+    month: int
+    remaining_balance: int
+    principal_paid: int
+    interest_paid: int
+
+
+def to_cents(value) -> int:
+    return int((Decimal(value) * 100).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def rate_basis_points(annual_interest_rate) -> int:
+    return int((Decimal(annual_interest_rate) * 100).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def round_div(numerator: int, denominator: int, rounding: str) -> int:
+    quotient, remainder = divmod(numerator, denominator)
+    twice = 2 * remainder
+    if twice > denominator or (twice == denominator and (rounding == "half_up" or quotient % 2 == 1)):
+        quotient += 1
+    return quotient
+
+
+def cents_payment(amount_cents: int, rate_bp: int, term: int, rounding: str) -> int:
+    if rate_bp == 0:
+        return round_div(amount_cents, term, rounding)
+    growth = (RATE_DENOMINATOR + rate_bp) ** term
+    base = RATE_DENOMINATOR ** term
+    return round_div(amount_cents * rate_bp * growth, RATE_DENOMINATOR * (growth - base), rounding)
+
+
+def cents_kernel(amount_cents: int, rate_bp: int, term: int, rounding: str = "half_up",
+                months: Optional[int] = None):
+    payment = cents_payment(amount_cents, rate_bp, term, rounding)
+    balance = amount_cents
+    half = RATE_DENOMINATOR // 2
+    round_half_up = rounding == "half_up"
+    for month in range(1, (term if months is None else months) + 1):
+        if rate_bp:
+            interest, remainder = divmod(balance * rate_bp, RATE_DENOMINATOR)
+            if remainder > half or (remainder == half and (round_half_up or interest & 1)):
+                interest += 1
+        else:
+            interest = 0
+        due = balance + interest
+        # The last month (or any month the regular payment would overshoot) pays off
+        # exactly what is left, so the balance always ends at zero.
+        paid = due if month == term or payment > due else payment
+        balance = due - paid
+        yield paid, paid - interest, interest, balance
+
+
+def cents_schedule(amount, annual_interest_rate, term: int, rounding: str = "half_up",
+                   stop: Optional[int] = None) -> ScheduleColumns:
+    # Rounding makes every month depend on the one before, so exact schedules always start at month one.
+    stop = term if stop is None else stop
+    payments, principals, interests, balances = [], [], [], []
+    for paid, principal, interest, balance in cents_kernel(to_cents(amount), rate_basis_points(annual_interest_rate),
+                                                           term, rounding, months=stop):
+        payments.append(paid / 100)
+        principals.append(principal / 100)
+        interests.append(interest / 100)
+        balances.append(balance / 100)
+    return ScheduleColumns(month=list(range(1, stop + 1)), monthly_payment=payments, principal=principals,
+                           interest=interests, remaining_balance=balances)
+
+
+def cents_summary(amount, annual_interest_rate, term: int, month: int, rounding: str = "half_up") -> CentsSummary:
+    amount_cents = to_cents(amount)
+    balance, interest_paid = amount_cents, 0
+    for _, _, interest, balance in cents_kernel(amount_cents, rate_basis_points(annual_interest_rate), term,
+                                                rounding, months=month):
+        interest_paid += interest
+    return CentsSummary(month=month, remaining_balance=balance, principal_paid=amount_cents - balance,
+                        interest_paid=interest_paid)
+
+
+def decimal_schedule(amount, annual_interest_rate, term: int, rounding: str = "half_up") -> ScheduleColumns:
+    # Straightforward decimal.Decimal reference for the exact mode; cents_kernel must agree with it.
+    mode = ROUND_HALF_UP if rounding == "half_up" else ROUND_HALF_EVEN
+    cent = Decimal("0.01")
+    with localcontext() as context:
+        context.prec = 60
+        principal_amount = Decimal(amount).quantize(cent, rounding=mode)
+        annual_rate = Decimal(annual_interest_rate)
+        rate = annual_rate / 1200
+        if rate == 0:
+            payment = (principal_amount / term).quantize(cent, rounding=mode)
+        else:
+            growth = (1 + rate) ** term
+            payment = (principal_amount * rate * growth / (growth - 1)).quantize(cent, rounding=mode)
+
+        payments, principals, interests, balances = [], [], [], []
+        balance = principal_amount
+        for month in range(1, term + 1):
+            interest = (balance * annual_rate / 1200).quantize(cent, rounding=mode)
+            due = balance + interest
+            paid = due if month == term or payment > due else payment
+            balance = due - paid
+            payments.append(float(paid))
+            principals.append(float(paid - interest))
+            interests.append(float(interest))
+            balances.append(float(balance))
+    return ScheduleColumns(month=list(range(1, term + 1)), monthly_payment=payments, principal=principals,
+                           interest=interests, remaining_balance=balances)
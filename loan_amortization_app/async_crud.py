@@ -0,0 +1,91 @@
+from typing import Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import crud
+import sqlmodels
+from config import settings
+from crud import relationship_loader
+
+User = sqlmodels.User
+Loan = sqlmodels.Loan
+
+
+async def get_user(db: AsyncSession, user_id: int):
+    return await db.get(User, user_id)
+
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    return (await db.exec(select(User).where(User.email == email))).first()
+
+
+async def get_user_with_loans(db: AsyncSession, email: str):
+    statement = select(User).where(User.email == email).options(relationship_loader(User.loans))
+    return (await db.exec(statement)).unique().first()
+
+
+async def get_users(db: AsyncSession, limit: int = 100, after_id: Optional[int] = None):
+    statement = select(User).order_by(User.id).limit(limit)
+    if after_id is not None:
+        statement = statement.where(User.id > after_id)
+    return (await db.exec(statement)).all()
+
+
+async def create_user(db: AsyncSession, user: sqlmodels.UserCreate):
+    db_user = User.from_orm(user)
+    db.add(db_user)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise
+    await db.refresh(db_user)
+    return db_user
+
+
+async def create_loan(db: AsyncSession, loan: sqlmodels.LoanCreate, primary_user: User):
+    db_loan = Loan.from_orm(loan)
+    db_loan.shared_users.append(primary_user)
+    db.add(db_loan)
+    if settings.schedule_storage == "eager" and db_loan.loan_term_in_months >= 1:
+        await db.flush()
+        await db.run_sync(lambda session: crud.store_loan_schedule(session, db_loan,
+                                                                   crud.fetch_loan_schedule_columns(db_loan)))
+    await db.commit()
+    return db_loan
+
+
+async def get_loan(db: AsyncSession, loan_id: int):
+    return await db.get(Loan, loan_id)
+
+
+async def get_loan_with_users(db: AsyncSession, loan_id: int):
+    statement = select(Loan).where(Loan.id == loan_id).options(relationship_loader(Loan.shared_users))
+    return (await db.exec(statement)).unique().first()
+
+
+async def create_relationship(db: AsyncSession, user_id: int, loan_id: int):
+    db_relationship = sqlmodels.UserLoanRelationship(user_id=user_id, loan_id=loan_id)
+    db.add(db_relationship)
+    await db.commit()
+    await db.refresh(db_relationship)
+    return db_relationship
+
+
+# Stored schedules go through the sync crud functions on the session's connection;
+# computed ones run in the threadpool so the event loop is not blocked.
+async def fetch_loan_schedule_window(db: AsyncSession, loan: sqlmodels.LoanRead, from_month: int = 1,
+                                     to_month: Optional[int] = None):
+    if settings.schedule_storage != "compute":
+        return await db.run_sync(
+            lambda session: crud.fetch_loan_schedule_window(loan, from_month, to_month, db=session))
+    return await run_in_threadpool(crud.fetch_loan_schedule_window, loan, from_month, to_month)
+
+
+async def fetch_loan_summary(db: AsyncSession, loan: sqlmodels.LoanRead, month: int):
+    if settings.schedule_storage != "compute":
+        return await db.run_sync(lambda session: crud.fetch_loan_summary(loan, month, db=session))
+    return await run_in_threadpool(crud.fetch_loan_summary, loan, month)
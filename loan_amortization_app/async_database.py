@@ -0,0 +1,41 @@
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config import settings
+from database import SQLALCHEMY_DATABASE_URL, apply_sqlite_pragmas, sqlite_pragmas
+
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg", "mysql": "aiomysql"}
+
+
+def async_database_url(database_url: str) -> str:
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend in ASYNC_DRIVERS and url.get_driver_name() not in ASYNC_DRIVERS.values():
+        url = url.set(drivername=backend + "+" + ASYNC_DRIVERS[backend])
+    return url.render_as_string(hide_password=False)
+
+
+def async_engine_options(database_url: str) -> dict:
+    url = make_url(database_url)
+    if url.get_backend_name() != "sqlite":
+        return {"pool_size": settings.db_pool_size, "max_overflow": settings.db_max_overflow,
+                "pool_timeout": settings.db_pool_timeout, "pool_recycle": settings.db_pool_recycle,
+                "pool_pre_ping": settings.db_pool_pre_ping}
+    if url.database in (None, "", ":memory:"):
+        return {"poolclass": StaticPool}
+    return {}
+
+
+def make_async_session_factory(bind) -> sessionmaker:
+    return sessionmaker(bind=bind, class_=AsyncSession, expire_on_commit=False)
+
+
+ASYNC_DATABASE_URL = settings.async_database_url or async_database_url(SQLALCHEMY_DATABASE_URL)
+
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **async_engine_options(ASYNC_DATABASE_URL))
+apply_sqlite_pragmas(async_engine.sync_engine, sqlite_pragmas(ASYNC_DATABASE_URL))
+
+AsyncSessionLocal = make_async_session_factory(async_engine)
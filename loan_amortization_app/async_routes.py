@@ -0,0 +1,131 @@
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import async_crud
+import crud
+import http_cache
+import schedule_formats
+import sqlmodels
+from async_database import AsyncSessionLocal
+from pagination import after_id_from_cursor, encode_cursor
+
+router = APIRouter()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+@router.post("/users/", response_model=sqlmodels.UserRead, tags=["Users"])
+async def create_user(user: sqlmodels.UserCreate, db: AsyncSession = Depends(get_async_db)):
+    try:
+        return await async_crud.create_user(db=db, user=user)
+    except IntegrityError:
+        raise HTTPException(status_code=400, detail="Email already registered")
+
+
+@router.get("/users/", response_model=List[sqlmodels.UserRead], tags=["Users"])
+async def get_users(response: Response, limit: int = 100, cursor: Optional[str] = None,
+                    db: AsyncSession = Depends(get_async_db)):
+    users = await async_crud.get_users(db, limit=limit, after_id=after_id_from_cursor(cursor))
+    if users and len(users) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(users[-1].id)
+    return users
+
+
+@router.get("/users/{user_email}", response_model=sqlmodels.UserRead, tags=["Users"])
+async def get_user_by_email(user_email: str, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_crud.get_user_by_email(db, email=user_email)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return db_user
+
+
+@router.get("/users/{user_email}/loans", response_model=sqlmodels.UserReadWithLoans, tags=["Users"])
+async def get_user_loans(user_email: str, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_crud.get_user_with_loans(db, email=user_email)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return db_user
+
+
+@router.get("/users/{user_email}/loans/share/{loan_id}", response_model=sqlmodels.UserLoanRelationship,
+            tags=["Users"])
+async def share_user_loans(user_email: str, loan_id: int, shared_user_id: int,
+                           db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_crud.get_user_by_email(db, email=user_email)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    db_loan = await async_crud.get_loan(db, loan_id)
+    if db_loan is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    if db_user.id != db_loan.primary_user_id:
+        raise HTTPException(status_code=400, detail="Only the primary loan holder may share the loan")
+    db_share_user = await async_crud.get_user(db, user_id=shared_user_id)
+    if db_share_user is None:
+        raise HTTPException(status_code=404, detail="User to share loan not found")
+    return await async_crud.create_relationship(db, shared_user_id, loan_id)
+
+
+@router.post("/loans/", response_model=sqlmodels.LoanRead, tags=["Loans"])
+async def create_loan(loan: sqlmodels.LoanCreate, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_crud.get_user(db, loan.primary_user_id)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return await async_crud.create_loan(db, loan, db_user)
+
+
+@router.get("/loans/{loan_id}", response_model=sqlmodels.LoanReadWithUsers, tags=["Loans"])
+async def get_loan(loan_id: int, response: Response, if_none_match: Optional[str] = Header(None),
+                   db: AsyncSession = Depends(get_async_db)):
+    db_loan = await async_crud.get_loan_with_users(db, loan_id)
+    if db_loan is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    etag = http_cache.loan_etag(db_loan)
+    cached = http_cache.not_modified(if_none_match, etag, public=False)
+    if cached is not None:
+        return cached
+    response.headers.update(http_cache.cache_headers(etag, public=False))
+    return db_loan
+
+
+@router.get("/loans/schedule/{loan_id}", response_model=List[sqlmodels.LoanSchedule], tags=["Loans"])
+async def get_loan_schedule(loan_id: int, from_month: int = 1, to_month: Optional[int] = None,
+                            fields: Optional[str] = None, accept: Optional[str] = Header(None),
+                            if_none_match: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    db_loan = await async_crud.get_loan(db, loan_id)
+    if db_loan is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    try:
+        schedule_fields = crud.parse_schedule_fields(fields)
+        etag = http_cache.schedule_etag(db_loan, schedule_formats.negotiate(accept), schedule_fields,
+                                        from_month, to_month)
+        cached = http_cache.not_modified(if_none_match, etag, vary="Accept")
+        if cached is not None:
+            return cached
+        columns = await async_crud.fetch_loan_schedule_window(db, db_loan, from_month, to_month)
+        rendered = schedule_formats.render(columns, schedule_fields, accept)
+    except crud.ScheduleQueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    rendered.headers.update(http_cache.cache_headers(etag, vary="Accept"))
+    return rendered
+
+
+@router.get("/loans/schedule/{loan_id}/summary/{month}", response_model=sqlmodels.LoanSummary, tags=["Loans"])
+async def get_loan_summary(loan_id: int, month: int, response: Response,
+                           if_none_match: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    db_loan = await async_crud.get_loan(db, loan_id)
+    if db_loan is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    if month < 1 or month > db_loan.loan_term_in_months:
+        raise HTTPException(status_code=400, detail="Month out of range")
+    etag = http_cache.summary_etag(db_loan, month)
+    cached = http_cache.not_modified(if_none_match, etag)
+    if cached is not None:
+        return cached
+    response.headers.update(http_cache.cache_headers(etag))
+    return await async_crud.fetch_loan_summary(db, db_loan, month)
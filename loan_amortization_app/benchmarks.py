@@ -0,0 +1,329 @@
+import argparse
+import fnmatch
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlmodel import create_engine
+
+import amortization
+import crud
+import group_commit
+import migrations
+import payment_factors
+import sqlmodels
+import vectorized
+from database import apply_sqlite_pragmas, create_database_engine, engine_options, make_session_factory
+
+TERMS = (12, 60, 360, 480)
+USER_COUNTS = (10_000,)
+FULL_USER_COUNTS = (10_000, 1_000_000)
+WRITE_CLIENTS = 8
+WRITES_PER_CLIENT = 25
+# Timings only compare on the machine that recorded them, so the baseline is saved locally
+# with --save-baseline and kept out of git rather than shipped as a reference.
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+DEFAULT_THRESHOLD = 0.20
+
+# Each group yields (name, callable) pairs and every case is timed as soon as it is
+# yielded, so the callables may close over the group's loop variables.
+Case = Tuple[str, Callable[[], object]]
+GROUPS: Dict[str, Callable[["BenchmarkContext"], Iterator[Case]]] = {}
+
+
+def group(name: str):
+    def register(function: Callable[["BenchmarkContext"], Iterator[Case]]):
+        GROUPS[name] = function
+        return function
+    return register
+
+
+def best_of(function: Callable[[], object], repeat: int = 5) -> float:
+    number, _ = timeit.Timer(function).autorange()
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number
+
+
+class BenchmarkContext:
+    def __init__(self, directory: str, user_counts=USER_COUNTS, terms=TERMS):
+        self.directory = directory
+        self.user_counts = user_counts
+        self.terms = terms
+        self._engines = {}
+
+    def engine(self, name: str, tuned: bool = True):
+        if name not in self._engines:
+            url = "sqlite:///" + os.path.join(self.directory, name + ".db")
+            if tuned:
+                engine = create_database_engine(url)
+            else:
+                # SQLite's own defaults, with only a busy timeout so parallel writers wait instead of failing.
+                engine = create_engine(url, **engine_options(url))
+                apply_sqlite_pragmas(engine, ["PRAGMA busy_timeout = 30000"])
+            migrations.upgrade(engine)
+            self._engines[name] = engine
+        return self._engines[name]
+
+    def session(self, name: str):
+        return make_session_factory(self.engine(name))()
+
+    def dispose(self):
+        for engine in self._engines.values():
+            engine.dispose()
+
+
+def sample_loan(term: int = 360) -> sqlmodels.LoanRead:
+    return sqlmodels.LoanRead(id=1, amount=Decimal("250000.00"), annual_interest_rate=Decimal("4.50"),
+                              loan_term_in_months=term)
+
+
+def seed_users(engine, count: int):
+    with engine.begin() as connection:
+        for start in range(0, count, 50_000):
+            connection.execute(insert(sqlmodels.User.__table__),
+                               [{"name": "user", "email": "user" + str(i) + "@example.com"}
+                                for i in range(start, min(count, start + 50_000))])
+
+
+@group("schedule")
+def schedule_cases(context: BenchmarkContext) -> Iterator[Case]:
+    for term in context.terms:
+        loan = sample_loan(term)
+        amount, rate = float(loan.amount), loan.annual_interest_rate
+        yield "schedule/float-rows/" + str(term), lambda: crud.fetch_loan_schedule(loan)
+        yield "schedule/float-columns/" + str(term), lambda: amortization.python_schedule(amount, rate, term)
+        yield "schedule/numpy/" + str(term), lambda: vectorized.numpy_schedule(amount, rate, term)
+        yield "schedule/table/" + str(term), lambda: payment_factors.table_schedule(amount, rate, term)
+        yield "schedule/exact-cents/" + str(term), lambda: amortization.cents_schedule(loan.amount, rate, term)
+        yield "schedule/exact-decimal/" + str(term), lambda: amortization.decimal_schedule(loan.amount, rate, term)
+
+
+@group("summary")
+def summary_cases(context: BenchmarkContext) -> Iterator[Case]:
+    for term in context.terms:
+        loan = sample_loan(term)
+        month = term // 2 or 1
+        yield "summary/closed-form/" + str(term), \
+            lambda: amortization.summary_values(float(loan.amount), loan.annual_interest_rate, term, month)
+        yield "summary/exact-cents/" + str(term), \
+            lambda: amortization.cents_summary(loan.amount, loan.annual_interest_rate, term, month)
+
+
+@group("solve")
+def solve_cases(context: BenchmarkContext) -> Iterator[Case]:
+    # A 10,000-point pricing grid: 100 amounts x 10 terms x 10 budgets.
+    grid = {"amount": [Decimal(100000 + 1000 * i) for i in range(100)],
+            "loan_term_in_months": [120 + 36 * i for i in range(10)],
+            "monthly_payment": [Decimal(500 + 250 * i) for i in range(10)]}
+    yield "solve/rate-grid-10000", \
+        lambda: crud.solve_loans(sqlmodels.LoanSolveRequest(solve_for="annual_interest_rate", **grid))
+    grid = {"annual_interest_rate": [Decimal(i) / 4 for i in range(100)], **grid}
+    del grid["amount"]
+    yield "solve/amount-grid-10000", lambda: crud.solve_loans(sqlmodels.LoanSolveRequest(solve_for="amount", **grid))
+
+
+@group("users")
+def user_cases(context: BenchmarkContext) -> Iterator[Case]:
+    for count in context.user_counts:
+        name = "users_" + str(count)
+        seed_users(context.engine(name), count)
+        db = context.session(name)
+        emails = ["user" + str(i) + "@example.com" for i in (0, count // 2, count - 1)]
+        yield "users/get-by-email/" + str(count), lambda: [crud.get_user_by_email(db, email) for email in emails]
+
+
+@group("loans")
+def loan_cases(context: BenchmarkContext) -> Iterator[Case]:
+    db = context.session("loans")
+    user = crud.create_user(db, sqlmodels.UserCreate(name="user", email="owner@example.com"))
+    loan = sqlmodels.LoanCreate(amount=Decimal("250000.00"), annual_interest_rate=Decimal("4.50"),
+                                loan_term_in_months=360, primary_user_id=user.id)
+    rows = [loan.dict() for _ in range(100)]
+    yield "loans/create-one", lambda: crud.create_loan(db, loan, user)
+    yield "loans/create-bulk-100", lambda: crud.create_loans(db, rows)
+
+
+@group("writes")
+def write_cases(context: BenchmarkContext) -> Iterator[Case]:
+    emails = itertools.count()
+    total = WRITE_CLIENTS * WRITES_PER_CLIENT
+
+    def new_user():
+        return sqlmodels.UserCreate(name="user", email="writer" + str(next(emails)) + "@example.com")
+
+    def parallel_clients(write: Callable[[], object]):
+        with ThreadPoolExecutor(WRITE_CLIENTS) as pool:
+            list(pool.map(lambda _: [write() for _ in range(WRITES_PER_CLIENT)], range(WRITE_CLIENTS)))
+
+    def commit_each(session_factory):
+        def write():
+            with session_factory() as db:
+                crud.create_user(db, new_user())
+        return lambda: parallel_clients(write)
+
+    default_sessions = make_session_factory(context.engine("writes_default", tuned=False))
+    tuned_sessions = make_session_factory(context.engine("writes_tuned"))
+    writer = group_commit.GroupCommitWriter(make_session_factory(context.engine("writes_group")))
+    try:
+        yield "writes/default-pragmas/commit-each/" + str(total), commit_each(default_sessions)
+        yield "writes/tuned/commit-each/" + str(total), commit_each(tuned_sessions)
+        yield "writes/tuned/group-commit/" + str(total), \
+            lambda: parallel_clients(lambda: writer.submit(crud.write_user, new_user()).result())
+    finally:
+        writer.stop()
+
+
+@group("api")
+def api_cases(context: BenchmarkContext) -> Iterator[Case]:
+    from fastapi.testclient import TestClient
+
+    from main import app, get_db
+
+    session_factory = make_session_factory(context.engine("api"))
+
+    def get_db_override():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = get_db_override
+    client = TestClient(app)
+    user = client.post("/users/", json={"name": "user", "email": "api@example.com"}).json()
+    loan = client.post("/loans/", json={"amount": 250000, "annual_interest_rate": 4.5, "loan_term_in_months": 360,
+                                        "primary_user_id": user['id']}).json()
+    schedule_url = "/loans/schedule/" + str(loan['id'])
+    try:
+        yield "api/get-user", lambda: client.get("/users/api@example.com")
+        yield "api/get-loan", lambda: client.get("/loans/" + str(loan['id']))
+        yield "api/schedule-json", lambda: client.get(schedule_url)
+        yield "api/schedule-columns", \
+            lambda: client.get(schedule_url, headers={"accept": "application/vnd.loan-schedule.columns"})
+        yield "api/summary", lambda: client.get(schedule_url + "/summary/180")
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+
+
+FIRST_RESPONSE = """
+from fastapi.testclient import TestClient
+import main
+with TestClient(main.app) as client:
+    client.get("/loans/schedule/{loan_id}").raise_for_status()
+"""
+
+
+@group("startup")
+def startup_cases(context: BenchmarkContext) -> Iterator[Case]:
+    # Each case is a fresh interpreter, so these time a cold start up to the first
+    # schedule served, against an already migrated database.
+    db = context.session("startup")
+    user = crud.create_user(db, sqlmodels.UserCreate(name="user", email="startup@example.com"))
+    loan = crud.create_loan(db, sqlmodels.LoanCreate(amount=Decimal("250000.00"), annual_interest_rate=Decimal("4.50"),
+                                                     loan_term_in_months=360, primary_user_id=user.id), user)
+    db.close()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    environment = dict(os.environ, LOAN_APP_DATABASE_URL=str(context.engine("startup").url))
+
+    def cold_start(code: str, **overrides):
+        env = dict(environment, **{"LOAN_APP_" + name.upper(): value for name, value in overrides.items()})
+        return lambda: subprocess.run([sys.executable, "-c", code], cwd=directory, env=env, check=True)
+
+    first_response = FIRST_RESPONSE.format(loan_id=loan.id)
+    yield "startup/import-main", cold_start("import main")
+    yield "startup/first-response/schema-full", cold_start(first_response, schema_check="full")
+    yield "startup/first-response/schema-version", cold_start(first_response, schema_check="version")
+    yield "startup/first-response/warm-up", cold_start(first_response, warmup="true")
+
+
+def run(patterns: List[str], context: BenchmarkContext, repeat: int) -> Dict[str, float]:
+    results = {}
+    for name, cases in GROUPS.items():
+        if not any(fnmatch.fnmatch(name, pattern.split("/")[0]) for pattern in patterns):
+            continue
+        for case_name, function in cases(context):
+            if any(fnmatch.fnmatch(case_name, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                results[case_name] = best_of(function, repeat=repeat)
+                print("{:<40}{:>14}".format(case_name, format_seconds(results[case_name])), file=sys.stderr)
+    return results
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds >= 1e-3:
+        return "{:.2f} ms".format(seconds * 1e3)
+    return "{:.1f} us".format(seconds * 1e6)
+
+
+def load_baseline(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path: str, results: Dict[str, float]):
+    with open(path, "w") as f:
+        json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, f,
+                  indent=2, sort_keys=True)
+
+
+def compare(results: Dict[str, float], baseline: dict, threshold: float) -> List[str]:
+    regressions = []
+    print("{:<40}{:>14}{:>14}{:>10}".format("benchmark", "current", "baseline", "change"))
+    for name, seconds in results.items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            print("{:<40}{:>14}{:>14}{:>10}".format(name, format_seconds(seconds), "-", "new"))
+            continue
+        change = seconds / previous - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<40}{:>14}{:>14}{:>+9.0%}{}".format(name, format_seconds(seconds), format_seconds(previous),
+                                                     change, flag))
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the amortization engines and API hot paths.")
+    parser.add_argument("patterns", nargs="*", default=["*"],
+                        help="glob patterns over group or benchmark names, e.g. schedule or 'api/*'")
+    parser.add_argument("--full", action="store_true", help="include the 1M-user email lookup")
+    parser.add_argument("--terms", type=int, nargs="+", default=list(TERMS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown reported as a regression (default 0.20)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        context = BenchmarkContext(directory, FULL_USER_COUNTS if args.full else USER_COUNTS, tuple(args.terms))
+        try:
+            results = run(args.patterns, context, args.repeat)
+        finally:
+            context.dispose()
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print("saved baseline to " + args.baseline)
+        return 0
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print("no baseline at " + args.baseline + "; run with --save-baseline on this machine to store one")
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+from typing import Literal, Optional
+
+from pydantic import BaseSettings, Field
+
+
+class Settings(BaseSettings):
+    database_url: str = Field("sqlite:///./loan_amortization_app.db",
+                              env=["LOAN_APP_DATABASE_URL", "SQLALCHEMY_DATABASE_URL"])
+    database_mode: Literal["sync", "async"] = "sync"
+    async_database_url: Optional[str] = None
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_recycle: int = -1
+    db_pool_pre_ping: bool = False
+    sqlite_tuning: bool = True
+    sqlite_journal_mode: Literal["wal", "delete", "truncate", "persist", "memory", "off"] = "wal"
+    sqlite_synchronous: Literal["off", "normal", "full", "extra"] = "normal"
+    sqlite_cache_size: int = -64000
+    sqlite_mmap_size: int = 268435456
+    sqlite_busy_timeout_ms: int = 5000
+    group_commit: bool = False
+    group_commit_max_batch: int = 64
+    group_commit_max_delay_ms: float = 0
+    relationship_loading: Literal["selectin", "joined"] = "selectin"
+    batch_max_loans: int = 10000
+    batch_chunk_size: int = 500
+    schedule_cache_size: int = 1024
+    schedule_cache_max_months: int = 1_000_000
+    amortization_mode: Literal["float", "exact"] = "float"
+    exact_rounding: Literal["half_up", "half_even"] = "half_up"
+    schedule_engine: Literal["python", "numpy", "table"] = "python"
+    factor_table_path: str = "payment_factors.npy"
+    factor_table_max_term: int = 480
+    summary_replay: Literal["auto", "always", "never"] = "auto"
+    scenario_max_count: int = 100
+    http_cache_max_age: int = 300
+    schedule_storage: Literal["compute", "eager", "lazy"] = "compute"
+    job_workers: Optional[int] = None
+    job_shard_size: int = 10000
+    job_max_loans: int = 1_000_000
+    job_dir: Optional[str] = None
+    job_start_method: Literal["spawn", "forkserver", "fork"] = "spawn"
+    schema_check: Literal["full", "version"] = "version"
+    warmup: bool = False
+    warmup_schedules: int = 100
+    metrics_enabled: bool = True
+    slow_request_ms: float = 0
+    profile_interval_ms: float = 5
+    profile_dir: str = "profiles"
+
+    class Config:
+        env_prefix = "LOAN_APP_"
+        env_file = ".env"
+
+
+settings = Settings()
@@ -1,13 +1,46 @@
-from typing import List
+import itertools
+import math
+from decimal import Decimal
+from typing import List, Optional, Tuple
 
-from sqlmodel import select
+from pydantic import ValidationError
+from sqlalchemy import event, inspect, or_, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+from sqlmodel import func, select
 from sqlmodel.orm.session import Session
 
+import amortization
+import instrumentation
+import schedule_store
 import sqlmodels
+from config import settings
+from schedule_cache import schedule_cache, schedule_key
 
 User = sqlmodels.User
 Loan = sqlmodels.Loan
 
+LOAN_TERMS = ("amount", "annual_interest_rate", "loan_term_in_months")
+AMORTIZATION_MODES = ("float", "exact")
+SCHEDULE_FIELDS = ("month", "remaining_balance", "monthly_payment", "principal", "interest")
+DEFAULT_SCHEDULE_FIELDS = ("month", "remaining_balance", "monthly_payment")
+
+
+class ScheduleQueryError(ValueError):
+    pass
+
+
+@event.listens_for(Loan, "before_update")
+def invalidate_edited_loan_schedule(mapper, connection, target: Loan):
+    state = inspect(target)
+    histories = [state.attrs[name].history for name in LOAN_TERMS]
+    if any(history.has_changes() for history in histories):
+        old_terms = [history.deleted[0] if history.deleted else getattr(target, name)
+                     for name, history in zip(LOAN_TERMS, histories)]
+        for mode in AMORTIZATION_MODES:
+            schedule_cache.invalidate(schedule_key(*old_terms, mode=mode))
+        schedule_store.delete_schedules(connection, target.id)
+
 
 def get_user(db: Session, user_id: int):
     return db.get(sqlmodels.User, user_id)
@@ -17,43 +50,144 @@ def get_user_by_email(db: Session, email: str):
     return db.exec(select(User).where(User.email == email)).first()
 
 
-def get_users(db: Session, limit: int = 100):
-    return db.exec(select(User).limit(limit)).all()
+def relationship_loader(attribute):
+    if settings.relationship_loading == "joined":
+        return joinedload(attribute)
+    return selectinload(attribute)
+
+
+def get_user_with_loans(db: Session, email: str):
+    statement = select(User).where(User.email == email).options(relationship_loader(User.loans))
+    return db.exec(statement).unique().first()
+
+
+def get_users(db: Session, limit: int = 100, after_id: Optional[int] = None):
+    statement = select(User).order_by(User.id).limit(limit)
+    if after_id is not None:
+        statement = statement.where(User.id > after_id)
+    return db.exec(statement).all()
+
+
+def stream_users(db: Session, after_id: Optional[int] = None, batch_size: int = 1000):
+    # Plain rows rather than User entities, so the identity map does not grow with the export.
+    statement = select(User.id, User.name, User.email).order_by(User.id)
+    if after_id is not None:
+        statement = statement.where(User.id > after_id)
+    result = db.execute(statement.execution_options(stream_results=True))
+    for partition in result.partitions(batch_size):
+        yield from partition
 
 
 def create_user(db: Session, user: sqlmodels.UserCreate):
     db_user = User.from_orm(user)
     db.add(db_user)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise
     db.refresh(db_user)
     return db_user
 
 
-def create_loan(db: Session, loan: sqlmodels.LoanCreate):
+def write_user(db: Session, user: sqlmodels.UserCreate):
+    db_user = User.from_orm(user)
+    db.add(db_user)
+    db.flush()
+    return sqlmodels.UserRead.from_orm(db_user)
+
+
+def add_loan(db: Session, loan: sqlmodels.LoanCreate, primary_user: User):
+    # The link row rides on the relationship, so the loan and its owner's
+    # UserLoanRelationship are written by one flush and one commit.
     db_loan = Loan.from_orm(loan)
+    db_loan.shared_users.append(primary_user)
     db.add(db_loan)
+    if settings.schedule_storage == "eager" and db_loan.loan_term_in_months >= 1:
+        db.flush()
+        store_loan_schedule(db, db_loan, fetch_loan_schedule_columns(db_loan))
+    return db_loan
+
+
+def create_loan(db: Session, loan: sqlmodels.LoanCreate, primary_user: User):
+    db_loan = add_loan(db, loan, primary_user)
     db.commit()
     db.refresh(db_loan)
-    user_loan_relationship = sqlmodels.UserLoanRelationship(loan_id=db_loan.id, user_id=db_loan.primary_user_id)
-    db.add(user_loan_relationship)
-    db.commit()
-    db.refresh(user_loan_relationship)
     return db_loan
 
 
+def write_loan(db: Session, loan: sqlmodels.LoanCreate):
+    db_loan = add_loan(db, loan, get_user(db, loan.primary_user_id))
+    db.flush()
+    return sqlmodels.LoanRead.from_orm(db_loan)
+
+
+def create_loans(db: Session, rows: List[dict]):
+    loans, errors = [], []
+    for index, row in enumerate(rows):
+        try:
+            loans.append((index, sqlmodels.LoanCreate.parse_obj(row)))
+        except ValidationError as e:
+            errors.append(sqlmodels.LoanBulkError(row=index, detail=e.errors()))
+
+    user_ids = {loan.primary_user_id for _, loan in loans if loan.primary_user_id is not None}
+    users = {user.id: user for user in db.exec(select(User).where(User.id.in_(user_ids))).all()} if user_ids else {}
+
+    db_loans = []
+    for index, loan in loans:
+        if loan.primary_user_id not in users:
+            errors.append(sqlmodels.LoanBulkError(row=index, detail="User not found"))
+            continue
+        db_loan = Loan.from_orm(loan)
+        db_loan.shared_users.append(users[loan.primary_user_id])
+        db_loans.append(db_loan)
+
+    db.add_all(db_loans)
+    db.flush()
+    if settings.schedule_storage == "eager":
+        # Loans without a month to schedule have nothing to store.
+        stored_loans = [db_loan for db_loan in db_loans if db_loan.loan_term_in_months >= 1]
+        for db_loan, columns in zip(stored_loans, fetch_loan_schedules(stored_loans)):
+            store_loan_schedule(db, db_loan, columns)
+    created = [sqlmodels.LoanRead.from_orm(db_loan) for db_loan in db_loans]
+    db.commit()
+    return sqlmodels.LoanBulkResult(created=created, errors=sorted(errors, key=lambda error: error.row))
+
+
 def get_loan(db: Session, loan_id: int):
     return db.get(sqlmodels.Loan, loan_id)
 
 
-def fetch_loan_schedule(loan: sqlmodels.LoanRead):
-    loan_amount = float(loan.amount)
-    monthly_interest_rate = float((loan.annual_interest_rate/100) / 12)
-    term = float(loan.loan_term_in_months)
+def get_loan_with_users(db: Session, loan_id: int):
+    statement = select(Loan).where(Loan.id == loan_id).options(relationship_loader(Loan.shared_users))
+    return db.exec(statement).unique().first()
+
+
+def get_loans(db: Session, loan_ids: List[int]):
+    loans = []
+    for chunk in chunked(loan_ids):
+        loans.extend(db.exec(select(Loan).where(Loan.id.in_(chunk))).all())
+    return loans
+
+
+def chunked(ids: List[int]):
+    unique_ids = sorted(set(ids))
+    for start in range(0, len(unique_ids), settings.batch_chunk_size):
+        yield unique_ids[start:start + settings.batch_chunk_size]
 
-    numerator = (monthly_interest_rate * ((float(1) + monthly_interest_rate) ** term))
-    denominator = (((float(1) + monthly_interest_rate) ** term) - float(1))
 
-    monthly_payment = loan_amount * (numerator/denominator)
+def get_loan_terms(db: Session, loan_ids: List[int]):
+    terms = {}
+    for chunk in chunked(loan_ids):
+        statement = select(Loan.id, Loan.amount, Loan.annual_interest_rate, Loan.loan_term_in_months)
+        terms.update((row.id, row) for row in db.execute(statement.where(Loan.id.in_(chunk))))
+    return terms
+
+
+def fetch_loan_schedule(loan: sqlmodels.LoanRead):
+    loan_amount = float(loan.amount)
+    monthly_interest_rate = amortization.monthly_interest_rate(loan.annual_interest_rate)
+    monthly_payment = amortization.monthly_payment(loan_amount, monthly_interest_rate, loan.loan_term_in_months)
 
     schedule = []
     remaining = loan_amount
@@ -67,17 +201,272 @@ def fetch_loan_schedule(loan: sqlmodels.LoanRead):
     return schedule
 
 
-def fetch_loan_summary(month: int, loan_schedule: List[sqlmodels.LoanSchedule], loan: sqlmodels.LoanRead):
-    month_info = loan_schedule[month - 1]
-    loan_amount = loan.amount
-    principal_paid = loan_amount - month_info.remaining_balance
-    interest_paid = (month_info.monthly_payment * month) - principal_paid
-    return sqlmodels.LoanSummary(month = month, principal_balance = month_info.remaining_balance,
+def loan_schedule_key(loan: sqlmodels.LoanBase):
+    return schedule_key(loan.amount, loan.annual_interest_rate, loan.loan_term_in_months,
+                        mode=settings.amortization_mode)
+
+
+def fetch_loan_schedule_columns(loan: sqlmodels.LoanRead):
+    return schedule_cache.get_or_compute(loan_schedule_key(loan), lambda: compute_loan_schedule_columns(loan))
+
+
+def schedule_engine_name():
+    return "exact" if settings.amortization_mode == "exact" else settings.schedule_engine
+
+
+def compute_loan_schedule_columns(loan: sqlmodels.LoanBase, start: int = 1, stop: Optional[int] = None):
+    with instrumentation.schedule_seconds.time(schedule_engine_name()):
+        if settings.amortization_mode == "exact":
+            columns = amortization.cents_schedule(loan.amount, loan.annual_interest_rate, loan.loan_term_in_months,
+                                                  rounding=settings.exact_rounding, stop=stop)
+            return columns if start == 1 else columns.window(start, len(columns.month))
+        # The NumPy-backed modules are imported on first use rather than with the app.
+        if settings.schedule_engine == "table":
+            import payment_factors
+
+            return payment_factors.table_schedule(float(loan.amount), loan.annual_interest_rate,
+                                                  loan.loan_term_in_months, start=start, stop=stop)
+        if settings.schedule_engine == "numpy":
+            import vectorized
+
+            return vectorized.numpy_schedule(float(loan.amount), loan.annual_interest_rate,
+                                             loan.loan_term_in_months, start=start, stop=stop)
+        return amortization.python_schedule(float(loan.amount), loan.annual_interest_rate, loan.loan_term_in_months,
+                                            start=start, stop=stop)
+
+
+def warm_up(db: Session, schedules: int) -> int:
+    # Pays the first request's costs ahead of time: NumPy and the batch engine, the factor
+    # table, and the cached schedules of the most common loan terms.
+    import payment_factors
+    import vectorized
+
+    list(vectorized.numpy_schedules([1.0], [0], [1]))
+    if settings.amortization_mode == "float" and settings.schedule_engine == "table":
+        payment_factors.factor_table()
+    if schedules <= 0:
+        return 0
+    terms = db.exec(select(sqlmodels.Loan.amount, sqlmodels.Loan.annual_interest_rate,
+                           sqlmodels.Loan.loan_term_in_months)
+                    .where(sqlmodels.Loan.loan_term_in_months >= 1)
+                    .group_by(sqlmodels.Loan.amount, sqlmodels.Loan.annual_interest_rate,
+                              sqlmodels.Loan.loan_term_in_months)
+                    .order_by(func.count().desc()).limit(schedules)).all()
+    for amount, annual_interest_rate, loan_term_in_months in terms:
+        fetch_loan_schedule_columns(sqlmodels.LoanBase(amount=amount, annual_interest_rate=annual_interest_rate,
+                                                       loan_term_in_months=loan_term_in_months))
+    return len(terms)
+
+
+def stored_schedule_mode():
+    if settings.amortization_mode == "exact":
+        return "exact-" + settings.exact_rounding
+    return settings.amortization_mode
+
+
+def store_loan_schedule(db: Session, loan: sqlmodels.LoanRead, columns: amortization.ScheduleColumns):
+    schedule_store.store_schedule(db, loan.id, stored_schedule_mode(), columns)
+
+
+def materialize_loan_schedule(db: Session, loan: sqlmodels.LoanRead):
+    columns = fetch_loan_schedule_columns(loan)
+    try:
+        store_loan_schedule(db, loan, columns)
+        db.commit()
+    except IntegrityError:
+        # Another request stored the same schedule first.
+        db.rollback()
+    return columns
+
+
+def backfill_loan_schedules(db: Session, batch_size: Optional[int] = None):
+    batch_size = batch_size or settings.batch_chunk_size
+    Row = sqlmodels.LoanScheduleRow
+    stored = select(Row.loan_id).where(Row.loan_id == Loan.id, Row.mode == stored_schedule_mode())
+    count, after_id = 0, 0
+    while True:
+        loans = db.exec(select(Loan).where(Loan.id > after_id, Loan.loan_term_in_months >= 1, ~stored.exists())
+                        .order_by(Loan.id).limit(batch_size)).all()
+        if not loans:
+            return count
+        for loan, columns in zip(loans, fetch_loan_schedules(loans)):
+            store_loan_schedule(db, loan, columns)
+        db.commit()
+        count += len(loans)
+        after_id = loans[-1].id
+
+
+def fetch_loan_schedule_window(loan: sqlmodels.LoanRead, from_month: int = 1, to_month: Optional[int] = None,
+                               db: Optional[Session] = None):
+    term = loan.loan_term_in_months
+    to_month = term if to_month is None else to_month
+    if from_month < 1 or to_month > term or from_month > to_month:
+        raise ScheduleQueryError("Month out of range")
+    if db is not None and settings.schedule_storage != "compute":
+        columns = schedule_store.load_window(db, loan.id, stored_schedule_mode(), from_month, to_month)
+        if columns is None:
+            columns = materialize_loan_schedule(db, loan).window(from_month, to_month)
+        return columns
+    if from_month == 1 and to_month == term:
+        return fetch_loan_schedule_columns(loan)
+    columns = schedule_cache.get(loan_schedule_key(loan))
+    if columns is not None:
+        return columns.window(from_month, to_month)
+    return compute_loan_schedule_columns(loan, start=from_month, stop=to_month)
+
+
+def parse_schedule_fields(fields: Optional[str]):
+    if fields is None:
+        return DEFAULT_SCHEDULE_FIELDS
+    names = tuple(name.strip() for name in fields.split(",") if name.strip())
+    unknown = [name for name in names if name not in SCHEDULE_FIELDS]
+    if unknown or not names:
+        raise ScheduleQueryError("Unknown schedule field: " + ", ".join(unknown))
+    return names
+
+
+def fetch_loan_schedules(loans: List[sqlmodels.LoanBase]):
+    if settings.amortization_mode == "exact":
+        yield from (compute_loan_schedule_columns(loan) for loan in loans)
+        return
+    import vectorized
+
+    for start in range(0, len(loans), settings.batch_chunk_size):
+        chunk = loans[start:start + settings.batch_chunk_size]
+        with instrumentation.schedule_seconds.time("numpy"):
+            schedules = list(vectorized.numpy_schedules([float(loan.amount) for loan in chunk],
+                                                        [loan.annual_interest_rate for loan in chunk],
+                                                        [loan.loan_term_in_months for loan in chunk]))
+        yield from schedules
+
+
+def fetch_loan_scenarios(loan: sqlmodels.LoanRead, request: sqlmodels.ScenarioRequest):
+    if loan.loan_term_in_months < 1:
+        raise ScheduleQueryError("Loan term must be at least one month")
+    import scenarios
+
+    fields = parse_schedule_fields(request.fields) if request.include_schedule else None
+    base = fetch_loan_schedule_columns(loan)
+    try:
+        outcomes = scenarios.run_scenarios(loan.amount, loan.annual_interest_rate, loan.loan_term_in_months,
+                                           [scenario.events for scenario in request.scenarios], base,
+                                           mode=settings.amortization_mode, rounding=settings.exact_rounding)
+    except scenarios.ScenarioError as e:
+        raise ScheduleQueryError(str(e))
+    amount_cents = amortization.to_cents(loan.amount)
+    base_paid_cents = sum(round(payment * 100) for payment in amortization.as_list(base.monthly_payment))
+    return [sqlmodels.ScenarioResult(name=scenario.name, payoff_month=outcome.payoff_month,
+                                     total_paid=Decimal(outcome.total_paid_cents) / 100,
+                                     total_interest=Decimal(outcome.total_paid_cents - amount_cents) / 100,
+                                     interest_saved=Decimal(base_paid_cents - outcome.total_paid_cents) / 100,
+                                     schedule=outcome.columns.rows(fields) if fields else None)
+            for scenario, outcome in zip(request.scenarios, outcomes)]
+
+
+def solve_loans(request: sqlmodels.LoanSolveRequest):
+    # Every combination of the given amounts, rates, terms and payments is solved in one pass.
+    inputs = [name for name in LOAN_TERMS + ("monthly_payment",) if name != request.solve_for]
+    if getattr(request, request.solve_for):
+        raise ScheduleQueryError("Leave " + request.solve_for + " empty to solve for it")
+    missing = [name for name in inputs if not getattr(request, name)]
+    if missing:
+        raise ScheduleQueryError("Missing values for: " + ", ".join(missing))
+    if any(value <= 0 for value in request.amount + request.monthly_payment) \
+            or any(value < 0 for value in request.annual_interest_rate) \
+            or any(value < 1 for value in request.loan_term_in_months):
+        raise ScheduleQueryError("Amounts and payments must be positive, rates non-negative and terms at least one")
+    if math.prod(len(getattr(request, name)) for name in inputs) > settings.batch_max_loans:
+        raise ScheduleQueryError("Grid exceeds " + str(settings.batch_max_loans) + " loans")
+    rows = [dict(zip(inputs, values)) for values in itertools.product(*(getattr(request, name) for name in inputs))]
+
+    import solvers
+
+    solved, paid = solvers.solve(request.solve_for,
+                                 [amortization.to_cents(row.get("amount", 0)) for row in rows],
+                                 [amortization.monthly_interest_rate(row.get("annual_interest_rate", 0))
+                                  for row in rows],
+                                 [row.get("loan_term_in_months", 1) for row in rows],
+                                 [amortization.to_cents(row["monthly_payment"]) for row in rows])
+    for row, value, payment in zip(rows, solved, paid):
+        if request.solve_for == "amount":
+            row.update(amount=Decimal(value) / 100, monthly_payment=Decimal(int(payment)) / 100)
+        elif request.solve_for == "loan_term_in_months" and value:
+            row.update(loan_term_in_months=value, monthly_payment=Decimal(int(payment)) / 100)
+        elif request.solve_for == "loan_term_in_months":
+            row.update(detail="Payment does not cover the monthly interest")
+        elif math.isnan(value):
+            row.update(detail="Payment does not repay the amount within the term")
+        else:
+            row.update(annual_interest_rate=Decimal(str(round(value * 1200, 6))))
+    return [sqlmodels.LoanSolution(**row) for row in rows]
+
+
+def fetch_stored_loan_summary(db: Session, loan: sqlmodels.LoanRead, month: int):
+    row = schedule_store.load_month(db, loan.id, stored_schedule_mode(), month)
+    if row is None:
+        materialize_loan_schedule(db, loan)
+        row = schedule_store.load_month(db, loan.id, stored_schedule_mode(), month)
+    principal_balance = amortization.as_decimal(row.remaining_balance)
+    principal_paid = loan.amount - principal_balance
+    if settings.amortization_mode == "exact":
+        interest_paid = amortization.as_decimal(row.interest_paid)
+    else:
+        interest_paid = (amortization.as_decimal(row.monthly_payment) * month) - principal_paid
+    return sqlmodels.LoanSummary(month=month, principal_balance=principal_balance,
+                                 principal_balance_paid=principal_paid, interest_paid=interest_paid)
+
+
+def fetch_loan_summary(loan: sqlmodels.LoanRead, month: int, db: Optional[Session] = None):
+    if db is not None and settings.schedule_storage != "compute":
+        return fetch_stored_loan_summary(db, loan, month)
+    if settings.amortization_mode == "exact":
+        summary = amortization.cents_summary(loan.amount, loan.annual_interest_rate, loan.loan_term_in_months,
+                                             month, rounding=settings.exact_rounding)
+        return sqlmodels.LoanSummary(month=month, principal_balance=Decimal(summary.remaining_balance) / 100,
+                                     principal_balance_paid=Decimal(summary.principal_paid) / 100,
+                                     interest_paid=Decimal(summary.interest_paid) / 100)
+    columns = schedule_cache.get(loan_schedule_key(loan))
+    if columns is not None:
+        values = amortization.SummaryValues(month=month, monthly_payment=float(columns.monthly_payment[month - 1]),
+                                            remaining_balance=float(columns.remaining_balance[month - 1]))
+    else:
+        values = amortization.summary_values(float(loan.amount), loan.annual_interest_rate,
+                                             loan.loan_term_in_months, month, replay=settings.summary_replay)
+    principal_balance = amortization.as_decimal(values.remaining_balance)
+    monthly_payment = amortization.as_decimal(values.monthly_payment)
+    principal_paid = loan.amount - principal_balance
+    interest_paid = (monthly_payment * month) - principal_paid
+    return sqlmodels.LoanSummary(month = month, principal_balance = principal_balance,
                                  principal_balance_paid = principal_paid, interest_paid = interest_paid)
 
 
-def get_relationship(db: Session, limit: int = 100):
-    return db.exec(select(sqlmodels.UserLoanRelationship).limit(limit)).all()
+def get_user_portfolio_loans(db: Session, user_id: int):
+    Link = sqlmodels.UserLoanRelationship
+    shared = select(Link.loan_id).where(Link.user_id == user_id)
+    statement = select(Loan).where(or_(Loan.primary_user_id == user_id, Loan.id.in_(shared))).order_by(Loan.id)
+    return db.exec(statement).all()
+
+
+def fetch_user_portfolio(db: Session, user: User):
+    import vectorized
+
+    loans = [loan for loan in get_user_portfolio_loans(db, user.id) if loan.loan_term_in_months >= 1]
+    balance, principal_paid, interest_paid = vectorized.aggregate_schedules(
+        [amortization.to_cents(loan.amount) for loan in loans], list(fetch_loan_schedules(loans)))
+    months = [sqlmodels.PortfolioMonth(month=month, principal_balance=Decimal(int(balance_cents)) / 100,
+                                       principal_balance_paid=Decimal(int(paid_cents)) / 100,
+                                       interest_paid=Decimal(int(interest_cents)) / 100)
+              for month, (balance_cents, paid_cents, interest_cents)
+              in enumerate(zip(balance, principal_paid, interest_paid), start=1)]
+    return sqlmodels.Portfolio(loan_ids=[loan.id for loan in loans], months=months)
+
+
+def get_relationship(db: Session, limit: int = 100, after: Optional[Tuple[int, int]] = None):
+    Link = sqlmodels.UserLoanRelationship
+    statement = select(Link).order_by(Link.loan_id, Link.user_id).limit(limit)
+    if after is not None:
+        statement = statement.where(tuple_(Link.loan_id, Link.user_id) > tuple_(*after))
+    return db.exec(statement).all()
 
 
 def create_relationship(db: Session, user_id: int, loan_id: int):
@@ -86,3 +475,40 @@ def create_relationship(db: Session, user_id: int, loan_id: int):
     db.commit()
     db.refresh(db_user)
     return db_user
+
+
+def get_loan_owners(db: Session, loan_ids: List[int]):
+    owners = {}
+    for chunk in chunked(loan_ids):
+        owners.update(db.execute(select(Loan.id, Loan.primary_user_id).where(Loan.id.in_(chunk))).all())
+    return owners
+
+
+def get_existing_user_ids(db: Session, user_ids: List[int]):
+    existing = set()
+    for chunk in chunked(user_ids):
+        existing.update(db.execute(select(User.id).where(User.id.in_(chunk))).scalars())
+    return existing
+
+
+def share_loans(db: Session, loan_ids: List[int], user_ids: List[int]):
+    # One transaction for every (loan, user) pair; pairs that are already shared are reported, not re-added.
+    Link = sqlmodels.UserLoanRelationship
+    pairs = list(dict.fromkeys(itertools.product(loan_ids, user_ids)))
+    existing = set()
+    for loan_chunk, user_chunk in itertools.product(chunked(loan_ids), list(chunked(user_ids))):
+        statement = select(Link.loan_id, Link.user_id).where(Link.loan_id.in_(loan_chunk), Link.user_id.in_(user_chunk))
+        existing.update(tuple(row) for row in db.execute(statement))
+    created = [pair for pair in pairs if pair not in existing]
+    if created:
+        db.execute(Link.__table__.insert(), [{"loan_id": loan_id, "user_id": user_id} for loan_id, user_id in created])
+    db.commit()
+    return sqlmodels.LoanShareResult(created=[Link(loan_id=loan_id, user_id=user_id) for loan_id, user_id in created],
+                                     existing=[Link(loan_id=loan_id, user_id=user_id) for loan_id, user_id in pairs
+                                               if (loan_id, user_id) in existing])
+
+
+def write_relationship(db: Session, user_id: int, loan_id: int):
+    db.add(sqlmodels.UserLoanRelationship(user_id=user_id, loan_id=loan_id))
+    db.flush()
+    return sqlmodels.UserLoanRelationship(user_id=user_id, loan_id=loan_id)
@@ -1,7 +1,64 @@
+from typing import List
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
 from sqlmodel import Session, create_engine
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./loan_amortization_app.db"
+from config import settings
+
+SQLALCHEMY_DATABASE_URL = settings.database_url
+
+
+def engine_options(database_url: str) -> dict:
+    url = make_url(database_url)
+    pool_options = {"pool_size": settings.db_pool_size, "max_overflow": settings.db_max_overflow,
+                    "pool_timeout": settings.db_pool_timeout, "pool_recycle": settings.db_pool_recycle,
+                    "pool_pre_ping": settings.db_pool_pre_ping}
+    if url.get_backend_name() != "sqlite":
+        return pool_options
+    if url.database in (None, "", ":memory:"):
+        return {"connect_args": {"check_same_thread": False}, "poolclass": StaticPool}
+    return {"connect_args": {"check_same_thread": False}, "poolclass": QueuePool, **pool_options}
+
+
+def sqlite_pragmas(database_url: str) -> List[str]:
+    url = make_url(database_url)
+    if url.get_backend_name() != "sqlite" or not settings.sqlite_tuning:
+        return []
+    pragmas = ["PRAGMA busy_timeout = " + str(int(settings.sqlite_busy_timeout_ms)),
+               "PRAGMA synchronous = " + settings.sqlite_synchronous,
+               "PRAGMA cache_size = " + str(int(settings.sqlite_cache_size))]
+    if url.database not in (None, "", ":memory:"):
+        # journal_mode is persistent and WAL has no effect on an in-memory database.
+        pragmas = ["PRAGMA journal_mode = " + settings.sqlite_journal_mode,
+                   "PRAGMA mmap_size = " + str(int(settings.sqlite_mmap_size))] + pragmas
+    return pragmas
+
+
+def apply_sqlite_pragmas(engine, pragmas: List[str]):
+    if not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def create_database_engine(database_url: str):
+    engine = create_engine(database_url, **engine_options(database_url))
+    apply_sqlite_pragmas(engine, sqlite_pragmas(database_url))
+    return engine
+
+
+def make_session_factory(bind) -> sessionmaker:
+    return sessionmaker(bind=bind, class_=Session)
+
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread" : False})
+engine = create_database_engine(SQLALCHEMY_DATABASE_URL)
 
-SessionLocal = Session(engine)
+SessionLocal = make_session_factory(engine)
@@ -0,0 +1,103 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy.orm import sessionmaker
+
+Work = Tuple[Future, Callable, tuple]
+
+
+class GroupCommitWriter:
+    def __init__(self, session_factory: sessionmaker, max_batch: int = 64, max_delay: float = 0):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self.writes = 0
+        self.replays = 0
+        self._queue: "queue.Queue[Optional[Work]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def submit(self, work: Callable, *args) -> Future:
+        # work(session, *args) must only add and flush; the writer commits, and its result
+        # should be detached from the session (e.g. a Read model) as the session is closed.
+        future = Future()
+        self._queue.put((future, work, args))
+        if self._thread is None:
+            self.start()
+        return future
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "writes": self.writes, "replays": self.replays}
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch, stopping = self._collect(item)
+            self._write(batch)
+            if stopping:
+                return
+
+    def _collect(self, item: Work) -> Tuple[List[Work], bool]:
+        # Whatever queued up during the previous commit goes into this one; max_delay
+        # optionally holds the batch open for stragglers.
+        batch = [item]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _write(self, batch: List[Work]):
+        batch = [work for work in batch if work[0].set_running_or_notify_cancel()]
+        if batch:
+            self._write_running(batch)
+
+    def _write_running(self, batch: List[Work]):
+        try:
+            results = self._commit(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][0].set_exception(e)
+                return
+            # One bad write must not fail its neighbours, so the batch is replayed one
+            # transaction per write and only the failing ones see their error.
+            self.replays += 1
+            for work in batch:
+                self._write_running([work])
+            return
+        for (future, _, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def _commit(self, batch: List[Work]) -> list:
+        with self.session_factory() as session:
+            results = [work(session, *args) for _, work, args in batch]
+            session.commit()
+        self.batches += 1
+        self.writes += len(batch)
+        return results
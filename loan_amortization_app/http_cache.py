@@ -0,0 +1,64 @@
+import hashlib
+from typing import Optional
+
+from fastapi import Response
+
+import amortization
+import sqlmodels
+from config import settings
+
+
+def entity_tag(*parts) -> str:
+    return '"' + hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest() + '"'
+
+
+def loan_terms(loan: sqlmodels.LoanBase) -> tuple:
+    # Cents and basis points, so 250000 and 250000.00 give the same tag.
+    return (amortization.to_cents(loan.amount), amortization.rate_basis_points(loan.annual_interest_rate),
+            loan.loan_term_in_months)
+
+
+def schedule_settings() -> tuple:
+    return settings.amortization_mode, settings.exact_rounding, settings.schedule_engine
+
+
+def loan_etag(loan: sqlmodels.Loan) -> str:
+    shared_users = sorted((user.id, user.name, user.email) for user in loan.shared_users)
+    return entity_tag("loan", loan.id, loan_terms(loan), loan.primary_user_id, shared_users)
+
+
+def schedule_etag(loan: sqlmodels.LoanBase, media_type: str, fields: tuple, from_month: int,
+                  to_month: Optional[int]) -> str:
+    return entity_tag("schedule", loan_terms(loan), schedule_settings(), media_type, fields, from_month, to_month)
+
+
+def summary_etag(loan: sqlmodels.LoanBase, month: int) -> str:
+    return entity_tag("summary", loan_terms(loan), schedule_settings(), month)
+
+
+def cache_control(public: bool = True) -> str:
+    if settings.http_cache_max_age <= 0:
+        return "no-cache"
+    return ("public" if public else "private") + ", max-age=" + str(settings.http_cache_max_age)
+
+
+def matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # If-None-Match uses weak comparison, so W/"..." matches our strong tag.
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def cache_headers(etag: str, public: bool = True, vary: Optional[str] = None) -> dict:
+    headers = {"ETag": etag, "Cache-Control": cache_control(public)}
+    if vary is not None:
+        headers["Vary"] = vary
+    return headers
+
+
+def not_modified(if_none_match: Optional[str], etag: str, public: bool = True,
+                 vary: Optional[str] = None) -> Optional[Response]:
+    if matches(if_none_match, etag):
+        return Response(status_code=304, headers=cache_headers(etag, public, vary))
+    return None
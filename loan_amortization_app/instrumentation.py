@@ -0,0 +1,278 @@
+import bisect
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryLog:
+    def __init__(self):
+        self.statements: List[str] = []
+        self._lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.statements.append(statement)
+
+
+@contextmanager
+def count_queries(bind=Engine) -> Iterator[QueryLog]:
+    log = QueryLog()
+    event.listen(bind, "before_cursor_execute", log.record)
+    try:
+        yield log
+    finally:
+        event.remove(bind, "before_cursor_execute", log.record)
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name + format_labels(self.labelnames, labels) + " " + repr(float(value))
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            counts = self._values.setdefault(labels, [0] * (len(self.buckets) + 2))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def count(self, *labels: str) -> int:
+        counts = self._values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    @contextmanager
+    def time(self, *labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield (self.name + "_bucket" + format_labels(self.labelnames, labels, 'le="' + le + '"') + " "
+                       + str(cumulative))
+            yield self.name + "_sum" + format_labels(self.labelnames, labels) + " " + repr(float(counts[-1]))
+            yield self.name + "_count" + format_labels(self.labelnames, labels) + " " + str(cumulative)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List = []
+        self.collectors: List[Callable[[], Iterator[str]]] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP " + metric.name + " " + metric.help)
+            lines.append("# TYPE " + metric.name + " " + metric.kind)
+            lines.extend(metric.samples())
+        for collect in self.collectors:
+            lines.extend(collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+request_seconds = registry.register(Histogram("loan_app_http_request_duration_seconds",
+                                              "Time spent serving a request, including a streamed body.",
+                                              ("method", "route", "status")))
+sql_queries = registry.register(Counter("loan_app_sql_queries_total", "SQL statements executed.", ("route",)))
+sql_seconds = registry.register(Histogram("loan_app_sql_query_duration_seconds",
+                                          "Time spent executing one SQL statement.", ("route",)))
+schedule_seconds = registry.register(Histogram("loan_app_schedule_compute_seconds",
+                                               "Time spent computing amortization schedules.", ("engine",)))
+slow_requests = registry.register(Counter("loan_app_slow_requests_total",
+                                          "Requests slower than the profiling threshold.", ("route",)))
+
+
+class RequestStats:
+    def __init__(self, scope: Optional[dict] = None):
+        self.scope = scope if scope is not None else {}
+        self.queries = 0
+        self.sql_seconds = 0.0
+
+    @property
+    def route(self) -> str:
+        # The router records the matched route on the scope, before any handler runs a query.
+        return getattr(self.scope.get("route"), "path", None) or "unmatched"
+
+
+# Holds a mutable RequestStats, so handlers running in the threadpool with a copy of the
+# request's context still update the same object.
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = current_request.get()
+    route = stats.route if stats is not None else ""
+    if stats is not None:
+        stats.queries += 1
+        stats.sql_seconds += elapsed
+    sql_queries.inc(route)
+    sql_seconds.observe(elapsed, route)
+
+
+def install_sql_hooks(bind=Engine):
+    if not event.contains(bind, "after_cursor_execute", _after_cursor_execute):
+        event.listen(bind, "before_cursor_execute", _before_cursor_execute)
+        event.listen(bind, "after_cursor_execute", _after_cursor_execute)
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self) -> Dict[str, int]:
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code.co_filename.rsplit(os.sep, 1)[-1] + ":" + frame.f_code.co_name)
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write(stack + " " + str(count) + "\n")
+
+
+class MetricsMiddleware:
+    def __init__(self, app, slow_request_seconds: float = 0, profile_interval: float = 0.005,
+                 profile_dir: str = "profiles"):
+        self.app = app
+        self.slow_request_seconds = slow_request_seconds
+        self.profile_interval = profile_interval
+        self.profile_dir = profile_dir
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        stats = RequestStats(scope)
+        token = current_request.set(stats)
+        profiler = SamplingProfiler(self.profile_interval).start() if self.slow_request_seconds > 0 else None
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_request.reset(token)
+            route = stats.route
+            request_seconds.observe(elapsed, scope["method"], route, str(status[0]))
+            if profiler is not None:
+                profiler.stop()
+                if elapsed >= self.slow_request_seconds:
+                    slow_requests.inc(route)
+                    self.dump_profile(profiler, scope["method"], route)
+
+    def dump_profile(self, profiler: SamplingProfiler, method: str, route: str):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = "{}-{}-{}.collapsed".format(time.strftime("%Y%m%dT%H%M%S"), method,
+                                           re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root")
+        profiler.dump(os.path.join(self.profile_dir, name))
+
+
+def stats_collector(prefix: str, stats: Callable[[], dict], counters: Sequence[str] = ()):
+    def collect() -> Iterator[str]:
+        values = stats()
+        for key, value in values.items():
+            kind = "counter" if key in counters else "gauge"
+            name = prefix + "_" + key + ("_total" if kind == "counter" else "")
+            yield "# TYPE " + name + " " + kind
+            yield name + " " + repr(float(value))
+        if "hits" in values and "misses" in values:
+            lookups = values["hits"] + values["misses"]
+            yield "# TYPE " + prefix + "_hit_ratio gauge"
+            yield prefix + "_hit_ratio " + repr(values["hits"] / lookups if lookups else 0.0)
+    return collect
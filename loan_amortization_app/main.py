@@ -1,34 +1,62 @@
 if __package__ is None:
     __package__ = "loan_amortization_app"
 
-from typing import List
-
-import uvicorn
-from fastapi import Depends, FastAPI, HTTPException
+import startup
+
+# Started ahead of the other imports so the report's first phase covers them.
+startup_report = startup.StartupReport()
+
+import csv
+import io
+import json
+from decimal import Decimal
+from typing import List, Literal, Optional
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
 from sqlmodel.orm.session import Session
 
 import crud
+import group_commit
+import http_cache
+import instrumentation
+import migrations
+import schedule_formats
 import sqlmodels
+from config import settings
 from database import SessionLocal, engine
+from pagination import after_id_from_cursor, encode_cursor
+from schedule_cache import schedule_cache
 
 description = """
 The Loan Amortization App API provides useful endpoints to calculate the amortization of loans. 
 This app is built using the FastAPI and SQLmodel python libraries.
 
 ## Users
-* **Get all Users in the database**
+* **Get all Users in the database**, a page at a time or as an NDJSON export
 * **Create a new user**
 * **Fetch a user using the email**
 * **Fetch all of the loans that a user is associated with**
-* **Allow a user to share a loan with another user**
+* **Aggregate a user's balance, principal and interest paid across all of their loans, month by month**
+* **Allow a user to share a loan with another user**, or many loans with many users in one request
 
 ## Loans
 * **Create a new loan and associate it with a user**
+* **Import many loans at once from a JSON array or CSV file**
 * **Fetch a loan with the loan_id**
-* **Generate an amortization schedule for a specific loan**
+* **Generate an amortization schedule for a specific loan** as JSON, NDJSON, CSV or packed columns
 * **Fetch the loan summary for a specific month**
+* **Solve for the amount, term or rate that fits a target monthly payment**, singly or over a grid
+* **Compare what-if scenarios for a loan**: extra payments, lump sums and rate changes
+* **Generate amortization schedules for a batch of loans**
+* **Run schedule jobs for very large batches across a pool of worker processes**
 """
 
+startup_report.mark("imports")
+
 app = FastAPI(title="Loan Amortization App", description=description)
 
 tags_metadata = [
@@ -44,33 +72,112 @@ tags_metadata = [
 ]
 
 
+if settings.metrics_enabled:
+    instrumentation.install_sql_hooks()
+    instrumentation.registry.register(startup_report)
+    instrumentation.registry.collectors.append(
+        instrumentation.stats_collector("loan_app_schedule_cache", schedule_cache.stats,
+                                        counters=("hits", "misses", "evictions")))
+    app.add_middleware(instrumentation.MetricsMiddleware, slow_request_seconds=settings.slow_request_ms / 1000,
+                       profile_interval=settings.profile_interval_ms / 1000, profile_dir=settings.profile_dir)
+
+
+group_writer = None
+if settings.group_commit:
+    group_writer = group_commit.GroupCommitWriter(SessionLocal, max_batch=settings.group_commit_max_batch,
+                                                  max_delay=settings.group_commit_max_delay_ms / 1000)
+    instrumentation.registry.collectors.append(
+        instrumentation.stats_collector("loan_app_group_commit", group_writer.stats,
+                                        counters=("batches", "writes", "replays")))
+
+
+if settings.database_mode == "async":
+    import async_routes
+
+    # Registered ahead of the sync handlers below so these paths resolve to the async versions;
+    # anything the router does not cover falls through to the sync handler.
+    app.include_router(async_routes.router, include_in_schema=False)
+
+
+# The job manager pulls in NumPy and multiprocessing, so it is created by the first job request.
+schedule_jobs = None
+
+
+def get_schedule_jobs():
+    global schedule_jobs
+    if schedule_jobs is None:
+        import schedule_jobs as jobs_module
+
+        schedule_jobs = jobs_module.schedule_jobs
+    return schedule_jobs
+
+
+startup_report.mark("app")
+
+
 def get_db():
-    db = SessionLocal
+    db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
 
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(instrumentation.registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.on_event("startup")
 def on_startup():
-    sqlmodels.SQLModel.metadata.create_all(engine)
+    with startup_report.phase("schema"):
+        migrations.ensure_schema(engine, settings.schema_check)
+    if group_writer is not None:
+        group_writer.start()
+    if settings.warmup:
+        with startup_report.phase("warm-up"):
+            with SessionLocal() as db:
+                crud.warm_up(db, settings.warmup_schedules)
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    if group_writer is not None:
+        group_writer.stop()
+    if schedule_jobs is not None:
+        schedule_jobs.shutdown()
 
 
 @app.post("/users/", response_model=sqlmodels.UserRead, tags=["Users"])
 def create_user(user: sqlmodels.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
-    if db_user:
+    try:
+        if group_writer is not None:
+            return group_writer.submit(crud.write_user, user).result()
+        return crud.create_user(db=db, user=user)
+    except IntegrityError:
         raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user)
 
 
 @app.get("/users/", response_model=List[sqlmodels.UserRead], tags=["Users"])
-def get_users(limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, limit=limit)
+def get_users(response: Response, limit: int = 100, cursor: Optional[str] = None, db: Session = Depends(get_db)):
+    after_id = after_id_from_cursor(cursor)
+    users = crud.get_users(db, limit=limit, after_id=after_id)
+    if users and len(users) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(users[-1].id)
     return users
 
 
+@app.get("/users:export", tags=["Users"])
+def export_users(cursor: Optional[str] = None, db: Session = Depends(get_db)):
+    after_id = after_id_from_cursor(cursor)
+
+    def lines():
+        for user_id, name, email in crud.stream_users(db, after_id=after_id):
+            yield json.dumps({"name": name, "email": email, "id": user_id}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 @app.get("/users/{user_email}", response_model=sqlmodels.UserRead, tags=["Users"])
 def get_user_by_email(user_email: str, db: Session = Depends(get_db)):
     db_user = crud.get_user_by_email(db, email=user_email)
@@ -81,12 +188,20 @@ def get_user_by_email(user_email: str, db: Session = Depends(get_db)):
 
 @app.get("/users/{user_email}/loans", response_model=sqlmodels.UserReadWithLoans, tags=["Users"])
 def get_user_loans(user_email: str, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user_email)
+    db_user = crud.get_user_with_loans(db, email=user_email)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
 
+@app.get("/users/{user_email}/portfolio", response_model=sqlmodels.Portfolio, tags=["Users"])
+def get_user_portfolio(user_email: str, db: Session = Depends(get_db)):
+    db_user = crud.get_user_by_email(db, email=user_email)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return crud.fetch_user_portfolio(db, db_user)
+
+
 @app.get("/users/{user_email}/loans/share/{loan_id}", response_model=sqlmodels.UserLoanRelationship, tags=["Users"])
 def share_user_loans(user_email: str, loan_id: int, shared_user_id: int, db: Session = Depends(get_db)):
     db_user = crud.get_user_by_email(db, email=user_email)
@@ -100,41 +215,223 @@ def share_user_loans(user_email: str, loan_id: int, shared_user_id: int, db: Ses
     db_share_user = crud.get_user(db, user_id=shared_user_id)
     if db_share_user is None:
         raise HTTPException(status_code=404, detail="User to share loan not found")
+    if group_writer is not None:
+        return group_writer.submit(crud.write_relationship, shared_user_id, loan_id).result()
     return crud.create_relationship(db, shared_user_id, loan_id)
 
 
+@app.post("/users/{user_email}/loans:share", response_model=sqlmodels.LoanShareResult, tags=["Users"])
+def share_user_loans_bulk(user_email: str, request: sqlmodels.LoanShareRequest, db: Session = Depends(get_db)):
+    if len(set(request.loan_ids)) * len(set(request.shared_user_ids)) > settings.batch_max_loans:
+        raise HTTPException(status_code=400, detail="Share exceeds " + str(settings.batch_max_loans) + " pairs")
+    db_user = crud.get_user_by_email(db, email=user_email)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    owners = crud.get_loan_owners(db, request.loan_ids)
+    missing = sorted(set(request.loan_ids) - owners.keys())
+    if missing:
+        raise HTTPException(status_code=404, detail="Loan not found: " + ", ".join(map(str, missing)))
+    if any(owner != db_user.id for owner in owners.values()):
+        raise HTTPException(status_code=400, detail="Only the primary loan holder may share the loan")
+    missing = sorted(set(request.shared_user_ids) - crud.get_existing_user_ids(db, request.shared_user_ids))
+    if missing:
+        raise HTTPException(status_code=404, detail="User to share loan not found: " + ", ".join(map(str, missing)))
+    return crud.share_loans(db, request.loan_ids, request.shared_user_ids)
+
+
 @app.post("/loans/", response_model=sqlmodels.LoanRead, tags=["Loans"])
 def create_loan(loan: sqlmodels.LoanCreate, db: Session = Depends(get_db)):
     db_user = crud.get_user(db, loan.primary_user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return crud.create_loan(db, loan)
+    if group_writer is not None:
+        return group_writer.submit(crud.write_loan, loan).result()
+    return crud.create_loan(db, loan, db_user)
+
+
+@app.post("/loans:bulk", response_model=sqlmodels.LoanBulkResult, tags=["Loans"])
+async def create_loans_bulk(request: Request, db: Session = Depends(get_db)):
+    body = await request.body()
+    if request.headers.get("content-type", "").startswith("text/csv"):
+        try:
+            rows = [{key: value or None for key, value in row.items()}
+                    for row in csv.DictReader(io.StringIO(body.decode("utf-8-sig")))]
+        except (UnicodeDecodeError, csv.Error):
+            raise HTTPException(status_code=422, detail="Expected a JSON array or CSV of loans")
+    else:
+        try:
+            rows = json.loads(body)
+        except ValueError:
+            rows = None
+        if not isinstance(rows, list):
+            raise HTTPException(status_code=422, detail="Expected a JSON array or CSV of loans")
+    if len(rows) > settings.batch_max_loans:
+        raise HTTPException(status_code=400, detail="Batch exceeds " + str(settings.batch_max_loans) + " loans")
+    return await run_in_threadpool(crud.create_loans, db, rows)
+
+
+@app.get("/loans:solve", response_model=sqlmodels.LoanSolution, tags=["Loans"])
+def solve_loan(solve_for: Literal["amount", "annual_interest_rate", "loan_term_in_months"],
+               amount: Optional[Decimal] = None, annual_interest_rate: Optional[Decimal] = None,
+               loan_term_in_months: Optional[int] = None, monthly_payment: Optional[Decimal] = None):
+    values = {"amount": amount, "annual_interest_rate": annual_interest_rate,
+              "loan_term_in_months": loan_term_in_months, "monthly_payment": monthly_payment}
+    try:
+        request = sqlmodels.LoanSolveRequest(solve_for=solve_for, **{name: [value] for name, value in values.items()
+                                                                     if value is not None})
+        return crud.solve_loans(request)[0]
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors())
+    except crud.ScheduleQueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/loans:solve", response_model=List[sqlmodels.LoanSolution], tags=["Loans"])
+def solve_loans(request: sqlmodels.LoanSolveRequest):
+    try:
+        return crud.solve_loans(request)
+    except crud.ScheduleQueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/loans/{loan_id}", response_model=sqlmodels.LoanReadWithUsers, tags=["Loans"])
-def get_loan(loan_id: int, db: Session = Depends(get_db)):
-    db_loan = crud.get_loan(db, loan_id)
+def get_loan(loan_id: int, response: Response, if_none_match: Optional[str] = Header(None),
+             db: Session = Depends(get_db)):
+    db_loan = crud.get_loan_with_users(db, loan_id)
     if db_loan is None:
         raise HTTPException(status_code=404, detail="Loan not found")
+    etag = http_cache.loan_etag(db_loan)
+    cached = http_cache.not_modified(if_none_match, etag, public=False)
+    if cached is not None:
+        return cached
+    response.headers.update(http_cache.cache_headers(etag, public=False))
     return db_loan
 
 
 @app.get("/loans/schedule/{loan_id}", response_model=List[sqlmodels.LoanSchedule], tags=["Loans"])
-def get_loan_schedule(loan_id: int, db: Session = Depends(get_db)):
+def get_loan_schedule(loan_id: int, from_month: int = 1, to_month: Optional[int] = None,
+                      fields: Optional[str] = None, accept: Optional[str] = Header(None),
+                      if_none_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
     db_loan = crud.get_loan(db, loan_id)
     if db_loan is None:
         raise HTTPException(status_code=404, detail="Loan not found")
-    return crud.fetch_loan_schedule(db_loan)
+    try:
+        schedule_fields = crud.parse_schedule_fields(fields)
+        etag = http_cache.schedule_etag(db_loan, schedule_formats.negotiate(accept), schedule_fields,
+                                        from_month, to_month)
+        cached = http_cache.not_modified(if_none_match, etag, vary="Accept")
+        if cached is not None:
+            return cached
+        columns = crud.fetch_loan_schedule_window(db_loan, from_month, to_month, db=db)
+        rendered = schedule_formats.render(columns, schedule_fields, accept)
+    except crud.ScheduleQueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    rendered.headers.update(http_cache.cache_headers(etag, vary="Accept"))
+    return rendered
+
+
+@app.post("/loans/schedule/{loan_id}/scenarios", response_model=List[sqlmodels.ScenarioResult], tags=["Loans"])
+def get_loan_scenarios(loan_id: int, request: sqlmodels.ScenarioRequest, db: Session = Depends(get_db)):
+    if len(request.scenarios) > settings.scenario_max_count:
+        raise HTTPException(status_code=400,
+                            detail="Request exceeds " + str(settings.scenario_max_count) + " scenarios")
+    db_loan = crud.get_loan(db, loan_id)
+    if db_loan is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    try:
+        return crud.fetch_loan_scenarios(db_loan, request)
+    except crud.ScheduleQueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/loans/schedules:batch", tags=["Loans"])
+def get_loan_schedules_batch(batch: sqlmodels.LoanScheduleBatch, db: Session = Depends(get_db)):
+    if len(batch.loan_ids) + len(batch.loans) > settings.batch_max_loans:
+        raise HTTPException(status_code=400, detail="Batch exceeds " + str(settings.batch_max_loans) + " loans")
+    db_loans = {loan.id: loan for loan in crud.get_loans(db, batch.loan_ids)}
+
+    entries, loans = [], []
+    for loan_id in batch.loan_ids:
+        if loan_id not in db_loans:
+            entries.append(({"loan_id": loan_id}, "Loan not found"))
+        elif db_loans[loan_id].loan_term_in_months < 1:
+            entries.append(({"loan_id": loan_id}, "Loan term must be at least one month"))
+        else:
+            entries.append(({"loan_id": loan_id}, None))
+            loans.append(db_loans[loan_id])
+    for index, loan in enumerate(batch.loans):
+        if loan.loan_term_in_months < 1:
+            entries.append(({"index": index}, "Loan term must be at least one month"))
+        else:
+            entries.append(({"index": index}, None))
+            loans.append(loan)
+
+    def lines():
+        schedules = crud.fetch_loan_schedules(loans)
+        for key, detail in entries:
+            if detail is None:
+                yield json.dumps({**key, "schedule": next(schedules).rows()}) + "\n"
+            else:
+                yield json.dumps({**key, "detail": detail}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/loans/schedules:jobs", response_model=sqlmodels.ScheduleJobStatus, status_code=202, tags=["Loans"])
+def submit_schedule_job(request: sqlmodels.ScheduleJobRequest, db: Session = Depends(get_db)):
+    if len(request.loan_ids) > settings.job_max_loans:
+        raise HTTPException(status_code=400, detail="Job exceeds " + str(settings.job_max_loans) + " loans")
+    try:
+        fields = crud.parse_schedule_fields(request.fields)
+    except crud.ScheduleQueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    job = get_schedule_jobs().submit(request.loan_ids, crud.get_loan_terms(db, request.loan_ids), fields)
+    return job.as_status()
+
+
+@app.get("/loans/schedules:jobs/{job_id}", response_model=sqlmodels.ScheduleJobStatus, tags=["Loans"])
+def get_schedule_job(job_id: str):
+    job = get_schedule_jobs().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.as_status()
+
+
+@app.get("/loans/schedules:jobs/{job_id}/result", tags=["Loans"])
+def get_schedule_job_result(job_id: str):
+    job = get_schedule_jobs().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail="Job is " + job.status)
+    return StreamingResponse((json.dumps(line) + "\n" for line in job.result_lines()),
+                             media_type="application/x-ndjson")
+
+
+@app.delete("/loans/schedules:jobs/{job_id}", status_code=204, tags=["Loans"])
+def delete_schedule_job(job_id: str):
+    if not get_schedule_jobs().delete(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return Response(status_code=204)
 
 
 @app.get("/loans/schedule/{loan_id}/summary/{month}", response_model=sqlmodels.LoanSummary, tags=["Loans"])
-def get_loan_summary(loan_id: int, month: int, db: Session = Depends(get_db)):
+def get_loan_summary(loan_id: int, month: int, response: Response, if_none_match: Optional[str] = Header(None),
+                     db: Session = Depends(get_db)):
     db_loan = crud.get_loan(db, loan_id)
     if db_loan is None:
         raise HTTPException(status_code=404, detail="Loan not found")
-    loan_schedule = crud.fetch_loan_schedule(db_loan)
-    return crud.fetch_loan_summary(month, loan_schedule, db_loan)
+    if month < 1 or month > db_loan.loan_term_in_months:
+        raise HTTPException(status_code=400, detail="Month out of range")
+    etag = http_cache.summary_etag(db_loan, month)
+    cached = http_cache.not_modified(if_none_match, etag)
+    if cached is not None:
+        return cached
+    response.headers.update(http_cache.cache_headers(etag))
+    return crud.fetch_loan_summary(db_loan, month, db=db)
 
 
 if __name__ == "__main__":
+    import uvicorn
+
     uvicorn.run(app, host="127.0.0.1", port=8000)
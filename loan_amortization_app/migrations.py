@@ -0,0 +1,67 @@
+from typing import Callable, List, Tuple
+
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import DBAPIError
+from sqlmodel import func, select
+
+import sqlmodels
+
+
+def create_table_indexes(table_name: str) -> Callable[[Connection], None]:
+    def migrate(connection: Connection):
+        for index in sqlmodels.SQLModel.metadata.tables[table_name].indexes:
+            index.create(connection, checkfirst=True)
+    return migrate
+
+
+def create_table(table_name: str) -> Callable[[Connection], None]:
+    def migrate(connection: Connection):
+        sqlmodels.SQLModel.metadata.tables[table_name].create(connection, checkfirst=True)
+    return migrate
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "unique index on user.email", create_table_indexes("user")),
+    (2, "materialized loan schedules", create_table("loanschedulerow")),
+    (3, "index on userloanrelationship (user_id, loan_id)", create_table_indexes("userloanrelationship")),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection: Connection) -> int:
+    return connection.execute(select(func.max(sqlmodels.SchemaVersion.version))).scalar() or 0
+
+
+def upgrade(engine: Engine) -> int:
+    sqlmodels.SQLModel.metadata.create_all(engine)
+    with engine.begin() as connection:
+        version = current_version(connection)
+        for migration_version, _, migrate in MIGRATIONS:
+            if migration_version > version:
+                migrate(connection)
+                connection.execute(sqlmodels.SchemaVersion.__table__.insert().values(version=migration_version))
+                version = migration_version
+    return version
+
+
+def is_current(engine: Engine) -> bool:
+    # One indexed query instead of create_all's reflection of every table; a missing
+    # schemaversion table just means the database needs the full upgrade.
+    try:
+        with engine.connect() as connection:
+            return current_version(connection) >= SCHEMA_VERSION
+    except DBAPIError:
+        return False
+
+
+def ensure_schema(engine: Engine, check: str = "version") -> int:
+    if check == "version" and is_current(engine):
+        return SCHEMA_VERSION
+    return upgrade(engine)
+
+
+if __name__ == "__main__":
+    from database import engine
+
+    print("schema version", upgrade(engine))
@@ -0,0 +1,32 @@
+import base64
+import json
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(*key: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int = 1) -> Tuple[int, ...]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise InvalidCursor(cursor)
+    if not isinstance(key, list) or len(key) != size or not all(type(value) is int for value in key):
+        raise InvalidCursor(cursor)
+    return tuple(key)
+
+
+def after_id_from_cursor(cursor: Optional[str]) -> Optional[int]:
+    if cursor is None:
+        return None
+    try:
+        return decode_cursor(cursor)[0]
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
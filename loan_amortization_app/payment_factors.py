@@ -0,0 +1,108 @@
+import os
+import threading
+from decimal import Decimal
+from typing import Optional
+
+import numpy as np
+
+import amortization
+import vectorized
+from amortization import ScheduleColumns
+from config import settings
+
+# LoanBase caps annual_interest_rate at 4 digits with 2 decimals, so every valid rate is a
+# whole number of basis points below 10000.
+RATE_STEPS = 10000
+
+
+def table_rates() -> np.ndarray:
+    return np.array([amortization.monthly_interest_rate(Decimal(bp) / 100) for bp in range(RATE_STEPS)],
+                    dtype=np.float64)
+
+
+def build_growth(max_term: int) -> np.ndarray:
+    # Python's float ** rather than np.power: the two disagree in the last bit for about a
+    # quarter of the cells, and the payment has to match monthly_payment exactly.
+    exponents = [float(month) for month in range(max_term + 1)]
+    return np.array([[(float(1) + rate) ** exponent for exponent in exponents] for rate in table_rates().tolist()],
+                    dtype=np.float64)
+
+
+class PaymentFactorTable:
+    def __init__(self, growth: np.ndarray):
+        # growth[bp, k] = (1 + r) ** k for the monthly rate r of bp basis points a year. A plain
+        # ndarray view of the memory map skips np.memmap's per-slice bookkeeping.
+        self.growth = np.asarray(growth)
+        self.rates = table_rates()
+        self.max_term = growth.shape[1] - 1
+
+    def rate_index(self, annual_interest_rate, term: int) -> Optional[int]:
+        if term < 1 or term > self.max_term:
+            return None
+        bp = amortization.rate_basis_points(annual_interest_rate)
+        if not 0 <= bp < RATE_STEPS or self.rates[bp] != amortization.monthly_interest_rate(annual_interest_rate):
+            return None
+        return bp
+
+    def monthly_payment(self, amount: float, bp: int, term: int) -> float:
+        # Same operations as amortization.monthly_payment, with (1 + r) ** term looked up.
+        rate = float(self.rates[bp])
+        if rate == 0:
+            return amount / term
+        growth = float(self.growth[bp, term])
+        return amount * ((rate * growth) / (growth - float(1)))
+
+    def balance_ratios(self, bp: int, term: int, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        # Remaining balance after month k as a fraction of the amount, for k in start..stop.
+        stop = term if stop is None else stop
+        if self.rates[bp] == 0:
+            return float(1) - np.arange(start, stop + 1, dtype=np.float64) / term
+        total = self.growth[bp, term]
+        return (total - self.growth[bp, start:stop + 1]) / (total - float(1))
+
+
+def load_or_build(path: str, max_term: int) -> PaymentFactorTable:
+    if os.path.exists(path):
+        growth = np.load(path, mmap_mode="r")
+        if growth.shape == (RATE_STEPS, max_term + 1) and growth.dtype == np.float64:
+            return PaymentFactorTable(growth)
+    growth = build_growth(max_term)
+    partial = path + "." + str(os.getpid()) + ".tmp"
+    with open(partial, "wb") as f:
+        np.save(f, growth)
+    os.replace(partial, path)
+    return PaymentFactorTable(np.load(path, mmap_mode="r"))
+
+
+_table: Optional[PaymentFactorTable] = None
+_table_lock = threading.Lock()
+
+
+def factor_table() -> PaymentFactorTable:
+    global _table
+    if _table is None:
+        with _table_lock:
+            if _table is None:
+                _table = load_or_build(settings.factor_table_path, settings.factor_table_max_term)
+    return _table
+
+
+def table_schedule(amount: float, annual_interest_rate, term: int, start: int = 1,
+                   stop: Optional[int] = None) -> ScheduleColumns:
+    table = factor_table()
+    bp = table.rate_index(annual_interest_rate, term)
+    if bp is None:
+        return vectorized.numpy_schedule(amount, annual_interest_rate, term, start=start, stop=stop)
+    stop = term if stop is None else stop
+    payment = table.monthly_payment(amount, bp, term)
+    # Month start - 1 is included so principal can be taken as the drop in balance.
+    balance = amount * table.balance_ratios(bp, term, start - 1, stop)
+    principal = np.diff(balance) * -1
+    months = np.arange(start, stop + 1)
+    rates = table.rates[bp:bp + 1]
+    remaining_balance = vectorized.round_balances(balance[None, 1:], table.growth[bp:bp + 1, start:stop + 1], months,
+                                                  np.ones((1, len(months)), dtype=bool), np.array([amount]), rates,
+                                                  np.array([payment]))
+    return ScheduleColumns(month=months, monthly_payment=np.full(len(months), round(payment, 2)),
+                           principal=np.round(principal, 2), interest=np.round(payment - principal, 2),
+                           remaining_balance=remaining_balance[0])
@@ -0,0 +1,162 @@
+from decimal import Decimal
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+import amortization
+import sqlmodels
+from amortization import ScheduleColumns
+
+
+class ScenarioError(ValueError):
+    pass
+
+
+class ScenarioOutcome(NamedTuple):
+    columns: ScheduleColumns
+    payoff_month: int
+    total_paid_cents: int
+
+
+def validate_events(events: Sequence[sqlmodels.ScenarioEvent], term: int):
+    for event in events:
+        if event.month < 1 or event.month > term:
+            raise ScenarioError("Event month out of range")
+        if event.type in ("extra_payment", "lump_sum") and (event.amount is None or event.amount < 0):
+            raise ScenarioError(event.type + " event needs a non-negative amount")
+        if event.type == "extra_payment" and event.end_month is not None and event.end_month < event.month:
+            raise ScenarioError("Extra payment ends before it starts")
+        if event.type == "rate_change" and event.annual_interest_rate is None:
+            raise ScenarioError("rate_change event needs an annual_interest_rate")
+
+
+def event_matrices(scenarios: Sequence[Sequence[sqlmodels.ScenarioEvent]], term: int
+                   ) -> Tuple[np.ndarray, Dict[int, List[Tuple[int, Decimal]]], np.ndarray]:
+    # Extra principal per scenario and month in cents; rate resets are sparse, keyed by month.
+    extra = np.zeros((len(scenarios), term + 1), dtype=np.int64)
+    rate_changes: Dict[int, List[Tuple[int, Decimal]]] = {}
+    first_month = np.full(len(scenarios), term + 1, dtype=np.int64)
+    for s, events in enumerate(scenarios):
+        for event in events:
+            first_month[s] = min(first_month[s], event.month)
+            if event.type == "rate_change":
+                rate_changes.setdefault(event.month, []).append((s, event.annual_interest_rate))
+            elif event.type == "lump_sum":
+                extra[s, event.month] += amortization.to_cents(event.amount)
+            else:
+                end = term if event.end_month is None else min(event.end_month, term)
+                extra[s, event.month:end + 1] += amortization.to_cents(event.amount)
+    return extra, rate_changes, first_month
+
+
+def run_scenarios(amount, annual_interest_rate, term: int, scenarios: Sequence[Sequence[sqlmodels.ScenarioEvent]],
+                  base: ScheduleColumns, mode: str = "float", rounding: str = "half_up") -> List[ScenarioOutcome]:
+    # Every scenario follows the base schedule until its first event, so months before the
+    # earliest event are copied from base and only the rest is stepped, one month at a time
+    # for all scenarios at once.
+    for events in scenarios:
+        validate_events(events, term)
+    extra, rate_changes, first_month = event_matrices(scenarios, term)
+    start = int(first_month.min(initial=term + 1))
+    if mode == "exact":
+        tail = _cents_pass(amount, annual_interest_rate, term, start, extra, rate_changes, rounding)
+    else:
+        tail = _float_pass(float(amount), annual_interest_rate, term, start, extra, rate_changes)
+
+    prefix = [amortization.as_list(column)[:start - 1] for column in base]
+    prefix_paid = sum(round(payment * 100) for payment in prefix[1])
+    payments, principals, interests, balances, months = tail
+    outcomes = []
+    for s in range(len(scenarios)):
+        paid = payments[s, :months[s]].tolist()
+        columns = ScheduleColumns(month=list(range(1, start + int(months[s]))), monthly_payment=prefix[1] + paid,
+                                  principal=prefix[2] + principals[s, :months[s]].tolist(),
+                                  interest=prefix[3] + interests[s, :months[s]].tolist(),
+                                  remaining_balance=prefix[4] + balances[s, :months[s]].tolist())
+        outcomes.append(ScenarioOutcome(columns=columns, payoff_month=start - 1 + int(months[s]),
+                                        total_paid_cents=prefix_paid + sum(round(p * 100) for p in paid)))
+    return outcomes
+
+
+def _tail_arrays(scenarios: int, months: int, dtype) -> list:
+    # Payment, principal, interest and balance per scenario and stepped month, plus each
+    # scenario's stepped month count up to its payoff.
+    return [np.zeros((scenarios, max(months, 0)), dtype=dtype) for _ in range(4)] + [
+        np.full(scenarios, max(months, 0), dtype=np.int64)]
+
+
+def _float_pass(amount: float, annual_interest_rate, term: int, start: int, extra: np.ndarray,
+                rate_changes: Dict[int, List[Tuple[int, Decimal]]]):
+    scenarios = extra.shape[0]
+    rate = amortization.monthly_interest_rate(annual_interest_rate)
+    payment = amortization.monthly_payment(amount, rate, term)
+    rates = np.full(scenarios, rate)
+    payments = np.full(scenarios, payment)
+    # Same float operations as the python engine's loop, so untouched months match it exactly.
+    remaining = np.full(scenarios, amortization.replay_balance(amount, rate, payment, start - 1))
+    active = np.ones(scenarios, dtype=bool)
+    extras = extra / 100
+    tail = _tail_arrays(scenarios, term - start + 1, np.float64)
+    for month in range(start, term + 1):
+        for s, annual_rate in rate_changes.get(month, ()):
+            rates[s] = amortization.monthly_interest_rate(annual_rate)
+            payments[s] = amortization.monthly_payment(float(remaining[s]), float(rates[s]), term - month + 1)
+        principal = payments - (remaining * rates)
+        interest = payments - principal
+        paid = payments + extras[:, month]
+        principal = principal + extras[:, month]
+        # A payment that would overshoot by more than half a cent settles the balance instead.
+        overshoot = principal > remaining + 0.005
+        interest = np.where(overshoot, remaining * rates, interest)
+        paid = np.where(overshoot, remaining + interest, paid)
+        principal = np.where(overshoot, remaining, principal)
+        remaining = np.where(overshoot, float(0), remaining - principal)
+        for column, values in zip(tail, (paid, principal, interest, remaining)):
+            column[:, month - start] = values
+        paid_off = active & (remaining < 0.005)
+        tail[4][paid_off] = month - start + 1
+        active &= ~paid_off
+        if not active.any():
+            break
+    # Python's round rather than np.round, which is off by a cent near half cents.
+    for column in tail[:4]:
+        for s, months in enumerate(tail[4].tolist()):
+            column[s, :months] = [round(value, 2) + 0.0 for value in column[s, :months].tolist()]
+    return tail
+
+
+def _cents_pass(amount, annual_interest_rate, term: int, start: int, extra: np.ndarray,
+                rate_changes: Dict[int, List[Tuple[int, Decimal]]], rounding: str):
+    scenarios = extra.shape[0]
+    amount_cents = amortization.to_cents(amount)
+    rate_bp = amortization.rate_basis_points(annual_interest_rate)
+    payment = amortization.cents_payment(amount_cents, rate_bp, term, rounding)
+    balance = amount_cents
+    for _, _, _, balance in amortization.cents_kernel(amount_cents, rate_bp, term, rounding, months=start - 1):
+        pass
+    balances = np.full(scenarios, balance, dtype=np.int64)
+    rates = np.full(scenarios, rate_bp, dtype=np.int64)
+    payments = np.full(scenarios, payment, dtype=np.int64)
+    active = np.ones(scenarios, dtype=bool)
+    half = amortization.RATE_DENOMINATOR // 2
+    tail = _tail_arrays(scenarios, term - start + 1, np.int64)
+    for month in range(start, term + 1):
+        for s, annual_rate in rate_changes.get(month, ()):
+            rates[s] = amortization.rate_basis_points(annual_rate)
+            payments[s] = amortization.cents_payment(int(balances[s]), int(rates[s]), term - month + 1, rounding)
+        # The cents_kernel step, vectorized across scenarios.
+        interest, remainder = np.divmod(balances * rates, amortization.RATE_DENOMINATOR)
+        round_up = (remainder > half) | ((remainder == half) & ((rounding == "half_up") | (interest % 2 == 1)))
+        interest = interest + round_up
+        due = balances + interest
+        regular = payments + extra[:, month]
+        paid = np.where((month == term) | (regular > due), due, regular)
+        balances = due - paid
+        for column, values in zip(tail, (paid, paid - interest, interest, balances)):
+            column[:, month - start] = values
+        paid_off = active & (balances <= 0)
+        tail[4][paid_off] = month - start + 1
+        active &= ~paid_off
+        if not active.any():
+            break
+    return [column / 100 for column in tail[:4]] + tail[4:]
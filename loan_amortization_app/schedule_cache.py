@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+from amortization import ScheduleColumns
+from config import settings
+
+
+class ScheduleCache:
+    def __init__(self, max_entries: int, max_months: int):
+        self.max_entries = max_entries
+        self.max_months = max_months
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, ScheduleColumns]" = OrderedDict()
+        self._months = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[ScheduleColumns]:
+        with self._lock:
+            columns = self._entries.get(key)
+            if columns is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return columns
+
+    def put(self, key: Hashable, columns: ScheduleColumns):
+        months = len(columns.month)
+        if self.max_entries <= 0 or months > self.max_months:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._months -= len(previous.month)
+            self._entries[key] = columns
+            self._months += months
+            while len(self._entries) > self.max_entries or self._months > self.max_months:
+                _, evicted = self._entries.popitem(last=False)
+                self._months -= len(evicted.month)
+                self.evictions += 1
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], ScheduleColumns]) -> ScheduleColumns:
+        columns = self.get(key)
+        if columns is None:
+            columns = compute()
+            self.put(key, columns)
+        return columns
+
+    def invalidate(self, key: Hashable) -> bool:
+        with self._lock:
+            columns = self._entries.pop(key, None)
+            if columns is None:
+                return False
+            self._months -= len(columns.month)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._months = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "months": self._months, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+def schedule_key(amount, annual_interest_rate, loan_term_in_months: int, mode: str = "float") -> tuple:
+    # Decimal('250000') and Decimal('250000.00') compare and hash equal, so identical
+    # products share one entry however their terms were written.
+    return amount, annual_interest_rate, loan_term_in_months, mode
+
+
+schedule_cache = ScheduleCache(max_entries=settings.schedule_cache_size,
+                               max_months=settings.schedule_cache_max_months)
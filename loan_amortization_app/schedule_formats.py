@@ -0,0 +1,110 @@
+import struct
+from typing import Dict, Iterator, Optional, Sequence
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from amortization import ScheduleColumns, as_list
+
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+CSV = "text/csv"
+COLUMNS = "application/vnd.loan-schedule.columns"
+MEDIA_TYPES = (JSON, NDJSON, CSV, COLUMNS)
+
+# Packed columnar layout: magic, row count and field count, then one (name, dtype) entry per
+# field and finally each column as a contiguous little-endian array.
+MAGIC = b"LSC1"
+DTYPES = {"month": "<i4"}
+DEFAULT_DTYPE = "<f8"
+STREAM_CHUNK_ROWS = 500
+
+
+def negotiate(accept: Optional[str]) -> str:
+    if not accept:
+        return JSON
+    candidates = []
+    for position, entry in enumerate(accept.split(",")):
+        media_type, _, params = entry.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        candidates.append((-quality, position, media_type.strip().lower()))
+    for quality, _, media_type in sorted(candidates):
+        if quality == 0:
+            break
+        if media_type in MEDIA_TYPES:
+            return media_type
+        if media_type in ("*/*", "application/*"):
+            return JSON
+        if media_type == "text/*":
+            return CSV
+    raise HTTPException(status_code=406, detail="Supported media types: " + ", ".join(MEDIA_TYPES))
+
+
+def render(columns: ScheduleColumns, fields: Sequence[str], accept: Optional[str]) -> Response:
+    media_type = negotiate(accept)
+    if media_type == NDJSON:
+        return StreamingResponse(_ndjson_lines(columns, fields), media_type=NDJSON)
+    if media_type == CSV:
+        return StreamingResponse(_csv_lines(columns, fields), media_type=CSV)
+    if media_type == COLUMNS:
+        return Response(encode_columns(columns, fields), media_type=COLUMNS)
+    return JSONResponse(columns.rows(fields))
+
+
+def _chunks(columns: ScheduleColumns, fields: Sequence[str]) -> Iterator[list]:
+    data = [as_list(getattr(columns, field)) for field in fields]
+    for start in range(0, len(columns.month), STREAM_CHUNK_ROWS):
+        yield list(zip(*(column[start:start + STREAM_CHUNK_ROWS] for column in data)))
+
+
+def _ndjson_lines(columns: ScheduleColumns, fields: Sequence[str]) -> Iterator[str]:
+    # Every value is an int or a float, so each row can be formatted directly instead of
+    # going through json.dumps.
+    template = "{{" + ",".join('"' + field + '":{}' for field in fields) + "}}\n"
+    for chunk in _chunks(columns, fields):
+        yield "".join(template.format(*(repr(value) for value in row)) for row in chunk)
+
+
+def _csv_lines(columns: ScheduleColumns, fields: Sequence[str]) -> Iterator[str]:
+    yield ",".join(fields) + "\r\n"
+    for chunk in _chunks(columns, fields):
+        yield "".join(",".join(repr(value) for value in row) + "\r\n" for row in chunk)
+
+
+def encode_columns(columns: ScheduleColumns, fields: Sequence[str]) -> bytes:
+    import numpy as np
+
+    parts = [MAGIC, struct.pack("<IH", len(columns.month), len(fields))]
+    for field in fields:
+        name = field.encode()
+        parts.append(struct.pack("<B", len(name)) + name + DTYPES.get(field, DEFAULT_DTYPE)[1:].encode())
+    for field in fields:
+        parts.append(np.asarray(getattr(columns, field), dtype=DTYPES.get(field, DEFAULT_DTYPE)).tobytes())
+    return b"".join(parts)
+
+
+def decode_columns(payload: bytes) -> Dict[str, "np.ndarray"]:
+    import numpy as np
+
+    if payload[:4] != MAGIC:
+        raise ValueError("Not a packed loan schedule")
+    rows, field_count = struct.unpack_from("<IH", payload, 4)
+    offset, layout = 10, []
+    for _ in range(field_count):
+        length = payload[offset]
+        name = payload[offset + 1:offset + 1 + length].decode()
+        dtype = "<" + payload[offset + 1 + length:offset + 3 + length].decode()
+        layout.append((name, np.dtype(dtype)))
+        offset += 3 + length
+    decoded = {}
+    for name, dtype in layout:
+        decoded[name] = np.frombuffer(payload, dtype=dtype, count=rows, offset=offset)
+        offset += rows * dtype.itemsize
+    return decoded
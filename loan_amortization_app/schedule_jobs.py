@@ -0,0 +1,208 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from decimal import Decimal
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+import amortization
+import crud
+import sqlmodels
+from amortization import ScheduleColumns
+from config import settings
+
+
+class LoanTerms(NamedTuple):
+    amount: Decimal
+    annual_interest_rate: Decimal
+    loan_term_in_months: int
+
+
+class ShardSpec(NamedTuple):
+    inputs: str
+    output: str
+    loans: int
+    months: int
+    fields: tuple
+    start: int
+    stop: int
+    amortization_mode: str
+    exact_rounding: str
+
+
+# Per-loan inputs share one block: amount in cents, rate in basis points, term, and the
+# offset of the loan's first month in the output columns.
+INPUT_COLUMNS = (("amount_cents", np.int64), ("rate_bp", np.int64), ("term", np.int64))
+
+
+def input_views(buffer, loans: int) -> Dict[str, np.ndarray]:
+    views = {name: np.ndarray((loans,), dtype=dtype, buffer=buffer, offset=i * loans * 8)
+             for i, (name, dtype) in enumerate(INPUT_COLUMNS)}
+    views["offsets"] = np.ndarray((loans + 1,), dtype=np.int64, buffer=buffer, offset=len(INPUT_COLUMNS) * loans * 8)
+    return views
+
+
+def output_columns(path: str, fields: Sequence[str], months: int, mode: str) -> np.memmap:
+    # np.memmap cannot map an empty file, so a job without columns or months still gets one cell.
+    return np.memmap(path, dtype=np.float64, mode=mode, shape=(max(len(fields), 1), max(months, 1)))
+
+
+def compute_shard(spec: ShardSpec) -> int:
+    # Runs in a worker process: loan terms come from shared memory and every schedule is
+    # written straight into the job's memory-mapped output, so nothing is pickled but the spec.
+    settings.amortization_mode = spec.amortization_mode
+    settings.exact_rounding = spec.exact_rounding
+    inputs = SharedMemory(name=spec.inputs)
+    try:
+        views = input_views(inputs.buf, spec.loans)
+        indices = [i for i in range(spec.start, spec.stop) if views["term"][i] >= 1]
+        loans = [LoanTerms(Decimal(int(views["amount_cents"][i])) / 100, Decimal(int(views["rate_bp"][i])) / 100,
+                           int(views["term"][i])) for i in indices]
+        offsets = views["offsets"].copy()
+        del views
+    finally:
+        inputs.close()
+
+    output = output_columns(spec.output, spec.fields, spec.months, "r+")
+    for i, columns in zip(indices, crud.fetch_loan_schedules(loans)):
+        for row, field in enumerate(spec.fields):
+            output[row, offsets[i]:offsets[i + 1]] = getattr(columns, field)
+    output.flush()
+    return spec.stop - spec.start
+
+
+class ScheduleJob:
+    def __init__(self, loan_ids: List[int], found: List[bool], fields: tuple, directory: str):
+        self.id = uuid.uuid4().hex
+        self.loan_ids = loan_ids
+        self.found = found
+        self.fields = fields
+        self.directory = directory
+        self.status = "queued"
+        self.completed = 0
+        self.error: Optional[str] = None
+        self.terms: Optional[np.ndarray] = None
+        self.offsets: Optional[np.ndarray] = None
+
+    @property
+    def output_path(self) -> str:
+        return os.path.join(self.directory, self.id + ".f8")
+
+    def as_status(self) -> sqlmodels.ScheduleJobStatus:
+        return sqlmodels.ScheduleJobStatus(id=self.id, status=self.status, loans=len(self.loan_ids),
+                                           completed=self.completed, error=self.error)
+
+    def result_lines(self) -> Iterator[dict]:
+        months = int(self.offsets[-1])
+        output = output_columns(self.output_path, self.fields, months, "r")
+        for i, loan_id in enumerate(self.loan_ids):
+            if not self.found[i]:
+                yield {"loan_id": loan_id, "detail": "Loan not found"}
+                continue
+            term = int(self.terms[i])
+            if term < 1:
+                yield {"loan_id": loan_id, "detail": "Loan term must be at least one month"}
+                continue
+            start = int(self.offsets[i])
+            columns = dict(zip(self.fields, output[:, start:start + term]))
+            schedule = ScheduleColumns(month=np.arange(1, term + 1), monthly_payment=columns.get("monthly_payment"),
+                                       principal=columns.get("principal"), interest=columns.get("interest"),
+                                       remaining_balance=columns.get("remaining_balance"))
+            yield {"loan_id": loan_id, "schedule": schedule.rows(("month",) + self.fields)}
+
+
+class ScheduleJobManager:
+    def __init__(self, workers: Optional[int] = None, shard_size: int = 10000, directory: Optional[str] = None,
+                 start_method: str = "spawn"):
+        self.workers = workers or os.cpu_count() or 1
+        self.shard_size = shard_size
+        self.directory = directory
+        self.start_method = start_method
+        self.jobs: Dict[str, ScheduleJob] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._coordinator: Optional[ThreadPoolExecutor] = None
+        self._temporary_directory: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context(self.start_method))
+                # One job at a time gets the whole process pool; later submissions wait their turn.
+                self._coordinator = ThreadPoolExecutor(max_workers=1, thread_name_prefix="schedule-jobs")
+            if self.directory is None:
+                self.directory = self._temporary_directory = tempfile.mkdtemp(prefix="schedule-jobs-")
+
+    def submit(self, loan_ids: List[int], loans: Dict[int, sqlmodels.LoanBase], fields: Sequence[str]) -> ScheduleJob:
+        self.start()
+        job = ScheduleJob(loan_ids, [loan_id in loans for loan_id in loan_ids],
+                          tuple(field for field in fields if field != "month"), self.directory)
+        self.jobs[job.id] = job
+        terms = [(amortization.to_cents(loans[loan_id].amount),
+                  amortization.rate_basis_points(loans[loan_id].annual_interest_rate),
+                  loans[loan_id].loan_term_in_months) if loan_id in loans else (0, 0, 0) for loan_id in loan_ids]
+        self._coordinator.submit(self._run, job, np.array(terms, dtype=np.int64).reshape(-1, 3),
+                                 settings.amortization_mode, settings.exact_rounding)
+        return job
+
+    def get(self, job_id: str) -> Optional[ScheduleJob]:
+        return self.jobs.get(job_id)
+
+    def delete(self, job_id: str) -> bool:
+        job = self.jobs.pop(job_id, None)
+        if job is None:
+            return False
+        if os.path.exists(job.output_path):
+            os.remove(job.output_path)
+        return True
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._coordinator.shutdown(wait=True)
+                self._pool.shutdown()
+                self._pool = self._coordinator = None
+            for job_id in list(self.jobs):
+                self.delete(job_id)
+            if self._temporary_directory is not None:
+                shutil.rmtree(self._temporary_directory, ignore_errors=True)
+                self.directory = self._temporary_directory = None
+
+    def _run(self, job: ScheduleJob, terms: np.ndarray, amortization_mode: str, exact_rounding: str):
+        job.status = "running"
+        loans = len(job.loan_ids)
+        job.terms = np.maximum(terms[:, 2], 0)
+        job.offsets = np.concatenate(([0], np.cumsum(job.terms))).astype(np.int64)
+        months = int(job.offsets[-1])
+        inputs = SharedMemory(create=True, size=max((len(INPUT_COLUMNS) * loans + loans + 1) * 8, 1))
+        try:
+            views = input_views(inputs.buf, loans)
+            for i, (name, _) in enumerate(INPUT_COLUMNS):
+                views[name][:] = terms[:, i]
+            views["offsets"][:] = job.offsets
+            del views
+            output_columns(job.output_path, job.fields, months, "w+").flush()
+
+            shards = [ShardSpec(inputs.name, job.output_path, loans, months, job.fields, start,
+                                min(start + self.shard_size, loans), amortization_mode, exact_rounding)
+                      for start in range(0, loans, self.shard_size)]
+            for future in as_completed([self._pool.submit(compute_shard, shard) for shard in shards]):
+                job.completed += future.result()
+            job.status = "done"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e) or type(e).__name__
+        finally:
+            inputs.close()
+            inputs.unlink()
+
+
+schedule_jobs = ScheduleJobManager(workers=settings.job_workers, shard_size=settings.job_shard_size,
+                                   directory=settings.job_dir, start_method=settings.job_start_method)
@@ -0,0 +1,58 @@
+from itertools import accumulate
+from typing import Optional
+
+from sqlalchemy import delete, insert
+from sqlmodel import select
+from sqlmodel.orm.session import Session
+
+import amortization
+import sqlmodels
+from amortization import ScheduleColumns
+
+Row = sqlmodels.LoanScheduleRow
+
+
+def store_schedule(db: Session, loan_id: int, mode: str, columns: ScheduleColumns):
+    # Interest is accumulated in whole cents so a stored month can answer the exact-mode
+    # summary without summing the rows before it.
+    interest = amortization.as_list(columns.interest)
+    if not interest:
+        # An empty executemany would run a single INSERT ... DEFAULT VALUES.
+        return
+    interest_paid = accumulate(round(value * 100) for value in interest)
+    db.execute(insert(Row.__table__), [
+        {"loan_id": loan_id, "mode": mode, "month": month, "monthly_payment": payment, "principal": principal,
+         "interest": month_interest, "remaining_balance": balance, "interest_paid": paid / 100}
+        for month, payment, principal, month_interest, balance, paid in zip(
+            amortization.as_list(columns.month), amortization.as_list(columns.monthly_payment),
+            amortization.as_list(columns.principal), interest, amortization.as_list(columns.remaining_balance),
+            interest_paid)
+    ])
+
+
+def load_window(db: Session, loan_id: int, mode: str, start: int, stop: int) -> Optional[ScheduleColumns]:
+    statement = (select(Row.month, Row.monthly_payment, Row.principal, Row.interest, Row.remaining_balance)
+                 .where(Row.loan_id == loan_id, Row.mode == mode, Row.month >= start, Row.month <= stop)
+                 .order_by(Row.month))
+    rows = db.execute(statement).all()
+    if not rows:
+        return None
+    return ScheduleColumns(*(list(column) for column in zip(*rows)))
+
+
+def load_month(db: Session, loan_id: int, mode: str, month: int) -> Optional[sqlmodels.LoanScheduleRow]:
+    return db.get(Row, (loan_id, mode, month))
+
+
+def delete_schedules(connection, loan_id: int):
+    connection.execute(delete(Row.__table__).where(Row.loan_id == loan_id))
+
+
+if __name__ == "__main__":
+    import crud
+    import migrations
+    from database import SessionLocal, engine
+
+    migrations.upgrade(engine)
+    with SessionLocal() as db:
+        print("materialized", crud.backfill_loan_schedules(db), "loan schedules")
@@ -0,0 +1,95 @@
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+# Amount and term solutions are checked against the rounded payment, so a loan created
+# from them through POST /loans/ has a monthly payment of at most the target.
+ADJUST_STEPS = 4
+RATE_ITERATIONS = 100
+RATE_TOLERANCE = 1e-9
+
+
+def payments(amount: np.ndarray, rate: np.ndarray, term: np.ndarray) -> np.ndarray:
+    # The annuity payment of amortization.monthly_payment for whole arrays of loans.
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        growth = np.power(float(1) + rate, term)
+        return np.where(rate == 0, amount / term, amount * ((rate * growth) / (growth - float(1))))
+
+
+def payment_cents(amount: np.ndarray, rate: np.ndarray, term: np.ndarray) -> np.ndarray:
+    # The payment as Python's round(payment, 2) would show it, in cents. np.round scales by
+    # 100 first and can land on the other side of a half cent, so those few are redone.
+    payment = payments(amount, rate, term)
+    cents = np.round(payment * 100)
+    with np.errstate(invalid="ignore"):
+        near = np.abs(payment * 100 - np.floor(payment * 100) - 0.5) < 1e-6
+    cents[near] = [round(round(value, 2) * 100) for value in payment[near].tolist()]
+    return cents
+
+
+def solve_amount(rate: np.ndarray, term: np.ndarray, target_cents: np.ndarray) -> np.ndarray:
+    # Largest principal in cents whose rounded payment does not exceed the target, i.e. whose
+    # unrounded payment stays below the target plus half a cent.
+    cents = np.floor((target_cents + 0.5) / payments(np.ones_like(rate), rate, term))
+    for _ in range(ADJUST_STEPS):
+        cents -= payment_cents(cents / 100, rate, term) > target_cents
+    for _ in range(ADJUST_STEPS):
+        cents += payment_cents((cents + 1) / 100, rate, term) <= target_cents
+    return np.maximum(cents, 0).astype(np.int64)
+
+
+def solve_term(amount: np.ndarray, rate: np.ndarray, target_cents: np.ndarray) -> np.ndarray:
+    # Shortest term whose rounded payment does not exceed the target; 0 where the payment
+    # never covers the monthly interest.
+    target = target_cents / 100
+    reachable = (target > amount * rate) & (target_cents > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        exact = np.where(rate == 0, amount / target, -np.log1p(-(rate * amount) / target) / np.log1p(rate))
+    term = np.where(reachable, np.maximum(np.ceil(exact), 1), 1)
+    for _ in range(ADJUST_STEPS):
+        term -= (term > 1) & (payment_cents(amount, rate, term - 1) <= target_cents)
+    for _ in range(ADJUST_STEPS):
+        term += reachable & (payment_cents(amount, rate, term) > target_cents)
+    return np.where(reachable, term, 0).astype(np.int64)
+
+
+def solve_rate(amount: np.ndarray, term: np.ndarray, target: np.ndarray) -> np.ndarray:
+    # Monthly rate whose payment equals the target: Newton's method, falling back to
+    # bisection whenever a step leaves the bracket. NaN where no rate of zero or more fits.
+    valid = (amount > 0) & (target * term >= amount)
+    amount = np.where(valid, amount, 1)
+    target = np.where(valid, target, 1)
+    # At r = target / amount the interest alone takes the whole payment, so the root lies below.
+    low, high = np.zeros_like(amount), target / amount
+    rate = high / 2
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        for _ in range(RATE_ITERATIONS):
+            log_growth = np.log1p(rate)
+            discount = -np.expm1(-term * log_growth)
+            value = amount * rate / discount - target
+            slope = amount * (discount - rate * term * np.exp(-(term + 1) * log_growth)) / discount ** 2
+            low = np.where(value < 0, rate, low)
+            high = np.where(value > 0, rate, high)
+            step = rate - value / slope
+            rate = np.where((step > low) & (step < high), step, (low + high) / 2)
+            if np.all(np.abs(value) < RATE_TOLERANCE * target):
+                break
+    return np.where(valid, rate, np.nan)
+
+
+def solve(solve_for: str, amount_cents: Sequence[int], rates: Sequence[float], terms: Sequence[int],
+          target_cents: Sequence[int]) -> Tuple[List, List[float]]:
+    # The solved value and the resulting payment in cents for every grid point; the inputs
+    # not being solved for are ignored.
+    amount_cents, rate, term, target_cents = (np.asarray(values, dtype=np.float64)
+                                              for values in (amount_cents, rates, terms, target_cents))
+    if solve_for == "amount":
+        solved = solve_amount(rate, term, target_cents)
+        return solved.tolist(), payment_cents(solved / 100, rate, term).tolist()
+    if solve_for == "loan_term_in_months":
+        solved = solve_term(amount_cents / 100, rate, target_cents)
+        return solved.tolist(), payment_cents(amount_cents / 100, rate, np.maximum(solved, 1)).tolist()
+    solved = solve_rate(amount_cents / 100, term, target_cents / 100)
+    # An interest-free fit is exact in cents but only approximate for Newton's method.
+    solved = np.where(target_cents * term == amount_cents, 0, solved)
+    return solved.tolist(), target_cents.tolist()
@@ -1,17 +1,25 @@
-from typing import List, Optional
+from typing import Any, List, Literal, Optional
 
 from pydantic import condecimal
+from sqlalchemy import Index
 from sqlmodel import Field, Relationship, SQLModel
 
 
+class SchemaVersion(SQLModel, table=True):
+    version: int = Field(primary_key=True)
+
+
 class UserLoanRelationship(SQLModel, table=True):
+    # The (loan_id, user_id) primary key serves "users for a loan"; this index serves "loans for a user".
+    __table_args__ = (Index("ix_userloanrelationship_user_id_loan_id", "user_id", "loan_id"),)
+
     loan_id: Optional[int] = Field(default=None, foreign_key="loan.id", primary_key=True)
     user_id: Optional[int] = Field(default=None, foreign_key="user.id", primary_key=True)
 
 
 class UserBase(SQLModel):
     name: str = Field(index=True)
-    email: str
+    email: str = Field(index=True, unique=True)
 
 
 class User(UserBase, table=True):
@@ -39,6 +47,17 @@ class Loan(LoanBase, table=True):
     shared_users: List[User] = Relationship(back_populates="loans", link_model=UserLoanRelationship)
 
 
+class LoanScheduleRow(SQLModel, table=True):
+    loan_id: int = Field(foreign_key="loan.id", primary_key=True)
+    mode: str = Field(primary_key=True)
+    month: int = Field(primary_key=True)
+    monthly_payment: float
+    principal: float
+    interest: float
+    remaining_balance: float
+    interest_paid: float
+
+
 class LoanRead(LoanBase):
     id: int
 
@@ -66,3 +85,97 @@ class LoanSummary(SQLModel):
     principal_balance: condecimal(decimal_places=2)
     principal_balance_paid: condecimal(decimal_places=2)
     interest_paid: condecimal(decimal_places=2)
+
+
+class PortfolioMonth(SQLModel):
+    month: int
+    principal_balance: condecimal(decimal_places=2)
+    principal_balance_paid: condecimal(decimal_places=2)
+    interest_paid: condecimal(decimal_places=2)
+
+
+class Portfolio(SQLModel):
+    loan_ids: List[int] = []
+    months: List[PortfolioMonth] = []
+
+
+class ScenarioEvent(SQLModel):
+    type: Literal["extra_payment", "lump_sum", "rate_change"]
+    month: int
+    amount: Optional[condecimal(decimal_places=2)] = None
+    end_month: Optional[int] = None
+    annual_interest_rate: Optional[condecimal(max_digits=4, decimal_places=2)] = None
+
+
+class Scenario(SQLModel):
+    name: Optional[str] = None
+    events: List[ScenarioEvent] = []
+
+
+class ScenarioRequest(SQLModel):
+    scenarios: List[Scenario] = []
+    fields: Optional[str] = None
+    include_schedule: bool = False
+
+
+class ScenarioResult(SQLModel):
+    name: Optional[str] = None
+    payoff_month: int
+    total_paid: condecimal(decimal_places=2)
+    total_interest: condecimal(decimal_places=2)
+    interest_saved: condecimal(decimal_places=2)
+    schedule: Optional[List[dict]] = None
+
+
+class LoanSolveRequest(SQLModel):
+    solve_for: Literal["amount", "annual_interest_rate", "loan_term_in_months"]
+    amount: List[condecimal(decimal_places=2)] = []
+    annual_interest_rate: List[condecimal(max_digits=4, decimal_places=2)] = []
+    loan_term_in_months: List[int] = []
+    monthly_payment: List[condecimal(decimal_places=2)] = []
+
+
+class LoanSolution(SQLModel):
+    amount: Optional[condecimal(decimal_places=2)] = None
+    annual_interest_rate: Optional[condecimal(decimal_places=6)] = None
+    loan_term_in_months: Optional[int] = None
+    monthly_payment: Optional[condecimal(decimal_places=2)] = None
+    detail: Optional[str] = None
+
+
+class LoanShareRequest(SQLModel):
+    loan_ids: List[int] = []
+    shared_user_ids: List[int] = []
+
+
+class LoanShareResult(SQLModel):
+    created: List[UserLoanRelationship] = []
+    existing: List[UserLoanRelationship] = []
+
+
+class LoanScheduleBatch(SQLModel):
+    loan_ids: List[int] = []
+    loans: List[LoanCreate] = []
+
+
+class ScheduleJobRequest(SQLModel):
+    loan_ids: List[int] = []
+    fields: Optional[str] = None
+
+
+class ScheduleJobStatus(SQLModel):
+    id: str
+    status: str
+    loans: int
+    completed: int
+    error: Optional[str] = None
+
+
+class LoanBulkError(SQLModel):
+    row: int
+    detail: Any
+
+
+class LoanBulkResult(SQLModel):
+    created: List[LoanRead] = []
+    errors: List[LoanBulkError] = []
@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+
+
+class StartupReport:
+    name = "loan_app_startup_seconds"
+    help = "Time spent in each phase of startup."
+    kind = "gauge"
+
+    def __init__(self):
+        self.phases: List[Tuple[str, float]] = []
+        self._last = time.perf_counter()
+
+    def mark(self, phase: str):
+        # Books everything since the previous mark to phase.
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    @contextmanager
+    def phase(self, phase: str) -> Iterator[None]:
+        self._last = time.perf_counter()
+        yield
+        self.mark(phase)
+
+    def total(self) -> float:
+        return sum(seconds for _, seconds in self.phases)
+
+    def samples(self) -> Iterator[str]:
+        for phase, seconds in self.phases:
+            yield self.name + '{phase="' + phase + '"} ' + repr(seconds)
+
+    def format(self) -> str:
+        lines = ["{:<32}{:>10.1f} ms".format(phase, seconds * 1000) for phase, seconds in self.phases]
+        lines.append("{:<32}{:>10.1f} ms".format("total", self.total() * 1000))
+        return "\n".join(lines)
+
+
+def import_times(module: str = "main") -> List[Tuple[str, float]]:
+    # Cumulative import time of everything the module imports directly, from a fresh
+    # interpreter's -X importtime log, which lists each module after the ones it imports.
+    directory = os.path.dirname(os.path.abspath(__file__))
+    log = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], cwd=directory,
+                         capture_output=True, text=True, check=True).stderr
+    children, times = [], []
+    for line in log.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            children.append((name.strip(), int(cumulative) / 1e6))
+        elif depth == 0:
+            if name.strip() == module:
+                times = children
+            children = []
+    return sorted(times, key=lambda entry: entry[1], reverse=True)
+
+
+if __name__ == "__main__":
+    from fastapi.testclient import TestClient
+
+    for name, seconds in import_times()[:15]:
+        print("{:<32}{:>10.1f} ms".format("import " + name, seconds * 1000))
+    print()
+    import main
+
+    with TestClient(main.app):
+        pass
+    print(main.startup_report.format())
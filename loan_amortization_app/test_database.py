@@ -0,0 +1,85 @@
+from test_users import session_fixture, client_fixture, before_test
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import NullPool
+from sqlmodel import Session, create_engine, select
+
+import crud
+import database
+import main
+import migrations
+import sqlmodels
+from group_commit import GroupCommitWriter
+
+
+def test_sqlite_pragmas(mocker):
+    file_pragmas = database.sqlite_pragmas("sqlite:///./loan_amortization_app.db")
+    assert "PRAGMA journal_mode = wal" in file_pragmas
+    assert "PRAGMA synchronous = normal" in file_pragmas
+    memory_pragmas = database.sqlite_pragmas("sqlite://")
+    assert "PRAGMA busy_timeout = 5000" in memory_pragmas
+    assert not any("journal_mode" in pragma or "mmap_size" in pragma for pragma in memory_pragmas)
+    assert database.sqlite_pragmas("postgresql://user@localhost/loans") == []
+
+    mocker.patch.object(database.settings, "sqlite_tuning", False)
+    assert database.sqlite_pragmas("sqlite:///./loan_amortization_app.db") == []
+
+
+def test_create_database_engine_applies_pragmas(tmp_path):
+    engine = database.create_database_engine("sqlite:///" + str(tmp_path / "tuned.db"))
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+    engine.dispose()
+
+
+@pytest.fixture(name="writer_engine")
+def writer_engine_fixture(tmp_path):
+    engine = create_engine("sqlite:///" + str(tmp_path / "writer.db"), poolclass=NullPool)
+    migrations.upgrade(engine)
+    yield engine
+    engine.dispose()
+
+
+def test_group_commit_batches_queued_writes(writer_engine):
+    writer = GroupCommitWriter(database.make_session_factory(writer_engine), max_delay=0.2)
+    futures = [writer.submit(crud.write_user, sqlmodels.UserCreate(name="user", email=str(i) + "@gmail.com"))
+               for i in range(10)]
+    users = [future.result(timeout=5) for future in futures]
+    writer.stop()
+
+    assert [user.email for user in users] == [str(i) + "@gmail.com" for i in range(10)]
+    assert writer.stats() == {"batches": 1, "writes": 10, "replays": 0}
+    with Session(writer_engine) as db:
+        assert len(db.exec(select(sqlmodels.User)).all()) == 10
+
+
+def test_group_commit_isolates_failing_write(writer_engine):
+    writer = GroupCommitWriter(database.make_session_factory(writer_engine), max_delay=0.2)
+    futures = [writer.submit(crud.write_user, sqlmodels.UserCreate(name="user", email=email))
+               for email in ("user1@gmail.com", "user1@gmail.com", "user2@gmail.com")]
+
+    assert futures[0].result(timeout=5).email == "user1@gmail.com"
+    with pytest.raises(IntegrityError):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5).email == "user2@gmail.com"
+    writer.stop()
+    assert writer.stats() == {"batches": 2, "writes": 2, "replays": 1}
+
+
+def test_routes_write_through_group_commit(db: Session, client: TestClient, mocker):
+    writer = GroupCommitWriter(database.make_session_factory(db.get_bind()))
+    mocker.patch.object(main, "group_writer", writer)
+
+    user = client.post("/users/", json={"name": "testUser", "email": "user1@gmail.com"}).json()
+    assert client.post("/users/", json={"name": "testUser", "email": "user1@gmail.com"}).status_code == 400
+    response = client.post("/loans/", json={"amount": 250000, "annual_interest_rate": 4.5,
+                                            "loan_term_in_months": 360, "primary_user_id": user['id']})
+    writer.stop()
+
+    assert response.status_code == 200
+    loan = db.get(sqlmodels.Loan, response.json()['id'])
+    assert [shared.id for shared in loan.shared_users] == [user['id']]
@@ -0,0 +1,137 @@
+from test_users import session_fixture, client_fixture, before_test
+
+import os
+import subprocess
+import sys
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlmodel import Session
+
+import instrumentation
+import sqlmodels
+import startup
+from schedule_cache import schedule_cache
+
+
+def test_metrics_endpoint(db: Session, client: TestClient):
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3)
+    db.add(loan1)
+    db.add(sqlmodels.User(name="testUser", email="user1@gmail.com"))
+    db.commit()
+    db.refresh(loan1)
+    requests = instrumentation.request_seconds.count("GET", "/users/{user_email}", "200")
+    queries = instrumentation.sql_queries.value("/users/{user_email}")
+
+    assert client.get("/users/user1@gmail.com").status_code == 200
+    assert client.get("/users/user2@gmail.com").status_code == 404
+    client.get("/loans/schedule/" + str(loan1.id))
+    client.get("/loans/schedule/" + str(loan1.id))
+
+    assert instrumentation.request_seconds.count("GET", "/users/{user_email}", "200") == requests + 1
+    assert instrumentation.sql_queries.value("/users/{user_email}") == queries + 2
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert "# TYPE loan_app_http_request_duration_seconds histogram" in lines
+    assert any(line.startswith('loan_app_http_request_duration_seconds_count{method="GET",'
+                               'route="/users/{user_email}",status="404"}') for line in lines)
+    assert any(line.startswith('loan_app_schedule_compute_seconds_count{engine="python"}') for line in lines)
+    assert "# TYPE loan_app_startup_seconds gauge" in lines
+    assert any(line.startswith('loan_app_startup_seconds{phase="imports"} ') for line in lines)
+    stats = schedule_cache.stats()
+    assert "loan_app_schedule_cache_hits_total " + repr(float(stats['hits'])) in lines
+    assert "loan_app_schedule_cache_hit_ratio " + repr(stats['hits'] / (stats['hits'] + stats['misses'])) in lines
+
+
+def test_histogram_samples():
+    histogram = instrumentation.Histogram("latency_seconds", "Latency.", ("route",), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, "/a")
+
+    assert list(histogram.samples()) == ['latency_seconds_bucket{route="/a",le="0.1"} 2',
+                                         'latency_seconds_bucket{route="/a",le="1.0"} 3',
+                                         'latency_seconds_bucket{route="/a",le="+Inf"} 4',
+                                         'latency_seconds_sum{route="/a"} 3.65',
+                                         'latency_seconds_count{route="/a"} 4']
+
+
+def test_slow_request_profile(tmp_path):
+    app = FastAPI()
+
+    @app.get("/slow/{item}")
+    def slow_endpoint(item: int):
+        time.sleep(0.05)
+        return {"item": item}
+
+    @app.get("/fast")
+    def fast_endpoint():
+        return {}
+
+    app.add_middleware(instrumentation.MetricsMiddleware, slow_request_seconds=0.02, profile_interval=0.001,
+                       profile_dir=str(tmp_path))
+    client = TestClient(app)
+
+    assert client.get("/fast").status_code == 200
+    assert list(tmp_path.iterdir()) == []
+    assert client.get("/slow/1").json() == {"item": 1}
+    dumps = list(tmp_path.iterdir())
+    assert len(dumps) == 1
+    assert dumps[0].name.endswith("-GET-slow_item.collapsed")
+    assert "slow_endpoint" in dumps[0].read_text()
+
+
+def test_startup_report():
+    report = startup.StartupReport()
+    report.mark("imports")
+    with report.phase("schema"):
+        time.sleep(0.01)
+
+    assert [phase for phase, _ in report.phases] == ["imports", "schema"]
+    assert report.phases[1][1] >= 0.01
+    assert report.total() == sum(seconds for _, seconds in report.phases)
+    samples = list(report.samples())
+    assert samples[1] == 'loan_app_startup_seconds{phase="schema"} ' + repr(report.phases[1][1])
+    assert report.format().splitlines()[-1].startswith("total")
+
+
+def test_main_defers_heavy_imports():
+    code = "import sys, main; print(sorted({'numpy', 'uvicorn', 'schedule_jobs'} & set(sys.modules)))"
+    loaded = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+
+    assert loaded.strip() == "[]"
+
+
+CONCURRENT_FIRST_CALLS = """
+import sys, threading
+from concurrent.futures import ThreadPoolExecutor
+import crud, sqlmodels
+
+assert "numpy" not in sys.modules
+barrier = threading.Barrier(16)
+loan = sqlmodels.LoanBase(amount=250, annual_interest_rate=12.45, loan_term_in_months=3)
+solve = sqlmodels.LoanSolveRequest(solve_for="amount", annual_interest_rate=[5], loan_term_in_months=[360],
+                                   monthly_payment=[1000])
+
+def first_call(index):
+    barrier.wait()
+    if index % 2:
+        return len(crud.solve_loans(solve))
+    return len(next(crud.fetch_loan_schedules([loan])).month)
+
+with ThreadPoolExecutor(16) as pool:
+    print(sorted(set(pool.map(first_call, range(16)))))
+"""
+
+
+def test_concurrent_first_calls_load_numpy_engines():
+    # A fresh interpreter, so every thread races to import the NumPy modules.
+    result = subprocess.run([sys.executable, "-c", CONCURRENT_FIRST_CALLS],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "[1, 3]"
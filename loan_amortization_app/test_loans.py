@@ -1,8 +1,21 @@
 from test_users import session_fixture, client_fixture, before_test
 
+import itertools
+import json
+from decimal import Decimal
+
+import numpy as np
+import pytest
 from fastapi.testclient import TestClient
 from sqlmodel import Session, select
+import amortization
+import crud
+import payment_factors
+import schedule_formats
 import sqlmodels
+import vectorized
+from instrumentation import count_queries
+from schedule_cache import schedule_cache
 
 
 def test_get_loan(db: Session, client: TestClient):
@@ -149,3 +162,830 @@ def test_get_loan_summary(db: Session, client: TestClient):
     assert data['principal_balance_paid'] == 4377.4
     assert data['interest_paid'] == 12089.83
 
+
+
+def test_get_loan_summary_month_out_of_range(db: Session, client: TestClient):
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+
+    for month in (0, 4):
+        response = client.get("/loans/schedule/" + str(loan1.id) + "/summary/" + str(month))
+        assert response.status_code == 400
+        assert response.json()['detail'] == "Month out of range"
+
+
+def test_get_loan_summary_matches_schedule(db: Session, client: TestClient):
+    loan1 = sqlmodels.Loan(amount=250000, annual_interest_rate=4.5, loan_term_in_months=360)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+
+    schedule = client.get("/loans/schedule/" + str(loan1.id)).json()
+    for month in (1, 13, 120, 359, 360):
+        response = client.get("/loans/schedule/" + str(loan1.id) + "/summary/" + str(month))
+        assert response.status_code == 200
+        data = response.json()
+        assert data['principal_balance'] == schedule[month - 1]['remaining_balance']
+        assert data['principal_balance_paid'] == round(250000 - schedule[month - 1]['remaining_balance'], 2)
+
+
+def test_fetch_loan_summary_replay_modes_agree():
+    loans = [sqlmodels.LoanRead(id=1, amount=amount, annual_interest_rate=rate, loan_term_in_months=term)
+             for amount, rate, term in ((250000, 4.5, 360), (250, 12.45, 3), (987654.32, 29.99, 480),
+                                        (1000, 0, 12))]
+    for loan in loans:
+        schedule = crud.fetch_loan_schedule(loan)
+        for month in range(1, loan.loan_term_in_months + 1):
+            expected = schedule[month - 1].remaining_balance
+            for replay in ("auto", "always"):
+                values = amortization.summary_values(float(loan.amount), loan.annual_interest_rate,
+                                                     loan.loan_term_in_months, month, replay=replay)
+                assert amortization.as_decimal(values.remaining_balance) == expected
+
+
+def test_get_loan_schedule_numpy_engine(db: Session, client: TestClient, mocker):
+    mocker.patch.object(crud.settings, "schedule_engine", "numpy")
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+
+    response = client.get("/loans/schedule/" + str(loan1.id))
+    assert response.status_code == 200
+    assert response.json() == [
+        {"month": 1, "remaining_balance": 167.53, "monthly_payment": 85.07},
+        {"month": 2, "remaining_balance": 84.19, "monthly_payment": 85.07},
+        {"month": 3, "remaining_balance": 0, "monthly_payment": 85.07},
+    ]
+
+
+def test_numpy_schedule_matches_loop():
+    for amount, rate, term in ((250000, 4.5, 360), (250, 12.45, 3), (987654.32, 29.99, 480), (1000, 0, 12),
+                               (1234567.89, 7.25, 360), (0.01, 99.99, 12), (50000, 0.01, 60)):
+        loan = sqlmodels.LoanRead(id=1, amount=amount, annual_interest_rate=rate, loan_term_in_months=term)
+        expected = crud.fetch_loan_schedule(loan)
+        for columns in (amortization.python_schedule(float(loan.amount), loan.annual_interest_rate, term),
+                        vectorized.numpy_schedule(float(loan.amount), loan.annual_interest_rate, term)):
+            assert [amortization.as_decimal(b) for b in columns.remaining_balance] == \
+                   [s.remaining_balance for s in expected]
+            assert [amortization.as_decimal(p) for p in columns.monthly_payment] == \
+                   [s.monthly_payment for s in expected]
+
+
+@pytest.mark.parametrize("amount, rate, term", [(250000, "4.5", 360), (987654.32, "29.99", 480),
+                                                (1392842.83, "23.47", 480), (1000, "0", 12), (0.01, "99.99", 12)])
+def test_numpy_schedule_columns_match_loop(amount: float, rate: str, term: int):
+    loop = amortization.python_schedule(amount, Decimal(rate), term)
+    for start in (1, term // 2 + 1):
+        columns = vectorized.numpy_schedule(amount, Decimal(rate), term, start=start)
+        for field in ("principal", "interest", "remaining_balance"):
+            assert getattr(columns, field).tolist() == getattr(loop, field)[start - 1:]
+    batch = next(crud.fetch_loan_schedules([sqlmodels.LoanBase(amount=amount, annual_interest_rate=rate,
+                                                               loan_term_in_months=term)]))
+    assert batch.principal.tolist() == loop.principal
+
+
+@pytest.fixture(name="factor_table")
+def factor_table_fixture(tmp_path, mocker):
+    mocker.patch.object(payment_factors.settings, "factor_table_path", str(tmp_path / "factors.npy"))
+    mocker.patch.object(payment_factors.settings, "factor_table_max_term", 480)
+    mocker.patch.object(payment_factors, "_table", None)
+    return payment_factors.factor_table()
+
+
+def test_table_schedule_matches_loop(factor_table):
+    assert isinstance(factor_table.growth.base, np.memmap)
+    for amount, rate, term in ((250000, 4.5, 360), (250, 12.45, 3), (987654.32, 29.99, 480), (1000, 0, 12),
+                               (1234567.89, 7.25, 360), (0.01, 99.99, 12), (50000, 0.01, 60), (1000, 5, 600)):
+        loan = sqlmodels.LoanRead(id=1, amount=amount, annual_interest_rate=rate, loan_term_in_months=term)
+        expected = crud.fetch_loan_schedule(loan)
+        columns = payment_factors.table_schedule(float(loan.amount), loan.annual_interest_rate, term)
+        assert [amortization.as_decimal(b) for b in columns.remaining_balance] == \
+               [s.remaining_balance for s in expected]
+        assert [amortization.as_decimal(p) for p in columns.monthly_payment] == [s.monthly_payment for s in expected]
+        window = payment_factors.table_schedule(float(loan.amount), loan.annual_interest_rate, term,
+                                                start=term // 2 + 1, stop=term)
+        assert window.remaining_balance.tolist() == columns.remaining_balance[term // 2:].tolist()
+
+    loop = amortization.python_schedule(987654.32, Decimal("29.99"), 480)
+    table = payment_factors.table_schedule(987654.32, Decimal("29.99"), 480)
+    assert np.abs(table.principal - np.array(loop.principal)).max() <= 0.01
+    assert np.abs(table.interest - np.array(loop.interest)).max() <= 0.01
+
+
+def test_factor_table_file(factor_table, tmp_path):
+    path = str(tmp_path / "factors.npy")
+    assert factor_table.rate_index(Decimal("4.50"), 360) == 450
+    assert factor_table.rate_index(Decimal("4.50"), 481) is None
+    assert factor_table.rate_index(Decimal("4.505"), 360) is None
+    assert factor_table.monthly_payment(250000.0, 450, 360) == amortization.monthly_payment(
+        250000.0, amortization.monthly_interest_rate(Decimal("4.50")), 360)
+    assert factor_table.monthly_payment(1000.0, 0, 7) == amortization.monthly_payment(1000.0, 0.0, 7)
+
+    reloaded = payment_factors.load_or_build(path, 480)
+    assert isinstance(reloaded.growth.base, np.memmap)
+    assert np.array_equal(reloaded.growth[450], factor_table.growth[450])
+    rebuilt = payment_factors.load_or_build(path, 12)
+    assert rebuilt.max_term == 12
+    assert rebuilt.growth[450, 12] == factor_table.growth[450, 12]
+
+
+def test_get_loan_schedule_table_engine(db: Session, client: TestClient, mocker, factor_table):
+    mocker.patch.object(crud.settings, "schedule_engine", "table")
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+
+    response = client.get("/loans/schedule/" + str(loan1.id))
+    assert response.json() == [
+        {"month": 1, "remaining_balance": 167.53, "monthly_payment": 85.07},
+        {"month": 2, "remaining_balance": 84.19, "monthly_payment": 85.07},
+        {"month": 3, "remaining_balance": 0, "monthly_payment": 85.07},
+    ]
+
+
+def test_get_loan_schedules_batch(db: Session, client: TestClient):
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3)
+    loan2 = sqlmodels.Loan(amount=250000, annual_interest_rate=4.5, loan_term_in_months=360)
+    db.add(loan1)
+    db.add(loan2)
+    db.commit()
+    db.refresh(loan1)
+    db.refresh(loan2)
+
+    response = client.post(
+        "/loans/schedules:batch",
+        json={"loan_ids": [loan2.id, loan2.id + 100, loan1.id],
+              "loans": [{"amount": 250, "annual_interest_rate": 12.45, "loan_term_in_months": 3},
+                        {"amount": 250, "annual_interest_rate": 12.45, "loan_term_in_months": 0}]},
+    )
+    assert response.status_code == 200
+    assert response.headers['content-type'] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 5
+
+    assert lines[0]['loan_id'] == loan2.id
+    assert len(lines[0]['schedule']) == 360
+    assert lines[0]['schedule'] == client.get("/loans/schedule/" + str(loan2.id)).json()
+    assert lines[1] == {"loan_id": loan2.id + 100, "detail": "Loan not found"}
+    assert lines[2]['loan_id'] == loan1.id
+    assert [row['remaining_balance'] for row in lines[2]['schedule']] == [167.53, 84.19, 0]
+    assert lines[3] == {"index": 0, "schedule": lines[2]['schedule']}
+    assert lines[4] == {"index": 1, "detail": "Loan term must be at least one month"}
+
+
+def test_get_loan_schedules_batch_chunked(db: Session, client: TestClient, mocker):
+    mocker.patch.object(crud.settings, "batch_chunk_size", 2)
+    loans = [sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=term)
+             for term in (3, 0, 2, 1, 3)]
+    db.add_all(loans)
+    db.commit()
+    loan_ids = [loan.id for loan in loans]
+
+    with count_queries() as queries:
+        response = client.post("/loans/schedules:batch", json={"loan_ids": loan_ids})
+    lines = [json.loads(line) for line in response.text.splitlines()]
+
+    assert queries.count == 3
+    assert [line['loan_id'] for line in lines] == loan_ids
+    assert lines[1] == {"loan_id": loan_ids[1], "detail": "Loan term must be at least one month"}
+    assert [len(line.get('schedule', [])) for line in lines] == [3, 0, 2, 1, 3]
+
+
+def test_get_loan_schedules_batch_too_large(client: TestClient, mocker):
+    mocker.patch.object(crud.settings, "batch_max_loans", 2)
+    response = client.post("/loans/schedules:batch", json={"loan_ids": [1, 2, 3]})
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Batch exceeds 2 loans"
+
+
+def test_get_loan_schedule_cached_by_terms(db: Session, client: TestClient):
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3)
+    loan2 = sqlmodels.Loan(amount=250.00, annual_interest_rate=12.45, loan_term_in_months=3)
+    db.add(loan1)
+    db.add(loan2)
+    db.commit()
+    db.refresh(loan1)
+    db.refresh(loan2)
+    stats = schedule_cache.stats()
+
+    first = client.get("/loans/schedule/" + str(loan1.id)).json()
+    second = client.get("/loans/schedule/" + str(loan2.id)).json()
+    summary = client.get("/loans/schedule/" + str(loan2.id) + "/summary/2").json()
+
+    assert first == second
+    assert summary['principal_balance'] == 84.19
+    assert schedule_cache.stats()['misses'] - stats['misses'] == 1
+    assert schedule_cache.stats()['hits'] - stats['hits'] == 2
+
+
+def test_warm_up_primes_common_schedules(db: Session, client: TestClient):
+    common = [sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3) for _ in range(2)]
+    rare = sqlmodels.Loan(amount=1000, annual_interest_rate=5, loan_term_in_months=12)
+    db.add_all(common + [rare, sqlmodels.Loan(amount=1000, annual_interest_rate=5, loan_term_in_months=0)])
+    db.commit()
+    db.refresh(common[0])
+
+    assert crud.warm_up(db, 1) == 1
+    assert schedule_cache.stats()['entries'] == 1
+    stats = schedule_cache.stats()
+    client.get("/loans/schedule/" + str(common[0].id))
+    assert schedule_cache.stats()['hits'] - stats['hits'] == 1
+
+    assert crud.warm_up(db, 10) == 2
+    assert schedule_cache.stats()['entries'] == 2
+    assert crud.warm_up(db, 0) == 0
+
+
+def test_get_loan_schedule_after_terms_edited(db: Session, client: TestClient):
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+    client.get("/loans/schedule/" + str(loan1.id))
+    assert schedule_cache.stats()['entries'] == 1
+
+    loan1.loan_term_in_months = 2
+    db.add(loan1)
+    db.commit()
+
+    assert schedule_cache.stats()['entries'] == 0
+    response = client.get("/loans/schedule/" + str(loan1.id))
+    assert len(response.json()) == 2
+
+
+@pytest.mark.parametrize("loading, max_queries", [("selectin", 2), ("joined", 1)])
+def test_get_loan_query_count(db: Session, client: TestClient, mocker, loading: str, max_queries: int):
+    mocker.patch.object(crud.settings, "relationship_loading", loading)
+    loan1 = sqlmodels.Loan(amount=250000, annual_interest_rate=4.5, loan_term_in_months=360)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+    for i in range(5):
+        user = sqlmodels.User(name="testUser", email="user" + str(i) + "@gmail.com")
+        db.add(user)
+        db.commit()
+        db.refresh(user)
+        db.add(sqlmodels.UserLoanRelationship(loan_id=loan1.id, user_id=user.id))
+    db.commit()
+    loan_id = loan1.id
+    db.expire_all()
+
+    with count_queries() as queries:
+        response = client.get("/loans/" + str(loan_id))
+
+    assert response.status_code == 200
+    assert len(response.json()['shared_users']) == 5
+    assert queries.count <= max_queries
+
+
+def test_create_loan_single_commit(db: Session, client: TestClient, mocker):
+    user1 = sqlmodels.User(name="testUser", email="user1@gmail.com")
+    db.add(user1)
+    db.commit()
+    db.refresh(user1)
+    commit = mocker.spy(db, "commit")
+
+    response = client.post(
+        "/loans/",
+        json={"amount": 250000, "annual_interest_rate": 4.5,
+              "loan_term_in_months": 360, "primary_user_id": user1.id},
+    )
+
+    assert response.status_code == 200
+    assert commit.call_count == 1
+
+
+def test_create_loans_bulk_json(db: Session, client: TestClient):
+    user1 = sqlmodels.User(name="testUser", email="user1@gmail.com")
+    db.add(user1)
+    db.commit()
+    db.refresh(user1)
+
+    with count_queries() as queries:
+        response = client.post(
+            "/loans:bulk",
+            json=[{"amount": 250000, "annual_interest_rate": 4.5, "loan_term_in_months": 360,
+                   "primary_user_id": user1.id},
+                  {"amount": 250000, "annual_interest_rate": 4.532, "loan_term_in_months": 360,
+                   "primary_user_id": user1.id},
+                  {"amount": 250, "annual_interest_rate": 12.45, "loan_term_in_months": 3,
+                   "primary_user_id": user1.id + 1},
+                  {"amount": 250, "annual_interest_rate": 12.45, "loan_term_in_months": 3,
+                   "primary_user_id": user1.id}],
+        )
+
+    assert response.status_code == 200
+    data = response.json()
+    assert [loan['amount'] for loan in data['created']] == [250000, 250]
+    assert [error['row'] for error in data['errors']] == [1, 2]
+    assert data['errors'][0]['detail'][0]['msg'] == "ensure that there are no more than 2 decimal places"
+    assert data['errors'][1]['detail'] == "User not found"
+    assert queries.count <= 5
+
+    links = db.exec(select(sqlmodels.UserLoanRelationship)).all()
+    assert sorted(link.loan_id for link in links) == sorted(loan['id'] for loan in data['created'])
+
+
+def test_create_loans_bulk_csv(db: Session, client: TestClient):
+    user1 = sqlmodels.User(name="testUser", email="user1@gmail.com")
+    db.add(user1)
+    db.commit()
+    db.refresh(user1)
+
+    body = ("amount,annual_interest_rate,loan_term_in_months,primary_user_id\n"
+            "250000,4.5,360," + str(user1.id) + "\n"
+            "250,12.45,3,\n")
+    response = client.post("/loans:bulk", content=body, headers={"content-type": "text/csv"})
+
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data['created']) == 1
+    assert data['created'][0]['primary_user_id'] == user1.id
+    assert data['errors'] == [{"row": 1, "detail": "User not found"}]
+
+
+def test_create_loans_bulk_invalid_body(client: TestClient):
+    response = client.post("/loans:bulk", json={"amount": 250000})
+    assert response.status_code == 422
+    assert response.json()['detail'] == "Expected a JSON array or CSV of loans"
+
+
+@pytest.mark.parametrize("content_type", ["text/csv", "application/json"])
+def test_create_loans_bulk_not_utf8(client: TestClient, content_type: str):
+    body = "amount,annual_interest_rate,loan_term_in_months\n250000,4.5,360\n".encode("utf-16")
+    response = client.post("/loans:bulk", content=body, headers={"content-type": content_type})
+    assert response.status_code == 422
+    assert response.json()['detail'] == "Expected a JSON array or CSV of loans"
+
+
+def test_get_loan_schedule_exact_mode(db: Session, client: TestClient, mocker):
+    mocker.patch.object(crud.settings, "amortization_mode", "exact")
+    loan1 = sqlmodels.Loan(amount=250000, annual_interest_rate=4.5, loan_term_in_months=360)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+
+    data = client.get("/loans/schedule/" + str(loan1.id)).json()
+    assert len(data) == 360
+    assert data[0] == {"month": 1, "remaining_balance": 249670.79, "monthly_payment": 1266.71}
+    assert data[359]['remaining_balance'] == 0
+    assert data[359]['monthly_payment'] != 1266.71
+
+    response = client.get("/loans/schedule/" + str(loan1.id) + "/summary/360")
+    summary = response.json()
+    assert summary['principal_balance'] == 0
+    assert summary['principal_balance_paid'] == 250000
+    assert summary['interest_paid'] == round(sum(row['monthly_payment'] for row in data) - 250000, 2)
+
+
+@pytest.mark.parametrize("rounding", ["half_up", "half_even"])
+def test_cents_schedule_matches_decimal_reference(rounding: str):
+    for amount, rate, term in (("250000", "4.5", 360), ("250", "12.45", 3), ("987654.32", "29.99", 480),
+                               ("1000", "0", 12), ("0.05", "0", 3), ("0.01", "99.99", 12),
+                               ("496109.09", "23.5", 438)):
+        columns = amortization.cents_schedule(Decimal(amount), Decimal(rate), term, rounding)
+        assert columns == amortization.decimal_schedule(Decimal(amount), Decimal(rate), term, rounding)
+        assert columns.remaining_balance[-1] == 0
+        assert round(sum(columns.principal), 2) == float(amount)
+
+
+def test_round_div_conventions():
+    assert amortization.round_div(5, 2, "half_up") == 3
+    assert amortization.round_div(5, 2, "half_even") == 2
+    assert amortization.round_div(7, 2, "half_even") == 4
+    assert amortization.round_div(7, 3, "half_even") == 2
+
+
+def test_get_loan_schedule_window_and_fields(db: Session, client: TestClient):
+    loan1 = sqlmodels.Loan(amount=250000, annual_interest_rate=4.5, loan_term_in_months=360)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+    url = "/loans/schedule/" + str(loan1.id)
+
+    window = client.get(url, params={"from_month": 13, "to_month": 24}).json()
+    balances = client.get(url, params={"from_month": 350, "fields": "month,remaining_balance"}).json()
+    full = client.get(url).json()
+
+    assert window == full[12:24]
+    assert balances == [{"month": row['month'], "remaining_balance": row['remaining_balance']} for row in full[349:]]
+
+    detailed = client.get(url, params={"to_month": 1, "fields": "principal,interest"}).json()
+    assert detailed == [{"principal": 329.21, "interest": 937.5}]
+
+
+@pytest.mark.parametrize("params, detail", [({"from_month": 0}, "Month out of range"),
+                                            ({"to_month": 361}, "Month out of range"),
+                                            ({"from_month": 5, "to_month": 4}, "Month out of range"),
+                                            ({"fields": "month,balance"}, "Unknown schedule field: balance")])
+def test_get_loan_schedule_invalid_window(db: Session, client: TestClient, params: dict, detail: str):
+    loan1 = sqlmodels.Loan(amount=250000, annual_interest_rate=4.5, loan_term_in_months=360)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+
+    response = client.get("/loans/schedule/" + str(loan1.id), params=params)
+    assert response.status_code == 400
+    assert response.json()['detail'] == detail
+
+
+@pytest.mark.parametrize("engine, mode", [("python", "float"), ("numpy", "float"), ("python", "exact")])
+def test_schedule_window_matches_full_schedule(mocker, engine: str, mode: str):
+    mocker.patch.object(crud.settings, "schedule_engine", engine)
+    mocker.patch.object(crud.settings, "amortization_mode", mode)
+    loan = sqlmodels.LoanRead(id=1, amount=987654.32, annual_interest_rate=29.99, loan_term_in_months=480)
+    full = crud.compute_loan_schedule_columns(loan)
+    for start, stop in ((1, 12), (100, 111), (470, 480), (240, 240)):
+        window = crud.compute_loan_schedule_columns(loan, start=start, stop=stop)
+        assert window.rows(crud.SCHEDULE_FIELDS) == full.window(start, stop).rows(crud.SCHEDULE_FIELDS)
+
+
+def test_get_loan_schedule_formats(db: Session, client: TestClient):
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+    url = "/loans/schedule/" + str(loan1.id)
+    expected = client.get(url).json()
+
+    response = client.get(url, headers={"accept": "application/x-ndjson"})
+    assert response.headers['content-type'] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == expected
+
+    response = client.get(url, headers={"accept": "text/csv"})
+    assert response.headers['content-type'].startswith("text/csv")
+    assert response.text.splitlines() == ["month,remaining_balance,monthly_payment", "1,167.53,85.07",
+                                          "2,84.19,85.07", "3,0.0,85.07"]
+
+    response = client.get(url, params={"fields": "month,remaining_balance"},
+                          headers={"accept": "application/json;q=0.5, application/vnd.loan-schedule.columns"})
+    assert response.headers['content-type'] == "application/vnd.loan-schedule.columns"
+    columns = schedule_formats.decode_columns(response.content)
+    assert list(columns) == ["month", "remaining_balance"]
+    assert columns['month'].tolist() == [1, 2, 3]
+    assert columns['remaining_balance'].tolist() == [167.53, 84.19, 0]
+
+
+def test_get_loan_schedule_not_acceptable(db: Session, client: TestClient):
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+
+    response = client.get("/loans/schedule/" + str(loan1.id), headers={"accept": "application/xml"})
+    assert response.status_code == 406
+
+
+def test_negotiate_schedule_format():
+    assert schedule_formats.negotiate(None) == schedule_formats.JSON
+    assert schedule_formats.negotiate("*/*") == schedule_formats.JSON
+    assert schedule_formats.negotiate("text/html, text/*;q=0.8") == schedule_formats.CSV
+    assert schedule_formats.negotiate("application/x-ndjson;q=0.2, text/csv;q=0.9") == schedule_formats.CSV
+
+
+def stored_rows(db: Session, loan_id: int):
+    return db.exec(select(sqlmodels.LoanScheduleRow).where(sqlmodels.LoanScheduleRow.loan_id == loan_id)).all()
+
+
+@pytest.mark.parametrize("mode", ["float", "exact"])
+def test_get_loan_schedule_eager_storage(db: Session, client: TestClient, mocker, mode: str):
+    mocker.patch.object(crud.settings, "amortization_mode", mode)
+    user1 = sqlmodels.User(name="testUser", email="user1@gmail.com")
+    db.add(user1)
+    db.commit()
+    db.refresh(user1)
+    loan_id = client.post("/loans/", json={"amount": 250000, "annual_interest_rate": 4.5, "loan_term_in_months": 360,
+                                           "primary_user_id": user1.id}).json()['id']
+    url = "/loans/schedule/" + str(loan_id)
+    computed = client.get(url, params={"fields": ",".join(crud.SCHEDULE_FIELDS)}).json()
+    summaries = [client.get(url + "/summary/" + str(month)).json() for month in (1, 180, 360)]
+
+    mocker.patch.object(crud.settings, "schedule_storage", "eager")
+    loan_id = client.post("/loans/", json={"amount": 250000, "annual_interest_rate": 4.5, "loan_term_in_months": 360,
+                                           "primary_user_id": user1.id}).json()['id']
+    assert len(stored_rows(db, loan_id)) == 360
+    url = "/loans/schedule/" + str(loan_id)
+    schedule_cache.clear()
+    assert client.get(url, params={"fields": ",".join(crud.SCHEDULE_FIELDS)}).json() == computed
+    assert client.get(url, params={"from_month": 100, "to_month": 102}).json() == \
+        [{key: row[key] for key in crud.DEFAULT_SCHEDULE_FIELDS} for row in computed[99:102]]
+    assert [client.get(url + "/summary/" + str(month)).json() for month in (1, 180, 360)] == summaries
+    assert schedule_cache.stats()['entries'] == 0
+
+
+def test_eager_storage_skips_zero_term_loans(db: Session, client: TestClient, mocker):
+    mocker.patch.object(crud.settings, "schedule_storage", "eager")
+    user1 = sqlmodels.User(name="testUser", email="user1@gmail.com")
+    db.add(user1)
+    db.commit()
+    db.refresh(user1)
+    loan = {"amount": 250, "annual_interest_rate": 12.45, "loan_term_in_months": 0, "primary_user_id": user1.id}
+
+    response = client.post("/loans/", json=loan)
+    assert response.status_code == 200
+    assert stored_rows(db, response.json()['id']) == []
+
+    response = client.post("/loans:bulk", json=[loan, {**loan, "loan_term_in_months": 3}])
+    assert response.status_code == 200
+    created = response.json()['created']
+    assert [len(stored_rows(db, row['id'])) for row in created] == [0, 3]
+
+
+def test_get_loan_schedule_lazy_storage(db: Session, client: TestClient, mocker):
+    mocker.patch.object(crud.settings, "schedule_storage", "lazy")
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+    loan_id = loan1.id
+    assert stored_rows(db, loan_id) == []
+
+    url = "/loans/schedule/" + str(loan_id)
+    assert client.get(url + "/summary/2").json()['principal_balance'] == 84.19
+    assert len(stored_rows(db, loan_id)) == 3
+    with count_queries(db.get_bind()) as queries:
+        response = client.get(url, params={"from_month": 2})
+    assert response.json() == [{"month": 2, "remaining_balance": 84.19, "monthly_payment": 85.07},
+                               {"month": 3, "remaining_balance": 0.0, "monthly_payment": 85.07}]
+    assert not any(statement.lstrip().upper().startswith("INSERT") for statement in queries.statements)
+
+    loan1.loan_term_in_months = 2
+    db.add(loan1)
+    db.commit()
+    assert stored_rows(db, loan_id) == []
+    assert len(client.get(url).json()) == 2
+    assert len(stored_rows(db, loan_id)) == 2
+
+
+def test_backfill_loan_schedules(db: Session, mocker):
+    mocker.patch.object(crud.settings, "amortization_mode", "exact")
+    db.add_all([sqlmodels.Loan(amount=1000 * i, annual_interest_rate=5, loan_term_in_months=12 * i)
+                for i in range(0, 6)])
+    db.commit()
+
+    assert crud.backfill_loan_schedules(db, batch_size=2) == 5
+    assert crud.backfill_loan_schedules(db, batch_size=2) == 0
+    rows = db.exec(select(sqlmodels.LoanScheduleRow)).all()
+    assert len(rows) == 12 * (1 + 2 + 3 + 4 + 5)
+    assert {row.mode for row in rows} == {"exact-half_up"}
+    last = max(rows, key=lambda row: (row.loan_id, row.month))
+    summary = amortization.cents_summary(5000, 5, 60, 60)
+    assert last.remaining_balance == 0
+    assert last.interest_paid == summary.interest_paid / 100
+
+
+def reference_scenario(amount: str, rate: str, term: int, extra: dict, rate_changes: dict, rounding: str = "half_up"):
+    balance, rate_bp = amortization.to_cents(Decimal(amount)), amortization.rate_basis_points(Decimal(rate))
+    payment = amortization.cents_payment(balance, rate_bp, term, rounding)
+    balances = []
+    for month in range(1, term + 1):
+        if month in rate_changes:
+            rate_bp = amortization.rate_basis_points(rate_changes[month])
+            payment = amortization.cents_payment(balance, rate_bp, term - month + 1, rounding)
+        due = balance + amortization.round_div(balance * rate_bp, amortization.RATE_DENOMINATOR, rounding)
+        regular = payment + extra.get(month, 0)
+        balance = due - (due if month == term or regular > due else regular)
+        balances.append(balance / 100)
+        if balance == 0:
+            break
+    return balances
+
+
+@pytest.mark.parametrize("mode", ["float", "exact"])
+def test_get_loan_scenarios(db: Session, client: TestClient, mocker, mode: str):
+    mocker.patch.object(crud.settings, "amortization_mode", mode)
+    loan1 = sqlmodels.Loan(amount=250000, annual_interest_rate=4.5, loan_term_in_months=360)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+    schedule = client.get("/loans/schedule/" + str(loan1.id), params={"fields": "month,remaining_balance"}).json()
+
+    request = {"include_schedule": True, "fields": "month,remaining_balance", "scenarios": [
+        {"name": "as agreed"},
+        {"name": "extra 200", "events": [{"type": "extra_payment", "month": 13, "amount": 200}]},
+        {"name": "lump sum", "events": [{"type": "lump_sum", "month": 24, "amount": 20000},
+                                        {"type": "extra_payment", "month": 25, "end_month": 36, "amount": 50}]},
+        {"name": "refinance", "events": [{"type": "rate_change", "month": 61, "annual_interest_rate": 3.25}]}]}
+    response = client.post("/loans/schedule/" + str(loan1.id) + "/scenarios", json=request)
+    assert response.status_code == 200
+    agreed, extra, lump_sum, refinance = response.json()
+
+    assert agreed['payoff_month'] == 360
+    assert agreed['schedule'] == schedule
+    assert agreed['interest_saved'] == 0
+    assert agreed['total_interest'] == round(agreed['total_paid'] - 250000, 2)
+    for result in (extra, lump_sum, refinance):
+        assert result['schedule'][:12] == schedule[:12]
+        assert result['schedule'][-1]['remaining_balance'] == 0
+        assert len(result['schedule']) == result['payoff_month']
+        assert result['interest_saved'] > 0
+        assert result['interest_saved'] == round(agreed['total_interest'] - result['total_interest'], 2)
+    assert extra['payoff_month'] < 360
+    assert refinance['payoff_month'] == 360
+    assert lump_sum['schedule'][23]['remaining_balance'] < schedule[23]['remaining_balance'] - 19999
+
+    if mode == "exact":
+        extras = {month: 5000 for month in range(25, 37)}
+        extras[24] = 2000000
+        assert [row['remaining_balance'] for row in lump_sum['schedule']] == \
+               reference_scenario("250000", "4.5", 360, extras, {})
+        assert [row['remaining_balance'] for row in refinance['schedule']] == \
+               reference_scenario("250000", "4.5", 360, {}, {61: Decimal("3.25")})
+
+    summaries = client.post("/loans/schedule/" + str(loan1.id) + "/scenarios",
+                            json={"scenarios": request['scenarios']}).json()
+    assert [summary['schedule'] for summary in summaries] == [None] * 4
+    assert [summary['payoff_month'] for summary in summaries] == [agreed['payoff_month'], extra['payoff_month'],
+                                                                  lump_sum['payoff_month'], 360]
+
+
+def test_get_loan_scenarios_many(db: Session, client: TestClient):
+    loan1 = sqlmodels.Loan(amount=100000, annual_interest_rate=6, loan_term_in_months=240)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+
+    request = {"scenarios": [{"events": [{"type": "extra_payment", "month": 1, "amount": 10 * i}]}
+                             for i in range(50)]}
+    results = client.post("/loans/schedule/" + str(loan1.id) + "/scenarios", json=request).json()
+    assert len(results) == 50
+    payoff_months = [result['payoff_month'] for result in results]
+    assert payoff_months[0] == 240
+    assert payoff_months == sorted(payoff_months, reverse=True)
+    savings = [result['interest_saved'] for result in results]
+    assert savings == sorted(savings)
+
+
+@pytest.mark.parametrize("events, detail", [
+    ([{"type": "lump_sum", "month": 13, "amount": 100}], "Event month out of range"),
+    ([{"type": "extra_payment", "month": 2}], "extra_payment event needs a non-negative amount"),
+    ([{"type": "rate_change", "month": 2}], "rate_change event needs an annual_interest_rate"),
+])
+def test_get_loan_scenarios_invalid(db: Session, client: TestClient, events: list, detail: str):
+    loan1 = sqlmodels.Loan(amount=1000, annual_interest_rate=5, loan_term_in_months=12)
+    db.add(loan1)
+    db.commit()
+    db.refresh(loan1)
+
+    response = client.post("/loans/schedule/" + str(loan1.id) + "/scenarios", json={"scenarios": [{"events": events}]})
+    assert response.status_code == 400
+    assert response.json() == {"detail": detail}
+
+
+def test_get_loan_scenarios_limits(db: Session, client: TestClient, mocker):
+    mocker.patch.object(crud.settings, "scenario_max_count", 2)
+    response = client.post("/loans/schedule/1/scenarios", json={"scenarios": [{}, {}, {}]})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Request exceeds 2 scenarios"}
+    response = client.post("/loans/schedule/1/scenarios", json={"scenarios": [{}]})
+    assert response.status_code == 404
+
+
+def test_solve_loan(client: TestClient):
+    loan = {"amount": 250000, "annual_interest_rate": 4.5, "loan_term_in_months": 360}
+    payment = 1266.71
+    for solve_for in loan:
+        params = {**{name: value for name, value in loan.items() if name != solve_for}, "monthly_payment": payment}
+        response = client.get("/loans:solve", params={"solve_for": solve_for, **params})
+        assert response.status_code == 200
+        solution = response.json()
+        assert solution['detail'] is None
+        assert solution['monthly_payment'] == payment
+        if solve_for == "amount":
+            assert 250000 <= solution['amount'] < 250001
+        elif solve_for == "annual_interest_rate":
+            assert solution[solve_for] == pytest.approx(4.5, abs=0.0001)
+        else:
+            assert solution[solve_for] == loan[solve_for]
+
+    response = client.get("/loans:solve", params={"solve_for": "loan_term_in_months", "amount": 1000,
+                                                  "annual_interest_rate": 12, "monthly_payment": 10})
+    assert response.json()['detail'] == "Payment does not cover the monthly interest"
+    response = client.get("/loans:solve", params={"solve_for": "annual_interest_rate", "amount": 1000,
+                                                  "loan_term_in_months": 10, "monthly_payment": 99.99})
+    assert response.json()['detail'] == "Payment does not repay the amount within the term"
+    response = client.get("/loans:solve", params={"solve_for": "annual_interest_rate", "amount": 99.99,
+                                                  "loan_term_in_months": 3, "monthly_payment": 33.33})
+    assert response.json()['annual_interest_rate'] == 0
+
+
+def test_solve_loans_grid(client: TestClient):
+    grid = {"amount": [1000, 25000.5, 250000, 987654.32], "annual_interest_rate": [0, 0.01, 4.5, 29.99],
+            "loan_term_in_months": [1, 12, 360, 480], "monthly_payment": [150, 2500, 9999.99]}
+    for solve_for in ("amount", "annual_interest_rate", "loan_term_in_months"):
+        request = {name: values for name, values in grid.items() if name != solve_for}
+        response = client.post("/loans:solve", json={"solve_for": solve_for, **request})
+        assert response.status_code == 200
+        solutions = response.json()
+        targets = [Decimal(str(values[-1])) for values in itertools.product(*request.values())]
+        assert len(solutions) == len(targets) == 4 * 4 * 3
+        for solution, target in zip(solutions, targets):
+            if solution['detail'] is not None:
+                continue
+            if solve_for == "annual_interest_rate":
+                rate = solution['annual_interest_rate'] / 1200
+                assert solution['monthly_payment'] == float(target)
+                if rate > 1:
+                    continue
+                assert amortization.monthly_payment(solution['amount'], rate, solution['loan_term_in_months']) == \
+                       pytest.approx(float(target), abs=0.01)
+                continue
+            loan = sqlmodels.LoanRead(id=1, amount=solution['amount'], loan_term_in_months=solution['loan_term_in_months'],
+                                      annual_interest_rate=solution['annual_interest_rate'])
+            assert crud.fetch_loan_schedule(loan)[0].monthly_payment == Decimal(str(solution['monthly_payment']))
+            assert Decimal(str(solution['monthly_payment'])) <= target
+            if solve_for == "amount":
+                loan.amount += Decimal("0.01")
+            else:
+                loan.loan_term_in_months -= 1
+            if loan.loan_term_in_months >= 1:
+                assert crud.fetch_loan_schedule(loan)[0].monthly_payment > target
+
+
+@pytest.mark.parametrize("request_body, detail", [
+    ({"solve_for": "amount", "amount": [1], "annual_interest_rate": [1], "loan_term_in_months": [1],
+      "monthly_payment": [1]}, "Leave amount empty to solve for it"),
+    ({"solve_for": "amount", "annual_interest_rate": [1], "monthly_payment": [1]},
+     "Missing values for: loan_term_in_months"),
+    ({"solve_for": "amount", "annual_interest_rate": [1], "loan_term_in_months": [0], "monthly_payment": [1]},
+     "Amounts and payments must be positive, rates non-negative and terms at least one"),
+    ({"solve_for": "amount", "annual_interest_rate": [1, 2], "loan_term_in_months": [1, 2],
+      "monthly_payment": [1, 2, 3]}, "Grid exceeds 10 loans"),
+])
+def test_solve_loans_invalid(client: TestClient, mocker, request_body: dict, detail: str):
+    mocker.patch.object(crud.settings, "batch_max_loans", 10)
+    response = client.post("/loans:solve", json=request_body)
+    assert response.status_code == 400
+    assert response.json() == {"detail": detail}
+
+
+def test_get_loan_schedule_etag(db: Session, client: TestClient, mocker):
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3)
+    loan2 = sqlmodels.Loan(amount="250.00", annual_interest_rate=12.45, loan_term_in_months=3)
+    db.add_all([loan1, loan2])
+    db.commit()
+    url = "/loans/schedule/" + str(loan1.id)
+
+    response = client.get(url)
+    etag = response.headers['etag']
+    assert response.headers['cache-control'] == "public, max-age=300"
+    assert response.headers['vary'] == "Accept"
+    assert client.get("/loans/schedule/" + str(loan2.id)).headers['etag'] == etag
+    assert client.get(url, params={"fields": "month,principal"}).headers['etag'] != etag
+    assert client.get(url, params={"to_month": 2}).headers['etag'] != etag
+    assert client.get(url, headers={"Accept": "text/csv"}).headers['etag'] != etag
+
+    window = mocker.spy(crud, "fetch_loan_schedule_window")
+    for if_none_match in (etag, 'W/' + etag, '"other", ' + etag, "*"):
+        response = client.get(url, headers={"If-None-Match": if_none_match})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers['etag'] == etag
+    assert window.call_count == 0
+    assert client.get(url, headers={"If-None-Match": '"other"'}).status_code == 200
+    assert window.call_count == 1
+
+    mocker.patch.object(crud.settings, "amortization_mode", "exact")
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_get_loan_summary_etag(db: Session, client: TestClient, mocker):
+    mocker.patch.object(crud.settings, "http_cache_max_age", 0)
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3)
+    db.add(loan1)
+    db.commit()
+    url = "/loans/schedule/" + str(loan1.id) + "/summary/"
+
+    response = client.get(url + "2")
+    assert response.headers['cache-control'] == "no-cache"
+    assert client.get(url + "3").headers['etag'] != response.headers['etag']
+    summary = mocker.spy(crud, "fetch_loan_summary")
+    assert client.get(url + "2", headers={"If-None-Match": response.headers['etag']}).status_code == 304
+    assert summary.call_count == 0
+    assert client.get(url + "4", headers={"If-None-Match": "*"}).status_code == 400
+
+
+def test_get_loan_etag(db: Session, client: TestClient):
+    user1 = sqlmodels.User(name="user1", email="user1@gmail.com")
+    user2 = sqlmodels.User(name="user2", email="user2@gmail.com")
+    db.add_all([user1, user2])
+    db.commit()
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3, primary_user_id=user1.id)
+    db.add(loan1)
+    db.commit()
+    url = "/loans/" + str(loan1.id)
+
+    response = client.get(url)
+    etag = response.headers['etag']
+    assert response.headers['cache-control'] == "private, max-age=300"
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    client.get("/users/user1@gmail.com/loans/share/" + str(loan1.id), params={"shared_user_id": user2.id})
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers['etag'] != etag
+    assert [user['id'] for user in response.json()['shared_users']] == [user2.id]
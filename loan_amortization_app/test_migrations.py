@@ -0,0 +1,67 @@
+import pytest
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import create_engine
+
+import migrations
+
+
+def legacy_engine(tmp_path, emails):
+    engine = create_engine("sqlite:///" + str(tmp_path / "legacy.db"))
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE user (name VARCHAR NOT NULL, email VARCHAR NOT NULL, "
+                                "id INTEGER NOT NULL, PRIMARY KEY (id))"))
+        for i, email in enumerate(emails):
+            connection.execute(text("INSERT INTO user (name, email, id) VALUES (:name, :email, :id)"),
+                               {"name": "user", "email": email, "id": i + 1})
+    return engine
+
+
+def test_upgrade_adds_unique_email_index(tmp_path):
+    engine = legacy_engine(tmp_path, ["user1@gmail.com", "user2@gmail.com"])
+
+    assert migrations.upgrade(engine) == migrations.SCHEMA_VERSION
+    indexes = {index['name']: index for index in inspect(engine).get_indexes("user")}
+    assert indexes['ix_user_email']['unique'] == 1
+    assert migrations.upgrade(engine) == migrations.SCHEMA_VERSION
+
+    with pytest.raises(IntegrityError):
+        with engine.begin() as connection:
+            connection.execute(text("INSERT INTO user (name, email) VALUES ('user', 'user1@gmail.com')"))
+
+
+def test_upgrade_rejects_duplicate_emails(tmp_path):
+    engine = legacy_engine(tmp_path, ["user1@gmail.com", "user1@gmail.com"])
+
+    with pytest.raises(IntegrityError):
+        migrations.upgrade(engine)
+    with engine.connect() as connection:
+        assert migrations.current_version(connection) == 0
+
+
+def test_upgrade_adds_relationship_index(tmp_path):
+    engine = legacy_engine(tmp_path, [])
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE userloanrelationship (loan_id INTEGER NOT NULL, "
+                                "user_id INTEGER NOT NULL, PRIMARY KEY (loan_id, user_id))"))
+
+    migrations.upgrade(engine)
+    indexes = {index['name']: index for index in inspect(engine).get_indexes("userloanrelationship")}
+    assert indexes['ix_userloanrelationship_user_id_loan_id']['column_names'] == ["user_id", "loan_id"]
+    with engine.connect() as connection:
+        plan = connection.execute(text("EXPLAIN QUERY PLAN SELECT loan_id FROM userloanrelationship "
+                                       "WHERE user_id = 1")).all()
+    assert "ix_userloanrelationship_user_id_loan_id" in " ".join(row[-1] for row in plan)
+
+
+def test_ensure_schema_checks_version(tmp_path, mocker):
+    engine = create_engine("sqlite:///" + str(tmp_path / "fresh.db"))
+    assert not migrations.is_current(engine)
+    assert migrations.ensure_schema(engine) == migrations.SCHEMA_VERSION
+    assert migrations.is_current(engine)
+
+    upgrade = mocker.spy(migrations, "upgrade")
+    assert migrations.ensure_schema(engine, "version") == migrations.SCHEMA_VERSION
+    upgrade.assert_not_called()
+    assert migrations.ensure_schema(engine, "full") == migrations.SCHEMA_VERSION
+    upgrade.assert_called_once_with(engine)
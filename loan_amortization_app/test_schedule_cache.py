@@ -0,0 +1,72 @@
+from decimal import Decimal
+
+import amortization
+from schedule_cache import ScheduleCache, schedule_key
+
+
+def make_columns(term: int):
+    return amortization.python_schedule(1000.0, 5, term)
+
+
+def test_get_or_compute_counts_hits_and_misses():
+    cache = ScheduleCache(max_entries=10, max_months=1000)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return make_columns(12)
+
+    first = cache.get_or_compute(("a",), compute)
+    second = cache.get_or_compute(("a",), compute)
+
+    assert first is second
+    assert len(calls) == 1
+    assert cache.stats() == {"entries": 1, "months": 12, "hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_evicts_least_recently_used_entry():
+    cache = ScheduleCache(max_entries=2, max_months=1000)
+    cache.put("a", make_columns(3))
+    cache.put("b", make_columns(3))
+    cache.get("a")
+    cache.put("c", make_columns(3))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_evicts_by_total_months():
+    cache = ScheduleCache(max_entries=10, max_months=400)
+    cache.put("a", make_columns(360))
+    cache.put("b", make_columns(36))
+    cache.put("c", make_columns(12))
+
+    assert cache.get("a") is None
+    assert cache.stats()["months"] == 48
+    cache.put("d", make_columns(480))
+    assert cache.get("d") is None
+
+
+def test_invalidate_and_clear():
+    cache = ScheduleCache(max_entries=10, max_months=1000)
+    cache.put("a", make_columns(12))
+    cache.put("b", make_columns(12))
+
+    assert cache.invalidate("a")
+    assert not cache.invalidate("a")
+    assert cache.stats()["months"] == 12
+    cache.clear()
+    assert cache.stats()["entries"] == 0
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ScheduleCache(max_entries=0, max_months=1000)
+    cache.put("a", make_columns(12))
+    assert cache.get("a") is None
+
+
+def test_schedule_key_shares_identical_products():
+    assert schedule_key(Decimal("250000"), Decimal("4.5"), 360) == schedule_key(Decimal("250000.00"),
+                                                                                Decimal("4.50"), 360)
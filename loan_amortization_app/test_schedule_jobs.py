@@ -0,0 +1,90 @@
+from test_users import session_fixture, client_fixture, before_test
+
+import json
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel import Session
+
+import crud
+import main
+import sqlmodels
+from schedule_jobs import ScheduleJobManager
+
+
+@pytest.fixture(name="jobs", scope="module")
+def jobs_fixture(tmp_path_factory):
+    jobs = ScheduleJobManager(workers=2, shard_size=2, directory=str(tmp_path_factory.mktemp("jobs")))
+    yield jobs
+    jobs.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def use_jobs(jobs, mocker):
+    mocker.patch.object(main, "schedule_jobs", jobs)
+
+
+def wait_for(client: TestClient, job_id: str) -> dict:
+    for _ in range(600):
+        status = client.get("/loans/schedules:jobs/" + job_id).json()
+        if status['status'] in ("done", "failed"):
+            return status
+        time.sleep(0.05)
+    raise AssertionError("job did not finish")
+
+
+def add_loans(db: Session):
+    loans = [sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3),
+             sqlmodels.Loan(amount=250000, annual_interest_rate=4.5, loan_term_in_months=360),
+             sqlmodels.Loan(amount=1000, annual_interest_rate=0, loan_term_in_months=12),
+             sqlmodels.Loan(amount=987654.32, annual_interest_rate=29.99, loan_term_in_months=480),
+             sqlmodels.Loan(amount=1000, annual_interest_rate=5, loan_term_in_months=0)]
+    db.add_all(loans)
+    db.commit()
+    return [loan.id for loan in loans]
+
+
+def test_schedule_job_matches_batch(db: Session, client: TestClient):
+    loan_ids = add_loans(db)
+    loan_ids = loan_ids[:4] + [-1] + loan_ids[4:] + [loan_ids[0]]
+
+    response = client.post("/loans/schedules:jobs", json={"loan_ids": loan_ids})
+    assert response.status_code == 202
+    job = response.json()
+    assert job['status'] in ("queued", "running", "done")
+    assert job['loans'] == 7
+    status = wait_for(client, job['id'])
+    assert status == {"id": job['id'], "status": "done", "loans": 7, "completed": 7, "error": None}
+
+    lines = [json.loads(line) for line in client.get("/loans/schedules:jobs/" + job['id'] + "/result").iter_lines()]
+    batch = [json.loads(line) for line in client.post("/loans/schedules:batch",
+                                                      json={"loan_ids": loan_ids[:4] + [-1]}).iter_lines()]
+    assert lines[:5] == batch
+    assert lines[4] == {"loan_id": -1, "detail": "Loan not found"}
+    assert lines[5] == {"loan_id": loan_ids[5], "detail": "Loan term must be at least one month"}
+    assert lines[6] == lines[0]
+
+    assert client.delete("/loans/schedules:jobs/" + job['id']).status_code == 204
+    assert client.get("/loans/schedules:jobs/" + job['id']).status_code == 404
+    assert client.get("/loans/schedules:jobs/" + job['id'] + "/result").status_code == 404
+
+
+def test_schedule_job_exact_fields(db: Session, client: TestClient, mocker):
+    mocker.patch.object(crud.settings, "amortization_mode", "exact")
+    loan_ids = add_loans(db)[:4]
+
+    job = client.post("/loans/schedules:jobs", json={"loan_ids": loan_ids, "fields": "month,principal,interest"}).json()
+    assert wait_for(client, job['id'])['status'] == "done"
+    lines = [json.loads(line) for line in client.get("/loans/schedules:jobs/" + job['id'] + "/result").iter_lines()]
+
+    for line, loan_id in zip(lines, loan_ids):
+        columns = crud.compute_loan_schedule_columns(db.get(sqlmodels.Loan, loan_id))
+        assert line == {"loan_id": loan_id, "schedule": columns.rows(("month", "principal", "interest"))}
+
+
+def test_schedule_job_errors(client: TestClient, mocker):
+    assert client.post("/loans/schedules:jobs", json={"loan_ids": [1], "fields": "month,nope"}).status_code == 400
+    mocker.patch.object(main.settings, "job_max_loans", 2)
+    assert client.post("/loans/schedules:jobs", json={"loan_ids": [1, 2, 3]}).status_code == 400
+    assert client.get("/loans/schedules:jobs/unknown").status_code == 404
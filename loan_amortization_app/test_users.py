@@ -1,10 +1,19 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 from fastapi.testclient import TestClient
 from sqlmodel import Session, create_engine, delete
 from sqlmodel.pool import StaticPool
 
+import crud
+import migrations
 import sqlmodels
+from database import engine_options, make_session_factory
+from instrumentation import count_queries
 from main import app, get_db
+from pagination import encode_cursor
+from schedule_cache import schedule_cache
 
 
 @pytest.fixture(name="db")
@@ -12,7 +21,7 @@ def session_fixture():
     SQLALCHEMY_TEST_DATABASE_URL = "sqlite:///./loan_amortization_app_test.db"
     engine = create_engine(SQLALCHEMY_TEST_DATABASE_URL, connect_args={"check_same_thread": False},
                            poolclass=StaticPool)
-    sqlmodels.SQLModel.metadata.create_all(engine)
+    migrations.upgrade(engine)
     with Session(engine) as db:
         try:
             yield db
@@ -34,14 +43,17 @@ def client_fixture(db: Session):
 
 @pytest.fixture(autouse=True)
 def before_test(db: Session):
+    schedule_cache.clear()
     db.exec(delete(sqlmodels.User))
     db.exec(delete(sqlmodels.Loan))
     db.exec(delete(sqlmodels.UserLoanRelationship))
+    db.exec(delete(sqlmodels.LoanScheduleRow))
     db.commit()
     yield
     db.exec(delete(sqlmodels.User))
     db.exec(delete(sqlmodels.Loan))
     db.exec(delete(sqlmodels.UserLoanRelationship))
+    db.exec(delete(sqlmodels.LoanScheduleRow))
     db.commit()
 
 
@@ -225,6 +237,50 @@ def test_get_user_loans_user_not_found(client: TestClient):
     assert obj['detail'] == "User not found"
 
 
+@pytest.mark.parametrize("mode", ["float", "exact"])
+def test_get_user_portfolio(db: Session, client: TestClient, mocker, mode: str):
+    mocker.patch.object(crud.settings, "amortization_mode", mode)
+    user1 = sqlmodels.User(name="testUser", email="user1@gmail.com")
+    user2 = sqlmodels.User(name="testUser2", email="user2@gmail.com")
+    db.add(user1)
+    db.add(user2)
+    db.commit()
+    db.refresh(user1)
+    db.refresh(user2)
+
+    loan1 = sqlmodels.Loan(amount=250000, annual_interest_rate=4.5, loan_term_in_months=36, primary_user_id=user1.id)
+    loan2 = sqlmodels.Loan(amount=1234.56, annual_interest_rate=21.2, loan_term_in_months=12, primary_user_id=user2.id)
+    loan3 = sqlmodels.Loan(amount=999.99, annual_interest_rate=0, loan_term_in_months=24, primary_user_id=user2.id)
+    db.add_all([loan1, loan2, loan3])
+    db.commit()
+    loan_ids = [loan1.id, loan2.id]
+    terms = {loan1.id: 36, loan2.id: 12}
+    db.add(sqlmodels.UserLoanRelationship(loan_id=loan2.id, user_id=user1.id))
+    db.commit()
+
+    response = client.get("/users/user1@gmail.com/portfolio")
+    assert response.status_code == 200
+    portfolio = response.json()
+    assert portfolio['loan_ids'] == loan_ids
+    assert len(portfolio['months']) == 36
+
+    for month in (1, 12, 13, 36):
+        summaries = [client.get("/loans/schedule/" + str(loan_id) + "/summary/"
+                                + str(min(month, terms[loan_id]))).json() for loan_id in loan_ids]
+        row = portfolio['months'][month - 1]
+        assert row['month'] == month
+        for key in ("principal_balance", "principal_balance_paid", "interest_paid"):
+            assert row[key] == round(sum(summary[key] for summary in summaries), 2)
+
+
+def test_get_user_portfolio_without_loans(db: Session, client: TestClient):
+    db.add(sqlmodels.User(name="testUser", email="user1@gmail.com"))
+    db.commit()
+
+    assert client.get("/users/user1@gmail.com/portfolio").json() == {"loan_ids": [], "months": []}
+    assert client.get("/users/user2@gmail.com/portfolio").status_code == 404
+
+
 def test_get_user_share_loan(db: Session, client: TestClient):
     user1 = sqlmodels.User(name="testUser", email="user1@gmail.com")
     db.add(user1)
@@ -318,3 +374,173 @@ def test_get_user_share_loan_share_user_not_found(db: Session, client: TestClien
     assert response.status_code == 404
     data = response.json()
     assert data['detail'] == "User to share loan not found"
+
+
+def test_parallel_requests_use_separate_sessions(db: Session):
+    engine = create_engine("sqlite:///./loan_amortization_app_test.db", **engine_options(
+        "sqlite:///./loan_amortization_app_test.db"))
+    session_factory = make_session_factory(engine)
+    sessions = []
+
+    def get_db_override():
+        request_db = session_factory()
+        sessions.append(request_db)
+        try:
+            yield request_db
+        finally:
+            request_db.close()
+
+    app.dependency_overrides[get_db] = get_db_override
+    client = TestClient(app)
+    emails = ["user" + str(i) + "@gmail.com" for i in range(20)]
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            created = list(executor.map(
+                lambda email: client.post("/users/", json={"name": email, "email": email}), emails))
+            fetched = list(executor.map(lambda email: client.get("/users/" + email), emails))
+    finally:
+        app.dependency_overrides.clear()
+        engine.dispose()
+
+    assert [response.status_code for response in created] == [200] * 20
+    assert [response.json()['email'] for response in fetched] == emails
+    assert len({response.json()['id'] for response in fetched}) == 20
+    assert len({id(request_db) for request_db in sessions}) == 40
+
+
+@pytest.mark.parametrize("loading, max_queries", [("selectin", 2), ("joined", 1)])
+def test_get_user_loans_query_count(db: Session, client: TestClient, mocker, loading: str, max_queries: int):
+    mocker.patch.object(crud.settings, "relationship_loading", loading)
+    user1 = sqlmodels.User(name="testUser", email="user1@gmail.com")
+    db.add(user1)
+    db.commit()
+    db.refresh(user1)
+    for _ in range(5):
+        loan = sqlmodels.Loan(amount=250000, annual_interest_rate=4.5, loan_term_in_months=360,
+                              primary_user_id=user1.id)
+        db.add(loan)
+        db.commit()
+        db.refresh(loan)
+        db.add(sqlmodels.UserLoanRelationship(loan_id=loan.id, user_id=user1.id))
+    db.commit()
+    db.expire_all()
+
+    with count_queries() as queries:
+        response = client.get("/users/user1@gmail.com/loans")
+
+    assert response.status_code == 200
+    assert len(response.json()['loans']) == 5
+    assert queries.count <= max_queries
+
+
+def test_get_users_pages_with_cursor(db: Session, client: TestClient):
+    for i in range(5):
+        db.add(sqlmodels.User(name="testUser", email="user" + str(i) + "@gmail.com"))
+    db.commit()
+
+    emails, cursor = [], None
+    for _ in range(3):
+        response = client.get("/users/", params={"limit": 2, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        emails += [user['email'] for user in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+
+    assert emails == ["user" + str(i) + "@gmail.com" for i in range(5)]
+    assert cursor is None
+
+
+def test_get_users_invalid_cursor(client: TestClient):
+    for cursor in ("not-a-cursor", encode_cursor(1, 2)):
+        response = client.get("/users/", params={"cursor": cursor})
+        assert response.status_code == 400
+        assert response.json()['detail'] == "Invalid cursor"
+
+
+def test_export_users(db: Session, client: TestClient):
+    users = [sqlmodels.User(name="testUser", email="user" + str(i) + "@gmail.com") for i in range(5)]
+    for user in users:
+        db.add(user)
+    db.commit()
+    ids = [user.id for user in users]
+
+    response = client.get("/users:export")
+    assert response.status_code == 200
+    assert response.headers['content-type'] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row['id'] for row in rows] == ids
+    assert rows[0] == {"name": "testUser", "email": "user0@gmail.com", "id": ids[0]}
+
+    response = client.get("/users:export", params={"cursor": encode_cursor(ids[2])})
+    assert [json.loads(line)['id'] for line in response.text.splitlines()] == ids[3:]
+
+
+def test_get_relationship_keyset(db: Session):
+    for loan_id, user_id in ((1, 2), (1, 1), (2, 1), (3, 5)):
+        db.add(sqlmodels.UserLoanRelationship(loan_id=loan_id, user_id=user_id))
+    db.commit()
+
+    first = crud.get_relationship(db, limit=2)
+    second = crud.get_relationship(db, limit=2, after=(first[-1].loan_id, first[-1].user_id))
+
+    assert [(r.loan_id, r.user_id) for r in first] == [(1, 1), (1, 2)]
+    assert [(r.loan_id, r.user_id) for r in second] == [(2, 1), (3, 5)]
+
+
+def test_share_loans_bulk(db: Session, client: TestClient, mocker):
+    mocker.patch.object(crud.settings, "batch_chunk_size", 2)
+    users = [sqlmodels.User(name="user" + str(i), email="user" + str(i) + "@gmail.com") for i in range(5)]
+    db.add_all(users)
+    db.commit()
+    loans = [sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3, primary_user_id=users[0].id)
+             for _ in range(3)]
+    db.add_all(loans)
+    db.commit()
+    db.add(sqlmodels.UserLoanRelationship(loan_id=loans[0].id, user_id=users[1].id))
+    db.commit()
+    loan_ids = [loan.id for loan in loans]
+    user_ids = [user.id for user in users[1:]]
+
+    with count_queries() as queries:
+        response = client.post("/users/user0@gmail.com/loans:share",
+                               json={"loan_ids": loan_ids, "shared_user_ids": user_ids + user_ids[:1]})
+    assert response.status_code == 200
+    result = response.json()
+    assert result['existing'] == [{"loan_id": loan_ids[0], "user_id": user_ids[0]}]
+    assert len(result['created']) == 3 * 4 - 1
+    assert queries.count <= 12
+
+    shared = crud.get_relationship(db, limit=100)
+    assert sorted((link.loan_id, link.user_id) for link in shared) == \
+           sorted((loan_id, user_id) for loan_id in loan_ids for user_id in user_ids)
+    response = client.get("/users/user4@gmail.com/loans")
+    assert [loan['id'] for loan in response.json()['loans']] == loan_ids
+
+
+def test_share_loans_bulk_invalid(db: Session, client: TestClient, mocker):
+    user1 = sqlmodels.User(name="user1", email="user1@gmail.com")
+    user2 = sqlmodels.User(name="user2", email="user2@gmail.com")
+    db.add_all([user1, user2])
+    db.commit()
+    loan1 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3, primary_user_id=user1.id)
+    loan2 = sqlmodels.Loan(amount=250, annual_interest_rate=12.45, loan_term_in_months=3, primary_user_id=user2.id)
+    db.add_all([loan1, loan2])
+    db.commit()
+    url = "/users/user1@gmail.com/loans:share"
+
+    for path, body, status, detail in (
+            ("/users/user9@gmail.com/loans:share", {"loan_ids": [loan1.id]}, 404, "User not found"),
+            (url, {"loan_ids": [loan1.id, 99], "shared_user_ids": [user2.id]}, 404, "Loan not found: 99"),
+            (url, {"loan_ids": [loan1.id, loan2.id], "shared_user_ids": [user2.id]}, 400,
+             "Only the primary loan holder may share the loan"),
+            (url, {"loan_ids": [loan1.id], "shared_user_ids": [user2.id, 98, 97]}, 404,
+             "User to share loan not found: 97, 98")):
+        response = client.post(path, json=body)
+        assert response.status_code == status
+        assert response.json() == {"detail": detail}
+    assert crud.get_relationship(db) == []
+
+    mocker.patch.object(crud.settings, "batch_max_loans", 1)
+    response = client.post(url, json={"loan_ids": [loan1.id], "shared_user_ids": [1, 2]})
+    assert response.json() == {"detail": "Share exceeds 1 pairs"}
@@ -0,0 +1,97 @@
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import amortization
+from amortization import ScheduleColumns
+
+
+def numpy_schedule(amount: float, annual_interest_rate, term: int, start: int = 1,
+                   stop: Optional[int] = None) -> ScheduleColumns:
+    return next(numpy_schedules([amount], [annual_interest_rate], [term], start=start, stop=stop))
+
+
+def numpy_schedules(amounts: Sequence[float], annual_interest_rates: Sequence, terms: Sequence[int],
+                    start: int = 1, stop: Optional[int] = None) -> Iterator[ScheduleColumns]:
+    amounts = np.asarray(amounts, dtype=np.float64)
+    terms = np.asarray(terms, dtype=np.int64)
+    rates = np.array([amortization.monthly_interest_rate(r) for r in annual_interest_rates], dtype=np.float64)
+    payments = np.array([amortization.monthly_payment(a, r, t) for a, r, t in zip(amounts, rates, terms)],
+                        dtype=np.float64)
+    stops = terms if stop is None else np.minimum(terms, stop)
+    # Month start - 1 is included so principal can be taken as the drop in balance; for
+    # start == 1 that column is month 0, where the closed form gives the full amount.
+    months = np.arange(start - 1, int(stops.max(initial=0)) + 1)
+
+    # One (loans x months) matrix per column; rows shorter than the longest term are
+    # computed past their end and sliced off below.
+    with np.errstate(all="ignore"):
+        growth = np.power(float(1) + rates[:, None], months.astype(np.float64))
+        balance = np.where(rates[:, None] == 0,
+                           amounts[:, None] - payments[:, None] * months,
+                           amounts[:, None] * growth - payments[:, None] * (growth - float(1)) / rates[:, None])
+        principal = np.diff(balance, axis=1) * -1
+        interest = payments[:, None] - principal
+        months, balance, growth = months[1:], balance[:, 1:], growth[:, 1:]
+        remaining_balance, principal, interest = round_columns(
+            (balance, principal, interest), growth, months, months <= stops[:, None], amounts, rates, payments)
+
+    for i, row_stop in enumerate(stops):
+        width = max(int(row_stop) - start + 1, 0)
+        yield ScheduleColumns(month=months[:width], monthly_payment=np.full(width, round(payments[i], 2)),
+                              principal=principal[i, :width], interest=interest[i, :width],
+                              remaining_balance=remaining_balance[i, :width])
+
+
+def round_balances(balance: np.ndarray, growth: np.ndarray, months: np.ndarray, in_window: np.ndarray,
+                   amounts: np.ndarray, rates: np.ndarray, payments: np.ndarray) -> np.ndarray:
+    return round_columns((balance,), growth, months, in_window, amounts, rates, payments)[0]
+
+
+def round_columns(columns: Tuple[np.ndarray, ...], growth: np.ndarray, months: np.ndarray, in_window: np.ndarray,
+                  amounts: np.ndarray, rates: np.ndarray, payments: np.ndarray) -> List[np.ndarray]:
+    # columns holds the balance and optionally principal and interest, in that order, as the
+    # closed form gives them. Principal and interest are differences of two balances, so
+    # they may be off by twice the balance's error.
+    tolerance = np.maximum(1e-6, np.abs(amounts)[:, None] * growth * 1e-9)
+    rounded, ambiguous = [], []
+    for column, scale in zip(columns, (1, 2, 2)):
+        cents = np.abs(column) * 100
+        rounded.append(np.round(column, 2) + 0.0)
+        ambiguous.append((np.abs(cents - np.floor(cents) - 0.5) < tolerance * scale) & in_window)
+
+    # Values on a half cent are rounded from the month-by-month loop so the columns stay
+    # cent-identical to the python engine.
+    replay = np.logical_or.reduce(ambiguous)
+    for i in np.flatnonzero(replay.any(axis=1)):
+        amount, rate, payment = float(amounts[i]), float(rates[i]), float(payments[i])
+        remaining = amount
+        row = replay[i]
+        offset = int(months[0])
+        for month in range(1, int(months[np.flatnonzero(row)[-1]]) + 1):
+            principal = payment - (remaining * rate)
+            remaining -= principal
+            if month >= offset and row[month - offset]:
+                for column, cells, value in zip(rounded, ambiguous, (remaining, principal, payment - principal)):
+                    if cells[i, month - offset]:
+                        column[i, month - offset] = round(value, 2) + 0.0
+    return rounded
+
+
+def aggregate_schedules(amount_cents: Sequence[int], schedules: Sequence[ScheduleColumns]
+                        ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Schedules are aligned on month in whole cents; a loan that ends early keeps its final
+    # balance and stops paying, so its cumulative totals carry through the longer terms.
+    amounts = np.asarray(amount_cents, dtype=np.int64)
+    width = max((len(columns.month) for columns in schedules), default=0)
+    balance = np.repeat(amounts[:, None], width, axis=1)
+    payment = np.zeros((len(schedules), width), dtype=np.int64)
+    for i, columns in enumerate(schedules):
+        term = len(columns.month)
+        if term:
+            balance[i, :term] = np.rint(np.asarray(columns.remaining_balance, dtype=np.float64) * 100)
+            balance[i, term:] = balance[i, term - 1]
+            payment[i, :term] = np.rint(np.asarray(columns.monthly_payment, dtype=np.float64) * 100)
+    principal_paid = amounts[:, None] - balance
+    interest_paid = np.cumsum(payment, axis=1) - principal_paid
+    return balance.sum(axis=0), principal_paid.sum(axis=0), interest_paid.sum(axis=0)